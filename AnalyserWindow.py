@@ -1,30 +1,36 @@
+import re
 import sys
 import time
 
 from PyQt5 import QtCore, QtGui
-from PyQt5.QtCore import Qt, QDataStream
+from PyQt5.QtCore import Qt, QDataStream, QTimer
 from PyQt5.QtCore import QMimeData
 from PyQt5.QtWidgets import QApplication, QMainWindow, QTabWidget, QWidget, QVBoxLayout, QHBoxLayout, QPlainTextEdit, \
     QGroupBox, QTableWidget, QTableWidgetItem, QTreeWidget, QTreeWidgetItem, QAbstractItemView, QDialog, QPushButton, \
-    QDialogButtonBox, QCheckBox, QMessageBox, QMenu, QAction
+    QDialogButtonBox, QCheckBox, QMessageBox, QMenu, QAction, QLineEdit
 
-from Prompts import Prompts
+from Prompts import Prompts, to_weight_array
+from TagWeightList import TagWeightList
 from SaveTagsWindow import SavePromptsDialog
-from defines import ANALYSIS_README, PRESET_TAG_PATH, ANALYSIS_SHOW_COLUMNS
+from defines import ANALYSIS_README, PRESET_TAG_PATH, ANALYSIS_SHOW_COLUMNS, ANALYSIS_DELAY
 from df_utility import *
 from TagManager import *
 from app_utility import *
-from ui_components import TagViewTableWidget, DraggableTree, DataFrameRowEditDialog
+from ui_components import TagViewTableWidget, DraggableTree, DataFrameRowEditDialog, add_weight_operation_menu
 
 
 class AnalyserWindow(QWidget):
+    # Rebuild the analysis table instead of patching it if more than this ratio of tags are added or removed
+    REBUILD_RATIO = 0.5
+
     def __init__(self, tag_manager: TagManager):
         super().__init__()
 
         self.tag_manager = tag_manager
         self.prompts = Prompts()
+        self.tree_version = -1
 
-        # self.tag_manager.register_database_observer(self)
+        self.tag_manager.register_database_observer(self)
 
         # self.positive_tags = []
         # self.negative_tags = []
@@ -34,6 +40,8 @@ class AnalyserWindow(QWidget):
         self.negative_df = pd.DataFrame(columns=DATABASE_FIELDS)
 
         self.row_color = QtGui.QColor(255, 255, 255)
+        # The weights are numbers in dataframe, formatted when showing in table
+        self.weight_column = list(ANALYSIS_SHOW_COLUMNS.keys()).index('weight')
 
         # Create the root layout
         root_layout = QVBoxLayout(self)
@@ -80,8 +88,24 @@ class AnalyserWindow(QWidget):
         save_prompts_button.clicked.connect(self.on_button_save_whole_prompts)
         menu_layout.addWidget(save_prompts_button)
 
+        suggest_button = QPushButton('拼写纠错建议')
+        suggest_button.clicked.connect(self.on_button_suggest_tags)
+        menu_layout.addWidget(suggest_button)
+
         # Add a stretch that weights max to the menu layout
         menu_layout.addStretch(1)
+
+        # Filter the analysis tables by the tag, translation or comments
+        self.search_edit = QLineEdit()
+        self.search_edit.setPlaceholderText('搜索Tag / 翻译 / 备注')
+        self.search_edit.setClearButtonEnabled(True)
+        self.search_edit.textChanged.connect(self.apply_search_filter)
+        menu_layout.addWidget(self.search_edit)
+
+        reset_statistics_button = QPushButton('统计清零')
+        reset_statistics_button.clicked.connect(self.on_button_reset_statistics)
+        menu_layout.addWidget(reset_statistics_button)
+
         # Add the menu layout to the root layout between the top and bottom layouts
         root_layout.addLayout(menu_layout)
 
@@ -112,11 +136,14 @@ class AnalyserWindow(QWidget):
         # Connect the sort function to the header clicked signal of the positive and negative tables
         self.positive_table.horizontalHeader().sectionClicked.connect(self.positive_table.sortByColumn)
         self.negative_table.horizontalHeader().sectionClicked.connect(self.negative_table.sortByColumn)
+        # Keep the prompt order until a header is clicked. The default indicator is shifted by the column insertion.
+        self.positive_table.horizontalHeader().setSortIndicator(-1, Qt.AscendingOrder)
+        self.negative_table.horizontalHeader().setSortIndicator(-1, Qt.AscendingOrder)
 
         # Create the tree widget for the tree group
         self.tree_group = QGroupBox("Tree", parent=self)
         # Create the tree widget for the tree group
-        self.tree = DraggableTree(self.tag_manager.get_database(), self.on_edit_done, parent=self)
+        self.tree = DraggableTree(self.tag_manager, self.on_edit_done, parent=self)
         # Create the tree widget for the tree group with one column and the specified name
         self.tree.setHeaderLabels(['Tag分类'])
         self.tree.setColumnCount(1)
@@ -143,6 +170,10 @@ class AnalyserWindow(QWidget):
 
         # Connect the on_prompt_edit function to the textChanged signal of self.text_edit
         self.text_edit.textChanged.connect(self.on_prompt_edit)
+        # Analyse the prompt once the typing pauses instead of on every key
+        self.analysis_timer = QTimer(self)
+        self.analysis_timer.setSingleShot(True)
+        self.analysis_timer.timeout.connect(self.analyse_prompt)
 
         # Set both tables to be whole row selection, multiple selection, not editable, and draggable
         self.positive_table.setSelectionBehavior(QAbstractItemView.SelectRows)
@@ -178,12 +209,25 @@ class AnalyserWindow(QWidget):
 
     # Define a function to be called when the text in self.text_edit changes
     def on_prompt_edit(self):
-        self.prompts.from_text(self.text_edit.toPlainText())
+        self.analysis_timer.start(ANALYSIS_DELAY)
+
+    def analyse_prompt(self):
+        self.analysis_timer.stop()
+        # The analysed prompt is counted into tag statistics at the next flush
+        self.prompts.from_text(self.text_edit.toPlainText(), self.tag_manager.get_tag_statistics(), 'analyser')
         # # Call parse_prompts with the input of self.text_edit
         # self.positive_tags, self.negative_tags, self.extra_data = \
         #     TagManager.parse_prompts(self.text_edit.toPlainText())
-        self.rebuild_analysis_table(True, True, True)
-    
+        self.update_analysis_table(True)
+        self.update_analysis_table(False)
+        if self.search_edit.text().strip() != '':
+            self.apply_search_filter()
+
+    def flush_prompt_analysis(self):
+        # Analyse the pending edit now for the operations that use the analysis result
+        if self.analysis_timer.isActive():
+            self.analyse_prompt()
+
     # Define a function to be called when a cell in the positive table is double clicked
     def on_positive_table_double_click(self, row, column):
         self.do_edit_item(self.positive_table, row, self.positive_df)
@@ -208,6 +252,9 @@ class AnalyserWindow(QWidget):
             lambda: self.do_save_selected_translation(self.positive_table, self.positive_df))
         menu.addAction(save_translation_action)
 
+        add_weight_operation_menu(menu, self, self.tag_manager,
+                                  lambda operation: self.do_adjust_weights(True, operation))
+
         # Show the menu at the position of the right click
         menu.exec_(self.positive_table.viewport().mapToGlobal(position))
 
@@ -227,11 +274,15 @@ class AnalyserWindow(QWidget):
             lambda: self.do_save_selected_translation(self.negative_table, self.negative_df))
         menu.addAction(save_translation_action)
 
+        add_weight_operation_menu(menu, self, self.tag_manager,
+                                  lambda operation: self.do_adjust_weights(False, operation))
+
         # Show the menu at the position of the right click
         menu.exec_(self.negative_table.viewport().mapToGlobal(position))
 
     # Define a function to be called when the translate button is clicked
     def on_button_translate(self):
+        self.flush_prompt_analysis()
         # Pop up a message box with yes and no button
         reply = QMessageBox.question(self, 'Translation Confirmation',
                                      '将使用有道对未翻译的tag进行翻译，需要联网。机翻精度有限，仅供参考。\n'
@@ -251,17 +302,19 @@ class AnalyserWindow(QWidget):
                 self.positive_table.item(row, 0).setCheckState(Qt.Checked)
 
     def on_button_save_picked_positive(self):
+        self.flush_prompt_analysis()
         checked_tags = []
-        weights = []
         for row in self.positive_table.selectionModel().selectedRows():     # range(self.positive_table.rowCount()):
             # 20230606: Change check selection to normal multiple selection
             # if self.positive_table.item(row, 0).checkState() == Qt.Checked:
             checked_tags.append(self.positive_table.item(row.row(), 0).text())
-            weights.append(self.positive_table.item(row.row(), 1).text())
 
         if len(checked_tags) > 0:
+            # Take the numeric weights from dataframe instead of the formatted text of table
+            positions = pd.Index(self.positive_df[PRIMARY_KEY]).get_indexer(checked_tags)
+            weights = to_weight_array(self.positive_df['weight'].values[positions])
             prompt = Prompts()
-            prompt.positive_tag_data_dict = {PRIMARY_KEY: checked_tags, 'weight': weights}
+            prompt.positive_tag_weights = TagWeightList(checked_tags, weights)
             prompt.extra_data_string = self.prompts.extra_data_string
 
             # extras = self.parse_extra_info(self.prompts.extra_data_string)
@@ -272,13 +325,40 @@ class AnalyserWindow(QWidget):
             # dlg.text_extras.setText(extras_str)
             dlg.exec_()
 
+    def on_button_suggest_tags(self):
+        self.flush_prompt_analysis()
+        # Look up all the unknown tags of prompts in one pass
+        tags = self.prompts.positive_tag_weights.tags() + self.prompts.negative_tag_weights.tags()
+        unknown_tags = [tag for tag in tags if not self.tag_manager.has_tag(tag)]
+        suggestions = self.tag_manager.suggest_tags(unknown_tags, 1)
+        if len(suggestions) == 0:
+            QMessageBox.information(self, '拼写纠错建议', '没有找到可纠正的未知Tag。')
+            return
+
+        text = '\n'.join('%s  ->  %s' % (tag, suggestion[0]) for tag, suggestion in suggestions.items())
+        reply = QMessageBox.question(self, '拼写纠错建议', text + '\n\n是否替换Prompts中的这些Tag？',
+                                     QMessageBox.Yes | QMessageBox.No)
+        if reply == QMessageBox.Yes:
+            prompt_text = self.text_edit.toPlainText()
+            for tag, suggestion in suggestions.items():
+                # Replace the whole tag only, keep the weight and brackets around it
+                prompt_text = re.sub(r'(?<![\w-])' + re.escape(tag) + r'(?![\w-])',
+                                     lambda _: suggestion[0], prompt_text)
+            self.text_edit.setPlainText(prompt_text)
+
+    def on_button_reset_statistics(self):
+        reply = QMessageBox.question(self, '统计清零', '是否清零所有Tag的统计？', QMessageBox.Yes | QMessageBox.No)
+        if reply == QMessageBox.Yes:
+            self.tag_manager.get_tag_statistics().reset()
+
     def on_button_save_whole_prompts(self):
         prompts = self.text_edit.toPlainText()
         dlg = SavePromptsDialog(prompts)
         dlg.exec_()
 
     def update_tag_path_tree(self):
-        TagManager.update_tag_path_tree(self.tree, self.tag_manager.get_database(), PRESET_TAG_PATH)
+        self.tree_version = self.tag_manager.get_path_tree_version()
+        TagManager.update_tag_path_tree(self.tree, self.tag_manager.get_paths(), PRESET_TAG_PATH)
 
     def get_selectd_tags(self, table: QTableWidget) -> [str]:
         selected_tags = [table.item(row.row(), 0).text() for row in table.selectionModel().selectedRows()]
@@ -290,11 +370,9 @@ class AnalyserWindow(QWidget):
             # Get the tag from the selected row
             tag = table.item(row, 0).text()
             selected_rows_df = df[df[PRIMARY_KEY] == tag]
-            editor = DataFrameRowEditDialog(self.tag_manager.get_database(), DATABASE_SUPPORT_FIELD, selected_rows_df, PRIMARY_KEY)
-            result = editor.exec_()
-
-            if result == QDialog.Accepted:
-                self.on_edit_done()
+            editor = DataFrameRowEditDialog(self.tag_manager, DATABASE_SUPPORT_FIELD, selected_rows_df, PRIMARY_KEY)
+            # The dialog commits the changes to tag manager
+            editor.exec_()
 
     def do_copy_tag(self, table: QTableWidget):
         # Get the selected row's first column values as a list
@@ -314,9 +392,9 @@ class AnalyserWindow(QWidget):
         # Select the 'tag' and 'translate_cn' columns where 'tag' is in selected_tags
         selected_df = df.loc[df['tag'].isin(selected_tags), [PRIMARY_KEY, 'translate_cn']]
 
-        if not selected_df.empty:
-            new_df = upsert_df_from_right(self.tag_manager.get_database(), selected_df, PRIMARY_KEY)
-            self.on_database_updated(new_df, False)
+        with self.tag_manager.edit_session() as session:
+            for tag, translation in zip(selected_df[PRIMARY_KEY], selected_df['translate_cn']):
+                session.set_property(tag, 'translate_cn', translation)
 
     def translate_unknown_tags(self):
         if translate_df(self.positive_df, PRIMARY_KEY, 'translate_cn', True) and \
@@ -335,53 +413,175 @@ class AnalyserWindow(QWidget):
     def df_to_table_decorator(self, row, col, item):
         if col == 0:
             tag = item.text()
-            if tag in self.tag_manager.get_database()[PRIMARY_KEY].values:
+            if self.tag_manager.has_tag(tag):
                 self.row_color = QtGui.QColor(0xCC, 0xFF, 0x99)
             else:
                 self.row_color = QtGui.QColor(255, 255, 255)
             item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
             item.setCheckState(Qt.Unchecked)
+        elif col == self.weight_column and item.text() != '':
+            item.setText(format_float(item.text()))
         item.setBackground(self.row_color)
 
-    def on_edit_done(self, new_df: pd.DataFrame = None, refresh_table: bool = True, refresh_tree: bool = True):
-        self.on_database_updated(new_df, refresh_tree)
-        self.rebuild_analysis_table(True, True, refresh_table)
+    # Callback Companionable. The UI is refreshed by on_database_changed().
+    def on_edit_done(self, new_df: pd.DataFrame = None):
+        self.on_database_updated(new_df)
 
-    def on_database_updated(self, new_df: pd.DataFrame = None, refresh_ui: bool = True):
+    def on_database_updated(self, new_df: pd.DataFrame = None):
         self.tag_manager.inform_database_modified(new_df, True)
-        self.tree.database = self.tag_manager.get_database()
-        if refresh_ui:
-            self.update_tag_path_tree()
+
+    def resolve_analysis_df(self, tag_weights: TagWeightList) -> pd.DataFrame:
+        # Join the tags with tag_database by PRIMARY_KEY row. Keep all tag_database columns.
+        # If the tag not in tag_database, the columns are empty string.
+        # The tags not in tag_database are looked up in the shared dictionary.
+        df = tag_weights.to_dataframe(PRIMARY_KEY, 'weight')
+        rows = self.tag_manager.lookup_rows(df[PRIMARY_KEY])
+        if not rows.empty:
+            df = merge_df_keeping_left_value(df, rows, PRIMARY_KEY)
+            translate_df(df, PRIMARY_KEY, 'translate_cn', True, True)
+        else:
+            df = df.reindex(columns=DATABASE_FIELDS).fillna('')
+        return df
 
     def rebuild_analysis_table(self, positive: bool, negative: bool, refresh_ui: bool = True):
         # Based on positive_tags and negative_tags
 
-        # Join positive_df with tag_database by PRIMARY_KEY row. Keep all tag_database columns.
-        # If the tag not in tag_database, the columns are empty string. The same to negative_df.
-
         if positive:
-            if not self.tag_manager.get_database().empty:
-                self.positive_df = pd.DataFrame(self.prompts.positive_tag_data_dict)
-                self.positive_df = merge_df_keeping_left_value(
-                    self.positive_df, self.tag_manager.get_database(), PRIMARY_KEY)
-                translate_df(self.positive_df, PRIMARY_KEY, 'translate_cn', True, True)
-            else:
-                self.positive_df = pd.DataFrame(self.prompts.positive_tag_data_dict, columns=DATABASE_FIELDS).fillna('')
+            self.positive_df = self.resolve_analysis_df(self.prompts.positive_tag_weights)
             if refresh_ui:
                 TagManager.dataframe_to_table_widget(
                     self.positive_table, self.positive_df, ANALYSIS_SHOW_COLUMNS, [], self.df_to_table_decorator)
 
         if negative:
-            if not self.tag_manager.get_database().empty:
-                self.negative_df = pd.DataFrame(self.prompts.negative_tag_data_dict)
-                self.negative_df = merge_df_keeping_left_value(
-                    self.negative_df, self.tag_manager.get_database(), PRIMARY_KEY)
-                translate_df(self.negative_df, PRIMARY_KEY, 'translate_cn', True, True)
-            else:
-                self.negative_df = pd.DataFrame(self.prompts.negative_tag_data_dict, columns=DATABASE_FIELDS).fillna('')
+            self.negative_df = self.resolve_analysis_df(self.prompts.negative_tag_weights)
             if refresh_ui:
                 TagManager.dataframe_to_table_widget(
                     self.negative_table, self.negative_df, ANALYSIS_SHOW_COLUMNS, [], self.df_to_table_decorator)
 
-    def on_database_changed(self):
-        pass
+        if refresh_ui and self.search_edit.text().strip() != '':
+            self.apply_search_filter()
+
+    def update_analysis_table(self, positive: bool):
+        """
+        Patch the analysis dataframe and table by the difference of the tag list to the last analysis.
+        The tags between the common head and tail of both lists are replaced, so the rows keep the prompt order.
+        The rows of the kept tags are reused. Only the added tags are resolved from database.
+        """
+        tag_weights = self.prompts.positive_tag_weights if positive else self.prompts.negative_tag_weights
+        table, old_df = (self.positive_table, self.positive_df) if positive else (self.negative_table, self.negative_df)
+
+        tags = tag_weights.tags()
+        weights = tag_weights.weights()
+        old_tags = old_df[PRIMARY_KEY].tolist() if not old_df.empty else []
+
+        # The changed span is [head, len - tail) of both lists
+        head = 0
+        while head < min(len(tags), len(old_tags)) and tags[head] == old_tags[head]:
+            head += 1
+        tail = 0
+        while tail < min(len(tags), len(old_tags)) - head and tags[-tail - 1] == old_tags[-tail - 1]:
+            tail += 1
+        span_tags = tags[head:len(tags) - tail]
+        old_span_tags = old_tags[head:len(old_tags) - tail]
+
+        if table.rowCount() != len(old_df) or \
+                len(span_tags) + len(old_span_tags) > max(len(tags), len(old_tags)) * self.REBUILD_RATIO:
+            self.rebuild_analysis_table(positive, not positive)
+            return
+
+        old_positions = pd.Index(old_tags).get_indexer(tags) if len(old_tags) > 0 \
+            else np.full(len(tags), -1, dtype=np.int64)
+        kept = old_positions >= 0
+        added_tags = [tag for tag, found in zip(tags, kept) if not found]
+        old_weights = to_weight_array(old_df['weight'].values[old_positions[kept]])
+        reweighted_tags = set(np.asarray(tags, dtype=object)[kept][old_weights != weights[kept]])
+
+        df = old_df
+        if len(added_tags) > 0:
+            added_df = self.resolve_analysis_df(TagWeightList(added_tags, weights[~kept]))
+            df = pd.concat([df, added_df], ignore_index=True)
+        df = df.iloc[pd.Index(df[PRIMARY_KEY]).get_indexer(tags)].reset_index(drop=True)
+        df['weight'] = weights.copy()
+        if positive:
+            self.positive_df = df
+        else:
+            self.negative_df = df
+
+        if table.horizontalHeader().sortIndicatorSection() < 0:
+            # In prompt order, replace the rows of the span
+            for row in reversed(range(head, head + len(old_span_tags))):
+                table.removeRow(row)
+            for row, tag in enumerate(span_tags, head):
+                table.insertRow(row)
+                table.setItem(row, 0, QTableWidgetItem(tag))
+            filled_tags = reweighted_tags.union(span_tags)
+        else:
+            # Sorted by a column, the new rows are placed by the sort
+            removed_tags = set(old_span_tags).difference(tags)
+            for row in reversed(range(table.rowCount())):
+                item = table.item(row, 0)
+                if item is not None and item.text() in removed_tags:
+                    table.removeRow(row)
+            for tag in added_tags:
+                row = table.rowCount()
+                table.insertRow(row)
+                table.setItem(row, 0, QTableWidgetItem(tag))
+            filled_tags = reweighted_tags.union(added_tags)
+        TagManager.update_table_widget_rows(
+            table, df, ANALYSIS_SHOW_COLUMNS, filled_tags, self.df_to_table_decorator)
+
+    def apply_search_filter(self, *args):
+        # The database tags are matched by the search index. The tags not in database are matched by the tag text.
+        text = self.search_edit.text().strip().lower()
+        matched_tags = set(self.tag_manager.search_tags(text)) if text != '' else set()
+        for table in [self.positive_table, self.negative_table]:
+            for row in range(table.rowCount()):
+                item = table.item(row, 0)
+                tag = item.text() if item is not None else ''
+                table.setRowHidden(row, text != '' and tag not in matched_tags and text not in tag.lower())
+
+    def do_adjust_weights(self, positive: bool, operation: callable):
+        # Adjust the weights of selected tags in one vectorised operation, then patch their rows only
+        table, df = (self.positive_table, self.positive_df) if positive else (self.negative_table, self.negative_df)
+        tags = set(table.get_selected_row_field_value(0))
+        mask = df[PRIMARY_KEY].isin(tags).values if not df.empty else []
+        if not np.any(mask):
+            return
+        weights = to_weight_array(df['weight'])
+        weights[mask] = operation(df[PRIMARY_KEY].values[mask], weights[mask])
+        df['weight'] = weights
+        self.prompts.set_tag_weights(positive, df[PRIMARY_KEY].values[mask], weights[mask])
+        TagManager.update_table_widget_rows(table, df, ANALYSIS_SHOW_COLUMNS, tags, self.df_to_table_decorator)
+
+    def on_database_changed(self, change_set: TagChangeSet):
+        # Only rebuild the tree if a path is added or removed
+        if self.tag_manager.get_path_tree_version() != self.tree_version:
+            self.update_tag_path_tree()
+
+        # Patch the rows of changed tags instead of rebuilding the analysis tables
+        changed_tags = change_set.changed_tags()
+        if self.patch_analysis_df(self.positive_df, changed_tags):
+            TagManager.update_table_widget_rows(
+                self.positive_table, self.positive_df, ANALYSIS_SHOW_COLUMNS, changed_tags, self.df_to_table_decorator)
+        if self.patch_analysis_df(self.negative_df, changed_tags):
+            TagManager.update_table_widget_rows(
+                self.negative_table, self.negative_df, ANALYSIS_SHOW_COLUMNS, changed_tags, self.df_to_table_decorator)
+
+    def patch_analysis_df(self, df: pd.DataFrame, changed_tags: set) -> bool:
+        # The tag and weight come from prompts. Other fields come from database.
+        positions = np.nonzero(df[PRIMARY_KEY].isin(changed_tags).values)[0] if not df.empty else []
+        if len(positions) == 0:
+            return False
+        tags = df[PRIMARY_KEY].values[positions]
+        rows = self.tag_manager.lookup_rows(tags)
+        row_positions = pd.Index(rows[PRIMARY_KEY].values).get_indexer(tags)
+        found = row_positions >= 0
+        for field in df.columns:
+            if field in [PRIMARY_KEY, 'weight']:
+                continue
+            values = np.full(len(tags), '', dtype=object)
+            if field in rows.columns:
+                values[found] = rows[field].to_numpy(dtype=object)[row_positions[found]]
+            set_dataframe_values(df, df.index[positions], field, values)
+        translate_df(df, PRIMARY_KEY, 'translate_cn', True, True)
+        return True
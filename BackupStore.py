@@ -0,0 +1,268 @@
+import os
+import sys
+import gzip
+import json
+import time
+import hashlib
+import tempfile
+import datetime
+
+
+class BackupStore:
+    """
+    A content-addressed backup store. Each version of a file is stored once as a gzip blob named by its sha256,
+    and a small json manifest indexes the backup points of each file by retention tier.
+    A backup is skipped if the content is the same as the latest backup of that file.
+
+    Retention tiers:
+        recent: The last N backup points.
+        hourly: The latest point of each hour for HOURLY_KEEP hours, fed by the points dropped from recent.
+        daily:  The latest point of each day for DAILY_KEEP days, fed by the points expired from hourly.
+    Each point moves through the tiers once, so the pruning cost of a backup is amortized O(1).
+
+    Layout:
+        backup_dir/objects/<sha256>.gz
+        backup_dir/manifest.json    {"files": {file_name: {tier: [point, ...]}}, "refs": {sha256: count}}
+    """
+
+    MANIFEST_NAME = 'manifest.json'
+    OBJECTS_NAME = 'objects'
+
+    TIERS = ['recent', 'hourly', 'daily']
+    HOURLY_KEEP = 24
+    DAILY_KEEP = 30
+
+    def __init__(self, backup_dir: str):
+        self.__backup_dir = backup_dir
+        self.__objects_dir = os.path.join(backup_dir, self.OBJECTS_NAME)
+        self.__manifest_file = os.path.join(backup_dir, self.MANIFEST_NAME)
+
+    def backup(self, file_name: str, backup_limit: int) -> bool:
+        """
+        Backup a file into the store.
+        :param file_name: The file to backup.
+        :param backup_limit: The number of points kept in the recent tier for this file.
+        :return: True if a new version is stored. False if the content is not changed.
+        """
+        with open(file_name, 'rb') as f:
+            data = f.read()
+        content_hash = hashlib.sha256(data).hexdigest()
+
+        manifest = self.load_manifest()
+        tiers = self.__file_tiers(manifest, file_name)
+        if len(tiers['recent']) > 0 and tiers['recent'][-1]['hash'] == content_hash:
+            return False
+
+        os.makedirs(self.__objects_dir, exist_ok=True)
+        object_file = self.__object_file(content_hash)
+        if not os.path.exists(object_file):
+            self.__write_atomic(object_file, gzip.compress(data))
+
+        now = time.time()
+        tiers['recent'].append({
+            'time': datetime.datetime.fromtimestamp(now).strftime('%Y%m%d%H%M%S_%f')[:-3],
+            'timestamp': now,
+            'hash': content_hash
+        })
+        manifest['refs'][content_hash] = manifest['refs'].get(content_hash, 0) + 1
+
+        self.__apply_retention(manifest, tiers, backup_limit, now)
+        self.save_manifest(manifest)
+        return True
+
+    def list_restore_points(self, file_name: str) -> [dict]:
+        """
+        List the available points in time of a file, from the oldest to the newest.
+        :param file_name: The backup file name.
+        :return: The list of point dict {'time', 'timestamp', 'hash', 'tier'}
+        """
+        tiers = self.__file_tiers(self.load_manifest(), file_name)
+        points = [dict(point, tier=tier) for tier in self.TIERS for point in tiers[tier]]
+        return sorted(points, key=lambda point: point['timestamp'])
+
+    def restore(self, file_name: str, point_time: str, target_file: str = '') -> bool:
+        """
+        Restore a file to a point in time. The current content of the target is backed up before overwritten.
+        :param file_name: The backup file name.
+        :param point_time: The 'time' of a point from list_restore_points().
+        :param target_file: The file to write. Use file_name if empty.
+        :return: True if restored. False if the point is not found.
+        """
+        points = [point for point in self.list_restore_points(file_name) if point['time'] == point_time]
+        if len(points) == 0:
+            return False
+        target_file = target_file if target_file else file_name
+        if os.path.exists(target_file):
+            self.backup(target_file, sys.maxsize)
+        self.__write_atomic(target_file, self.read_version(points[0]['hash']))
+        return True
+
+    def load_manifest(self) -> dict:
+        try:
+            with open(self.__manifest_file, 'rt', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            manifest = {}
+        if 'files' not in manifest:
+            manifest = BackupStore.__upgrade_manifest(manifest)
+        return manifest
+
+    def save_manifest(self, manifest: dict):
+        os.makedirs(self.__backup_dir, exist_ok=True)
+        self.__write_atomic(self.__manifest_file, json.dumps(manifest, indent=1).encode('utf-8'))
+
+    def read_version(self, content_hash: str) -> bytes:
+        with open(self.__object_file(content_hash), 'rb') as f:
+            return gzip.decompress(f.read())
+
+    # ------------------------------------------------------------------------------------------------------------------
+
+    def __apply_retention(self, manifest: dict, tiers: dict, backup_limit: int, now: float):
+        recent, hourly, daily = tiers['recent'], tiers['hourly'], tiers['daily']
+
+        while len(recent) > backup_limit:
+            self.__demote(manifest, hourly, recent.pop(0), '%Y%m%d%H')
+
+        while len(hourly) > 0 and hourly[0]['timestamp'] < now - self.HOURLY_KEEP * 3600:
+            self.__demote(manifest, daily, hourly.pop(0), '%Y%m%d')
+
+        while len(daily) > 0 and daily[0]['timestamp'] < now - self.DAILY_KEEP * 86400:
+            self.__release(manifest, daily.pop(0))
+
+    def __demote(self, manifest: dict, tier: list, point: dict, period_format: str):
+        # Keep the latest point of each period. The points come in time order.
+        period = datetime.datetime.fromtimestamp(point['timestamp']).strftime(period_format)
+        if len(tier) > 0 and \
+                datetime.datetime.fromtimestamp(tier[-1]['timestamp']).strftime(period_format) == period:
+            self.__release(manifest, tier.pop())
+        tier.append(point)
+
+    def __release(self, manifest: dict, point: dict):
+        content_hash = point['hash']
+        manifest['refs'][content_hash] = manifest['refs'].get(content_hash, 1) - 1
+        if manifest['refs'][content_hash] <= 0:
+            del manifest['refs'][content_hash]
+            try:
+                os.remove(self.__object_file(content_hash))
+            except FileNotFoundError:
+                pass
+
+    def __object_file(self, content_hash: str) -> str:
+        return os.path.join(self.__objects_dir, content_hash + '.gz')
+
+    def __file_tiers(self, manifest: dict, file_name: str) -> dict:
+        tiers = manifest['files'].setdefault(os.path.basename(file_name), {})
+        for tier in self.TIERS:
+            tiers.setdefault(tier, [])
+        return tiers
+
+    @staticmethod
+    def __upgrade_manifest(old_manifest: dict) -> dict:
+        # The old manifest is {file_name: [point, ...]} without tiers and reference counts.
+        manifest = {'files': {}, 'refs': {}}
+        for file_name, points in old_manifest.items():
+            for point in points:
+                if 'timestamp' not in point:
+                    point['timestamp'] = datetime.datetime.strptime(point['time'], '%Y%m%d%H%M%S_%f').timestamp()
+                manifest['refs'][point['hash']] = manifest['refs'].get(point['hash'], 0) + 1
+            manifest['files'][file_name] = {'recent': points, 'hourly': [], 'daily': []}
+        return manifest
+
+    @staticmethod
+    def __write_atomic(file_name: str, data: bytes):
+        fd, temp_file_name = tempfile.mkstemp(prefix=os.path.basename(file_name) + '.', suffix='.tmp',
+                                              dir=os.path.dirname(os.path.abspath(file_name)))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp_file_name, file_name)
+        except BaseException:
+            if os.path.exists(temp_file_name):
+                os.remove(temp_file_name)
+            raise
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+
+def test_backup_store():
+    work_dir = tempfile.mkdtemp()
+    store = BackupStore(os.path.join(work_dir, 'backup'))
+    file_a, file_b = os.path.join(work_dir, 'a.csv'), os.path.join(work_dir, 'b.csv')
+
+    def write(file_name: str, text: str):
+        with open(file_name, 'wt') as f:
+            f.write(text)
+
+    def content_hash(text: str) -> str:
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def objects() -> [str]:
+        return sorted(name[:-3] for name in os.listdir(os.path.join(work_dir, 'backup', BackupStore.OBJECTS_NAME)))
+
+    def tier_hashes(tier: str) -> [str]:
+        return [point['hash'] for point in store.load_manifest()['files']['a.csv'][tier]]
+
+    def set_timestamps(tier: str, timestamp: float):
+        manifest = store.load_manifest()
+        for point in manifest['files']['a.csv'][tier]:
+            point['timestamp'] = timestamp
+        store.save_manifest(manifest)
+
+    # Dedup: an unchanged file is not backed up again, and the same content is stored once
+    write(file_a, 'v1')
+    write(file_b, 'v1')
+    assert store.backup(file_a, 2) and not store.backup(file_a, 2) and store.backup(file_b, 2)
+    assert objects() == [content_hash('v1')] and store.load_manifest()['refs'][content_hash('v1')] == 2
+
+    # Over the limit, the points go to the hourly tier, which keeps the latest point of each hour
+    hour_start = (time.time() // 3600 - 2) * 3600
+    write(file_a, 'v2')
+    store.backup(file_a, 2)
+    set_timestamps('recent', hour_start + 60)
+    for version in ['v3', 'v4']:
+        write(file_a, version)
+        store.backup(file_a, 2)
+    assert tier_hashes('recent') == [content_hash('v3'), content_hash('v4')]
+    assert tier_hashes('hourly') == [content_hash('v2')]
+    # v1 is dropped from a.csv but still referenced by b.csv
+    assert content_hash('v1') in objects() and content_hash('v2') in objects()
+
+    # The hourly point expires to the daily tier, and the daily point expires at last
+    set_timestamps('hourly', time.time() - (BackupStore.HOURLY_KEEP + 1) * 3600)
+    write(file_a, 'v5')
+    store.backup(file_a, 2)
+    assert tier_hashes('daily') == [content_hash('v2')] and tier_hashes('hourly') == [content_hash('v3')]
+    set_timestamps('daily', time.time() - (BackupStore.DAILY_KEEP + 1) * 86400)
+    write(file_a, 'v6')
+    store.backup(file_a, 2)
+    assert tier_hashes('daily') == [] and content_hash('v2') not in objects()
+    assert store.list_restore_points(file_a)[-1]['hash'] == content_hash('v6')
+
+
+def main():
+    """
+    List or restore the backup points of a file.
+        python BackupStore.py list <file>
+        python BackupStore.py restore <file> <time>
+        python BackupStore.py test
+    """
+    if sys.argv[1:] == ['test']:
+        test_backup_store()
+        return
+    if len(sys.argv) < 3 or sys.argv[1] not in ['list', 'restore']:
+        print(main.__doc__)
+        return
+
+    file_name = sys.argv[2]
+    store = BackupStore(os.path.join(os.path.dirname(os.path.abspath(file_name)), 'backup'))
+    if sys.argv[1] == 'list':
+        for point in store.list_restore_points(file_name):
+            print('%s  %-6s  %s' % (point['time'], point['tier'], point['hash']))
+    elif len(sys.argv) > 3:
+        print('Restored.' if store.restore(file_name, sys.argv[3]) else 'Restore point not found.')
+    else:
+        print(main.__doc__)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,12 +7,12 @@ from PyQt5.QtCore import Qt, QDataStream
 from PyQt5.QtCore import QMimeData
 from PyQt5.QtWidgets import QApplication, QMainWindow, QTabWidget, QWidget, QVBoxLayout, QHBoxLayout, QPlainTextEdit, \
     QGroupBox, QTableWidget, QTableWidgetItem, QTreeWidget, QTreeWidgetItem, QAbstractItemView, QDialog, QPushButton, \
-    QDialogButtonBox, QCheckBox, QMessageBox, QMenu, QAction, QInputDialog
+    QDialogButtonBox, QCheckBox, QMessageBox, QMenu, QAction, QInputDialog, QListWidget, QListWidgetItem, QLineEdit
 
 from Prompts import Prompts
 from SaveTagsWindow import SavePromptsDialog
 from defines import ANALYSIS_README, PRESET_TAG_PATH, ANALYSIS_SHOW_COLUMNS, GENERATE_DISPLAY_FIELD, \
-    GENERATE_SHOW_COLUMNS, GENERATE_EDIT_FIELDS, GENERATE_EDIT_COLUMNS
+    GENERATE_SHOW_COLUMNS, GENERATE_EDIT_FIELDS, GENERATE_EDIT_COLUMNS, SEARCH_RESULT_LIMIT
 from df_utility import *
 from TagManager import *
 from app_utility import *
@@ -28,6 +28,10 @@ class GenerateWindow(QMainWindow):
         self.display_tag = pd.DataFrame(columns=GENERATE_DISPLAY_FIELD)
         self.includes_sub_path = False
         self.current_depot_file = ''
+        self.tree_version = -1
+        self.label_version = -1
+
+        self.tag_manager.register_database_observer(self)
 
         # Create the root layout as a horizontal layout
         root_layout = QHBoxLayout()
@@ -41,14 +45,14 @@ class GenerateWindow(QMainWindow):
 
         # ------------------------- Database Tree -------------------------
 
-        self.tree_db = DraggableTree(self.tag_manager.get_database(), self.on_edit_done, parent=self)
+        self.tree_db = DraggableTree(self.tag_manager, self.on_edit_done, parent=self)
         self.tree_db.setHeaderLabels(['Tag分类'])
         self.tree_db.setColumnCount(1)
         self.tree_db.itemClicked.connect(self.on_tree_click)
 
         # --------------------------- Depot Tree ---------------------------
 
-        self.tree_depot_browse = DraggableTree(self.tag_manager.get_database(), self.on_edit_done, parent=self)
+        self.tree_depot_browse = DraggableTree(self.tag_manager, self.on_edit_done, parent=self)
         self.tree_depot_browse.setHeaderLabels(['Tag分类'])
         self.tree_depot_browse.setColumnCount(1)
 
@@ -67,6 +71,19 @@ class GenerateWindow(QMainWindow):
         tag_collection_tab_layout.addWidget(self.tree_depot_browse)
         tag_collection_tab.setLayout(tag_collection_tab_layout)
 
+        # --------------------------- Label List ---------------------------
+
+        # The labels (收藏夹) of database. Double click to add all the tags of a label to the positive prompts.
+        self.label_list = QListWidget()
+        self.label_list.itemDoubleClicked.connect(lambda item: self.do_add_label_tags(item, True))
+        self.label_list.setContextMenuPolicy(Qt.CustomContextMenu)
+        self.label_list.customContextMenuRequested.connect(self.on_label_list_right_click)
+
+        tag_label_tab = QWidget()
+        tag_label_tab_layout = QVBoxLayout()
+        tag_label_tab_layout.addWidget(self.label_list)
+        tag_label_tab.setLayout(tag_label_tab_layout)
+
         # tag_free_input_tab = QWidget()
         # tag_free_input_tab_layout = QVBoxLayout()
         # tag_free_input_tab_layout.addWidget(self.tree_depot_browse)
@@ -76,6 +93,7 @@ class GenerateWindow(QMainWindow):
         tab_widget = QTabWidget()
         tab_widget.addTab(tag_database_tab, "Tag数据库")
         tab_widget.addTab(tag_collection_tab, "Tag收藏")
+        tab_widget.addTab(tag_label_tab, "收藏夹")
         # tab_widget.addTab(tag_free_input_tab, "自由输入")
         tab_widget.currentChanged.connect(self.on_tab_changed)
 
@@ -121,6 +139,13 @@ class GenerateWindow(QMainWindow):
         self.tag_table.setContextMenuPolicy(Qt.CustomContextMenu)
         self.tag_table.customContextMenuRequested.connect(self.on_tag_table_right_click)
 
+        # Search the tag, translation and comments of database. The result is shown in the tag table.
+        self.search_edit = QLineEdit()
+        self.search_edit.setPlaceholderText('搜索Tag / 翻译 / 备注')
+        self.search_edit.setClearButtonEnabled(True)
+        self.search_edit.textChanged.connect(self.on_search_text_changed)
+
+        group_tags_view_layout.addWidget(self.search_edit)
         group_tags_view_layout.addWidget(self.tag_table)
 
         # ------------------ The information group ------------------
@@ -208,6 +233,7 @@ class GenerateWindow(QMainWindow):
         # positive_view_layout.addWidget(self.positive_table)
 
         self.text_positive_prompts = PromptPlainTextEdit(True)
+        self.text_positive_prompts.set_tag_completion(self.tag_manager)
         positive_view_layout.addWidget(self.text_positive_prompts)
 
         positive_view.setLayout(positive_view_layout)
@@ -233,6 +259,7 @@ class GenerateWindow(QMainWindow):
         # negative_view_layout.addWidget(self.negative_table)
 
         self.text_negative_prompts = PromptPlainTextEdit(False)
+        self.text_negative_prompts.set_tag_completion(self.tag_manager)
         negative_view_layout.addWidget(self.text_negative_prompts)
 
         negative_view.setLayout(negative_view_layout)
@@ -254,30 +281,58 @@ class GenerateWindow(QMainWindow):
         self.refresh_depot_tree()
         self.refresh_ui()
 
-    # Callback Companionable.
-    def on_edit_done(self, _: pd.DataFrame = None, refresh_tree: bool = False):
-        self.tag_manager.inform_database_modified(None, True)
-        translated_df = self.display_tag[[PRIMARY_KEY, 'translate_cn']].copy()
-        self.display_tag = update_df_from_right_value(
-            self.display_tag, self.tag_manager.get_database(), PRIMARY_KEY)
-        self.display_tag = update_df_from_right_value_if_empty(self.display_tag, translated_df, PRIMARY_KEY)
+    # Callback Companionable. The UI is refreshed by on_database_changed().
+    def on_edit_done(self, new_df: pd.DataFrame = None):
+        self.tag_manager.inform_database_modified(new_df, True)
+
+    def on_database_changed(self, change_set: TagChangeSet):
+        changed_tags = change_set.changed_tags()
 
-        if refresh_tree:
+        # Only rebuild the tree if a path is added or removed
+        if self.tag_manager.get_path_tree_version() != self.tree_version:
             self.refresh_tree()
-        self.refresh_table()
+        if self.tag_manager.get_label_version() != self.label_version:
+            self.refresh_label_list()
+
+        # Patch the displayed rows of changed tags. Keep the displayed translation if it's not in database.
+        positions = np.nonzero(self.display_tag[PRIMARY_KEY].isin(changed_tags).values)[0] \
+            if not self.display_tag.empty else []
+        for position in positions:
+            row = self.tag_manager.get_row(self.display_tag.iat[position, self.display_tag.columns.get_loc(PRIMARY_KEY)])
+            if row is None:
+                continue
+            for field in self.display_tag.columns:
+                if field not in row.index or (field == 'translate_cn' and row[field] == ''):
+                    continue
+                set_dataframe_values(self.display_tag, self.display_tag.index[position], field, row[field])
+        if len(positions) > 0:
+            TagManager.update_table_widget_rows(self.tag_table, self.display_tag, GENERATE_SHOW_COLUMNS, changed_tags)
 
     def on_tree_click(self, item: QTreeWidgetItem):
-        df = self.tag_manager.get_database()
         full_path = self.tree_db.get_node_path(item)
 
-        # If includes_sub_path is true, filter df by 'path' value starts with full_path
-        # else filter df by 'path' value equals full_path
-        if self.includes_sub_path:
-            self.display_tag = df[df['path'].str.startswith(full_path)]
-        else:
-            self.display_tag = df[df['path'] == full_path]
-        self.display_tag = self.display_tag.reset_index(drop=True)
+        # Query the tags of the node (and its sub nodes if includes_sub_path) by the path index
+        tags = self.tag_manager.get_path_tags(full_path, self.includes_sub_path)
+        self.display_tag = self.tag_manager.select_rows(tags).reset_index(drop=True).copy()
+
+        self.refresh_table()
 
+    def on_search_text_changed(self, text: str):
+        text = text.strip()
+        if text == '':
+            # Back to the tags of the selected tree node
+            current_item = self.tree_db.currentItem()
+            if current_item is not None:
+                self.on_tree_click(current_item)
+            else:
+                self.display_tag = pd.DataFrame(columns=GENERATE_DISPLAY_FIELD)
+                self.refresh_table()
+            return
+        # A single ascii character matches too many tags
+        if len(text) == 1 and text.isascii():
+            return
+        tags = self.tag_manager.search_tags(text, SEARCH_RESULT_LIMIT)
+        self.display_tag = self.tag_manager.select_rows(tags).reset_index(drop=True).copy()
         self.refresh_table()
 
     def on_tag_table_double_click(self, row, column):
@@ -287,11 +342,9 @@ class GenerateWindow(QMainWindow):
             tag = self.tag_table.item(row, 0).text()
             selected_rows_df = self.display_tag[self.display_tag[PRIMARY_KEY] == tag]
             editor = DataFrameRowEditDialog(
-                self.tag_manager.get_database(), DATABASE_SUPPORT_FIELD, selected_rows_df, PRIMARY_KEY)
-            result = editor.exec_()
-
-            if result == QDialog.Accepted:
-                self.on_edit_done()
+                self.tag_manager, DATABASE_SUPPORT_FIELD, selected_rows_df, PRIMARY_KEY)
+            # The dialog commits the changes to tag manager
+            editor.exec_()
 
     def on_tag_table_right_click(self, position):
         # Create a menu
@@ -335,6 +388,22 @@ class GenerateWindow(QMainWindow):
         # Show the menu at the position of the right click
         menu.exec_(table.viewport().mapToGlobal(position))
 
+    def on_label_list_right_click(self, position):
+        item = self.label_list.itemAt(position)
+        if item is None:
+            return
+        menu = QMenu()
+
+        add_positive_action = QAction('添加到正向Tag', self)
+        add_positive_action.triggered.connect(lambda: self.do_add_label_tags(item, True))
+        menu.addAction(add_positive_action)
+
+        add_negative_action = QAction('添加到反向Tag', self)
+        add_negative_action.triggered.connect(lambda: self.do_add_label_tags(item, False))
+        menu.addAction(add_negative_action)
+
+        menu.exec_(self.label_list.viewport().mapToGlobal(position))
+
     def on_tab_changed(self, index):
         if index == 1:
             self.refresh_tree()
@@ -346,10 +415,20 @@ class GenerateWindow(QMainWindow):
 
     def refresh_ui(self):
         self.refresh_tree()
+        self.refresh_label_list()
         self.refresh_table()
 
     def refresh_tree(self):
-        TagManager.update_tag_path_tree(self.tree_db, self.tag_manager.get_database(), PRESET_TAG_PATH)
+        self.tree_version = self.tag_manager.get_path_tree_version()
+        TagManager.update_tag_path_tree(self.tree_db, self.tag_manager.get_paths(), PRESET_TAG_PATH)
+
+    def refresh_label_list(self):
+        self.label_version = self.tag_manager.get_label_version()
+        self.label_list.clear()
+        for label in self.tag_manager.get_labels():
+            item = QListWidgetItem('%s (%d)' % (label, self.tag_manager.count_label_tags(label)))
+            item.setData(Qt.UserRole, label)
+            self.label_list.addItem(item)
 
     def refresh_table(self):
         TagManager.dataframe_to_table_widget(self.tag_table, self.display_tag, GENERATE_SHOW_COLUMNS, [])
@@ -365,8 +444,6 @@ class GenerateWindow(QMainWindow):
             self.refresh_table()
 
     def save_translation_action(self):
-        tag_database = self.tag_manager.get_database()
-
         # Get the selected tags
         selected_tags = self.tag_table.get_selected_row_field_value(0)
 
@@ -374,18 +451,23 @@ class GenerateWindow(QMainWindow):
         selected_df = self.display_tag.loc[self.display_tag[PRIMARY_KEY].isin(selected_tags)]
 
         if not selected_df.empty:
-            new_df = update_df_from_right_value(tag_database, selected_df, PRIMARY_KEY, ['translate_cn'])
-            new_df = new_df.reset_index(drop=True)
-
-            self.tag_manager.inform_database_modified(new_df, True)
+            with self.tag_manager.edit_session() as session:
+                for tag, translation in zip(selected_df[PRIMARY_KEY], selected_df['translate_cn']):
+                    if self.tag_manager.has_tag(tag):
+                        session.set_property(tag, 'translate_cn', translation)
 
             QMessageBox.information(self, '保存结果', '保存完成。')
-
-            # Refresh the table to display the updated data
-            self.refresh_table()
         else:
             QMessageBox.information(self, '提示', '没有选择任何项目。')
 
+    def do_add_label_tags(self, item: QListWidgetItem, positive: bool):
+        # Add the whole label in one merge, with the default weight of each tag
+        label_df = self.tag_manager.select_rows(self.tag_manager.get_label_tags(item.data(Qt.UserRole)))
+        tag_data = [{PRIMARY_KEY: tag, 'weight': weight}
+                    for tag, weight in zip(label_df[PRIMARY_KEY], label_df['weight'])]
+        prompt_edit = self.text_positive_prompts if positive else self.text_negative_prompts
+        prompt_edit.on_accept_tag_data(tag_data)
+
     def do_set_shuffle(self, table: TagEditTableWidget):
         text, ok = QInputDialog.getText(self, '抽签分组', '请输入抽签分组名')
         if ok and text and text.strip():
@@ -408,7 +490,9 @@ class GenerateWindow(QMainWindow):
 
     def do_save(self):
         prompt = Prompts()
-        prompt.from_text(self.text_positive_prompts.toPlainText() + '\n\n' + self.text_negative_prompts.toPlainText())
+        # A saved prompt is a usage of its tags
+        prompt.from_text(self.text_positive_prompts.toPlainText() + '\n\n' + self.text_negative_prompts.toPlainText(),
+                         self.tag_manager.get_tag_statistics())
         # prompt.positive_tag_data_dict = self.positive_table.table_editing_data[[PRIMARY_KEY, 'weight']].to_dict('records')
         # prompt.positive_tag_data_dict = self.negative_table.table_editing_data[[PRIMARY_KEY, 'weight']].to_dict('records')
         dlg = SavePromptsDialog(prompt)
@@ -479,9 +563,9 @@ class GenerateWindow(QMainWindow):
 
                 prompt = Prompts()
                 if prompt.from_text(file_data):
-                    df = self.tag_manager.get_database()
-                    self.display_tag = pd.DataFrame(prompt.positive_tag_data_dict)
-                    self.display_tag = merge_df_keeping_left_value(self.display_tag, df, PRIMARY_KEY)
+                    self.display_tag = prompt.positive_tag_weights.to_dataframe(PRIMARY_KEY, 'weight')
+                    self.display_tag = merge_df_keeping_left_value(
+                        self.display_tag, self.tag_manager.lookup_rows(self.display_tag[PRIMARY_KEY]), PRIMARY_KEY)
                     translate_df(self.display_tag, PRIMARY_KEY, 'translate_cn', True, True)
                     self.refresh_table()
                     self.text_information.setPlainText(prompt.extra_data_string)
@@ -0,0 +1,448 @@
+import re
+import time
+import traceback
+
+
+# The attention multipliers. {} is the NovelAI style emphasis, which is kept for the old prompts.
+# [] is 0.9 as the weight calculation of this app, instead of 1 / 1.1 of A1111 webui.
+ATTENTION_INC_BASE = 1.1
+ATTENTION_DEC_BASE = 0.9
+
+BRACKET_PAIRS = {'(': ')', '[': ']', '{': '}'}
+CLOSE_BRACKETS = {close: bracket for bracket, close in BRACKET_PAIRS.items()}
+ESCAPE_CHARS = re.compile(r'([\\()\[\]{}])')
+
+# One pass of the prompt text. Each alternative is a token kind, the text runs are matched greedily.
+TOKEN_PATTERN = re.compile(r"""
+    \\(?P<escape>[\\()\[\]{}])
+  | (?P<network><\w+:[^<>\n]*>)
+  | (?P<open>[(\[{])
+  | (?P<close>[)\]}])
+  | (?P<colon>:)
+  | (?P<bar>\|)
+  | (?P<separator>[,\n])
+  | (?P<text>[^\\()\[\]{}<:|,\n]+|[\\<])
+""", re.VERBOSE)
+
+BREAK_PATTERN = re.compile(r'\bBREAK\b')
+NUMBER = r'[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?'
+NUMBER_PATTERN = re.compile(r'\s*' + NUMBER + r'\s*$')
+# The 'tag:1.2' without brackets, which is accepted by the old parser
+COLON_WEIGHT_PATTERN = re.compile(r'^(.*?)\s*:\s*(' + NUMBER + ')$', re.DOTALL)
+
+
+class PromptText:
+    """
+    The text is unescaped. The raw is how it's written in prompt, e.g. a lone '\\' or an unmatched ')'.
+    """
+    __slots__ = ['text', 'raw']
+
+    def __init__(self, text: str, raw: str = None):
+        self.text = text
+        self.raw = escape_prompt_text(text) if raw is None else raw
+
+    def to_text(self) -> str:
+        return self.raw
+
+
+class PromptSeparator:
+    __slots__ = ['text']
+
+    def __init__(self, text: str):
+        self.text = text
+
+    def to_text(self) -> str:
+        return self.text
+
+
+class PromptBreak:
+    __slots__ = []
+
+    def to_text(self) -> str:
+        return 'BREAK'
+
+
+class PromptNetwork:
+    """
+    The extra network like <lora:name:0.8>. The tag is 'lora:name'.
+    """
+    __slots__ = ['text']
+
+    def __init__(self, text: str):
+        self.text = text
+
+    def tag_weight(self) -> (str, float):
+        parts = self.text.split(':')
+        weight = parse_number(parts[2]) if len(parts) > 2 else None
+        return ':'.join(parts[:2]).strip(), 1.0 if weight is None else weight
+
+    def to_text(self) -> str:
+        return '<' + self.text + '>'
+
+
+class PromptAttention:
+    """
+    (text), [text], {text} and (text:weight). The weight of the text is multiplied by multiplier().
+    An unclosed bracket weights the text until the end, and it's written back without the closing bracket.
+    """
+    __slots__ = ['bracket', 'children', 'weight_text', 'closed']
+
+    def __init__(self, bracket: str, children: list, weight_text: str = '', closed: bool = True):
+        self.bracket = bracket
+        self.children = children
+        self.weight_text = weight_text
+        self.closed = closed
+
+    def multiplier(self) -> float:
+        if self.weight_text != '':
+            return float(self.weight_text)
+        return ATTENTION_DEC_BASE if self.bracket == '[' else ATTENTION_INC_BASE
+
+    def text_parts(self) -> list:
+        weight = ':' + self.weight_text if self.weight_text != '' else ''
+        close = BRACKET_PAIRS[self.bracket] if self.closed else ''
+        return [self.bracket, self.children, weight + close]
+
+    def to_text(self) -> str:
+        return nodes_to_text([self])
+
+
+class PromptSchedule:
+    """
+    [from:to:step], [to:step] and [from::step]. from_children is None for the [to:step] form.
+    """
+    __slots__ = ['from_children', 'to_children', 'step_text']
+
+    def __init__(self, from_children: list or None, to_children: list, step_text: str):
+        self.from_children = from_children
+        self.to_children = to_children
+        self.step_text = step_text
+
+    def text_parts(self) -> list:
+        from_parts = [self.from_children, ':'] if self.from_children is not None else []
+        return ['['] + from_parts + [self.to_children, ':' + self.step_text + ']']
+
+    def to_text(self) -> str:
+        return nodes_to_text([self])
+
+
+class PromptAlternate:
+    """
+    [a|b|c], which switches the options at each step.
+    """
+    __slots__ = ['options']
+
+    def __init__(self, options: list):
+        self.options = options
+
+    def text_parts(self) -> list:
+        parts = ['[']
+        for index, option in enumerate(self.options):
+            parts += [option] if index == 0 else ['|', option]
+        return parts + [']']
+
+    def to_text(self) -> str:
+        return nodes_to_text([self])
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+
+def escape_prompt_text(text: str) -> str:
+    """
+    Escape the brackets of a tag like 'ganyu (genshin impact)' so that it's not parsed as weight.
+    """
+    return ESCAPE_CHARS.sub(r'\\\1', text)
+
+
+def parse_number(text: str) -> float or None:
+    return float(text) if NUMBER_PATTERN.match(text) else None
+
+
+def nodes_to_text(nodes: list) -> str:
+    """
+    Write the nodes back to prompt text. The brackets are expanded by text_parts(), which are strings and
+    node lists. It's iterative as prompt_tag_weights(), so the deep nested brackets don't exceed the recursion limit.
+    """
+    texts = []
+    stack = [iter(nodes)]
+    while len(stack) > 0:
+        item = next(stack[-1], None)
+        if item is None:
+            stack.pop()
+        elif isinstance(item, str):
+            texts.append(item)
+        elif isinstance(item, list):
+            stack.append(iter(item))
+        elif hasattr(item, 'text_parts'):
+            stack.append(iter(item.text_parts()))
+        else:
+            texts.append(item.to_text())
+    return ''.join(texts)
+
+
+def append_text(nodes: list, text: str, raw: str = None):
+    # Merge the adjacent text so that a tag is always one node
+    if len(nodes) > 0 and isinstance(nodes[-1], PromptText):
+        nodes[-1].text += text
+        nodes[-1].raw += escape_prompt_text(text) if raw is None else raw
+    else:
+        nodes.append(PromptText(text, raw))
+
+
+def join_nodes(parts: [list], delimiter: str) -> list:
+    """
+    Join the parts split by ':' or '|' back with the delimiter as text.
+    """
+    nodes = []
+    for index, part in enumerate(parts):
+        if index > 0:
+            append_text(nodes, delimiter)
+        for node in part:
+            if isinstance(node, PromptText):
+                append_text(nodes, node.text, node.raw)
+            else:
+                nodes.append(node)
+    return nodes
+
+
+def part_number(part: list) -> str or None:
+    # The weight or step must be the only text of its part
+    if len(part) == 1 and isinstance(part[0], PromptText) and NUMBER_PATTERN.match(part[0].text):
+        return part[0].text
+    return None
+
+
+class PromptFrame:
+    """
+    An open bracket being parsed. The nodes are collected by the '|' options and the ':' parts of each option.
+    """
+    __slots__ = ['bracket', 'options']
+
+    def __init__(self, bracket: str):
+        self.bracket = bracket
+        self.options = [[[]]]
+
+    def nodes(self) -> list:
+        return self.options[-1][-1]
+
+    def close(self, closed: bool = True):
+        if not closed:
+            # The ':' and '|' are text in an unclosed bracket
+            options = [join_nodes(parts, ':') for parts in self.options]
+            return PromptAttention(self.bracket, join_nodes(options, '|'), closed=False)
+        if self.bracket == '[' and len(self.options) > 1:
+            return PromptAlternate([join_nodes(parts, ':') for parts in self.options])
+
+        # '|' is a text out of [], keep the ':' parts around it
+        parts = list(self.options[0])
+        for option in self.options[1:]:
+            parts[-1] = join_nodes([parts[-1], option[0]], '|')
+            parts.extend(option[1:])
+        number = part_number(parts[-1]) if len(parts) > 1 else None
+
+        if self.bracket == '[' and number is not None and len(parts) in [2, 3]:
+            if len(parts) == 2:
+                return PromptSchedule(None, parts[0], number)
+            return PromptSchedule(parts[0], parts[1], number)
+        if self.bracket != '[' and number is not None:
+            return PromptAttention(self.bracket, join_nodes(parts[:-1], ':'), number)
+        return PromptAttention(self.bracket, join_nodes(parts, ':'))
+
+
+def parse_prompt(text: str) -> list:
+    """
+    Parse a prompt of A1111 webui grammar to a list of nodes in one pass.
+    The unmatched closing brackets are kept as text without tag, and the unclosed brackets weight until the end.
+    :param text: The prompt text, positive or negative part.
+    :return: The nodes. Use nodes_to_text() to convert them back.
+    """
+    root = PromptFrame('')
+    stack = [root]
+    # The count of open frames of each bracket, so a close bracket is matched without scanning the stack
+    open_counts = dict.fromkeys(BRACKET_PAIRS, 0)
+    for match in TOKEN_PATTERN.finditer(text):
+        kind = match.lastgroup
+        frame = stack[-1]
+        if kind == 'text':
+            token = match.group()
+            if 'BREAK' in token:
+                for index, piece in enumerate(BREAK_PATTERN.split(token)):
+                    if index > 0:
+                        frame.nodes().append(PromptBreak())
+                    if piece != '':
+                        append_text(frame.nodes(), piece, piece)
+            else:
+                append_text(frame.nodes(), token, token)
+        elif kind == 'separator':
+            frame.nodes().append(PromptSeparator(match.group()))
+        elif kind == 'escape':
+            append_text(frame.nodes(), match.group('escape'), match.group())
+        elif kind == 'open':
+            stack.append(PromptFrame(match.group()))
+            open_counts[match.group()] += 1
+        elif kind == 'close':
+            bracket = match.group()
+            if open_counts[CLOSE_BRACKETS[bracket]] > 0:
+                # Close the inner brackets that are not closed, until the matched one
+                while True:
+                    frame = stack.pop()
+                    open_counts[frame.bracket] -= 1
+                    matched = BRACKET_PAIRS[frame.bracket] == bracket
+                    stack[-1].nodes().append(frame.close(matched))
+                    if matched:
+                        break
+            else:
+                append_text(frame.nodes(), '', bracket)
+        elif kind == 'colon':
+            if frame is root:
+                append_text(frame.nodes(), ':', ':')
+            else:
+                frame.options[-1].append([])
+        elif kind == 'bar':
+            if frame is root:
+                append_text(frame.nodes(), '|', '|')
+            else:
+                frame.options.append([[]])
+        elif kind == 'network':
+            frame.nodes().append(PromptNetwork(match.group()[1:-1]))
+    while len(stack) > 1:
+        frame = stack.pop()
+        stack[-1].nodes().append(frame.close(False))
+    return root.nodes()
+
+
+def prompt_fragments(nodes: list) -> [list]:
+    """
+    Split the nodes by the top level ',', new line and BREAK.
+    """
+    fragments = [[]]
+    for node in nodes:
+        if isinstance(node, (PromptSeparator, PromptBreak)):
+            fragments.append([])
+        else:
+            fragments[-1].append(node)
+    return [fragment for fragment in fragments if len(fragment) > 0]
+
+
+def prompt_tag_weights(nodes: list, weight: float = 1.0) -> [(str, float)]:
+    """
+    Get the tags and their effective weights. A text between the separators and brackets is a tag.
+    The tags in schedule and alternation are all listed with the weight outside.
+    """
+    tag_weights = []
+    # Each level is iterated with its own stack, so the deep nested brackets don't exceed the recursion limit
+    stack = [(iter(nodes), weight)]
+    while len(stack) > 0:
+        node = next(stack[-1][0], None)
+        if node is None:
+            stack.pop()
+            continue
+        weight = stack[-1][1]
+        if isinstance(node, PromptText):
+            tag, tag_weight = text_tag_weight(node.text)
+            if tag != '':
+                tag_weights.append((tag, weight * tag_weight))
+        elif isinstance(node, PromptNetwork):
+            tag, tag_weight = node.tag_weight()
+            if tag != '':
+                tag_weights.append((tag, tag_weight))
+        elif isinstance(node, PromptAttention):
+            stack.append((iter(node.children), weight * node.multiplier()))
+        elif isinstance(node, PromptSchedule):
+            stack.append((iter((node.from_children or []) + node.to_children), weight))
+        elif isinstance(node, PromptAlternate):
+            stack.append((iter([child for option in node.options for child in option]), weight))
+    return tag_weights
+
+
+def text_tag_weight(text: str) -> (str, float):
+    text = text.strip()
+    if ':' in text:
+        match = COLON_WEIGHT_PATTERN.match(text)
+        if match is not None:
+            return match.group(1).strip(), float(match.group(2))
+    return text, 1.0
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+
+def test_parse_prompt_weights():
+    def weights(text: str) -> dict:
+        return {tag: round(weight, 4) for tag, weight in prompt_tag_weights(parse_prompt(text))}
+
+    assert weights('a, (b), ((c)), [d], {e}') == {'a': 1.0, 'b': 1.1, 'c': 1.21, 'd': 0.9, 'e': 1.1}
+    assert weights('(a, b: 1.2), c') == {'a': 1.2, 'b': 1.2, 'c': 1.0}
+    assert weights('((a:1.2), b)') == {'a': 1.32, 'b': 1.1}
+    assert weights(r'ganyu \(genshin impact\), (nahida \(genshin impact\):1.3)') == \
+        {'ganyu (genshin impact)': 1.0, 'nahida (genshin impact)': 1.3}
+    assert weights('[cat:dog:0.5], [hat:10], [tree::0.3], ([red|blue] eyes:1.2)') == \
+        {'cat': 1.0, 'dog': 1.0, 'hat': 1.0, 'tree': 1.0, 'red': 1.2, 'blue': 1.2, 'eyes': 1.2}
+    assert weights('(a BREAK b:0.5) BREAK c') == {'a': 0.5, 'b': 0.5, 'c': 1.0}
+    assert weights('<lora:add_detail:0.8>, <lora:x>, tag:1.3, (a:b)') == \
+        {'lora:add_detail': 0.8, 'lora:x': 1.0, 'tag': 1.3, 'a:b': 1.1}
+    assert weights('a), ((b, [c') == {'a': 1.0, 'b': 1.21, 'c': round(1.21 * 0.9, 4)}
+    assert weights('<lora:a,b:0.5>, (a:1e2), (b:2.5E-1), c:1e1') == {'lora:a,b': 0.5, 'a': 100.0, 'b': 0.25, 'c': 10.0}
+    assert weights('a < b, c > d') == {'a < b': 1.0, 'c > d': 1.0}
+
+
+def test_prompt_round_trip():
+    texts = [
+        'masterpiece, (best quality:1.2), ((a:1.2), b), [c], {d}',
+        r'ganyu \(genshin impact\), \[x\], back\\slash',
+        '[cat:dog:0.5], [hat:10], [tree::0.3], [red|blue|green] eyes',
+        '(a, b: 1.2) BREAK c\nlowres, <lora:add_detail:0.8>, x:y|z',
+        # A lone backslash, unbalanced brackets, a network with ',' and the exponent weight
+        'back\\slash, a\\, \\',
+        'a), ((b, [c', '(a', '[(a:1.2]', '[a|b:c', 'x]',
+        '<lora:a,b:0.5>, <lora:a,b>',
+        '(a:1e2), (b:2.5E-1)',
+    ]
+    for text in texts:
+        nodes = parse_prompt(text)
+        assert nodes_to_text(nodes) == text, nodes_to_text(nodes)
+
+    # Deep nesting is parsed and written back without recursion
+    depth = 5000
+    for text in ['(' * depth + 'a' + ')' * depth, '[' * depth + 'a:b|c' + ']' * depth, '(' * depth + 'a']:
+        nodes = parse_prompt(text)
+        assert nodes_to_text(nodes) == text
+        assert prompt_tag_weights(nodes)[0][0] in ['a', 'a:b']
+
+
+def test_parse_prompt_linear_time():
+    # The close brackets are matched without scanning the open brackets
+    for text in ['(' * 20000 + ']' * 20000, '(' * 20000 + ')' * 20000, '[(' * 10000 + ')]' * 10000]:
+        start = time.perf_counter()
+        assert nodes_to_text(parse_prompt(text)) == text
+        assert time.perf_counter() - start < 1.0, text[:10]
+
+
+def benchmark_parse_prompt():
+    fragment = r'masterpiece, (best quality:1.2), ((detailed eyes:1.1), smile), [cat:dog:0.5], [red|blue] hair, ' \
+               r'ganyu \(genshin impact\), <lora:add_detail:0.8>, {{cinematic lighting}} BREAK '
+    text = fragment * (8 * 1024 // len(fragment) + 1)
+    loop = 200
+    start = time.perf_counter()
+    for _ in range(loop):
+        prompt_tag_weights(parse_prompt(text))
+    elapsed = time.perf_counter() - start
+    print('Parse %d bytes prompt: %.3f ms each, %.2f MB/s' %
+          (len(text), elapsed * 1000 / loop, len(text) * loop / elapsed / 1024 / 1024))
+
+
+def main():
+    test_parse_prompt_weights()
+    test_prompt_round_trip()
+    test_parse_prompt_linear_time()
+    benchmark_parse_prompt()
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception as e:
+        print('Error =>', e)
+        print('Error =>', traceback.format_exc())
+        exit()
+    finally:
+        pass
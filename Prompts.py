@@ -1,52 +1,60 @@
+import numpy as np
 import pandas as pd
 
 from TagManager import DATABASE_FIELDS, PRIMARY_KEY
+from TagWeightList import TagWeightList
+from PromptParser import parse_prompt, prompt_fragments, prompt_tag_weights, nodes_to_text, escape_prompt_text, \
+    ATTENTION_INC_BASE, ATTENTION_DEC_BASE
 from app_utility import *
 
-SPECIAL_KEYWORDS = ['BREAK']
-
-WEIGHT_INC_BASE = 1.1
-WEIGHT_DEC_BASE = 0.9
+WEIGHT_INC_BASE = ATTENTION_INC_BASE
+WEIGHT_DEC_BASE = ATTENTION_DEC_BASE
 
 
 def try_float(text: str, on_fail: float or None = None) -> float or None:
     try:
         return float(text)
-    except ValueError:
+    except (TypeError, ValueError):
         return on_fail
     finally:
         pass
 
 
-def parse_wrapper(tag: str, left: str, right: str, base: float) -> (str, float):
-    tag = tag.strip()
-    if tag.startswith(left):  # and tag.endswith(right):
-        n = tag.count(left)
-        weight = base ** n
-    else:
-        weight = 1.0
-    return tag.replace(left, '').replace(right, ''), weight
+def to_weight_array(values) -> np.ndarray:
+    """
+    Convert the weights of any form (float, number text, '' or None) to a float array. The invalid ones are 1.0.
+    """
+    weights = pd.to_numeric(pd.Series(list(values), dtype=object), errors='coerce').to_numpy(dtype=np.float64)
+    weights[np.isnan(weights)] = 1.0
+    return weights
+
+
+def scale_weights(weights: np.ndarray, factor: float) -> np.ndarray:
+    return weights * factor
+
 
+def clamp_weights(weights: np.ndarray, lower: float, upper: float) -> np.ndarray:
+    return np.clip(weights, min(lower, upper), max(lower, upper))
 
-def parse_tag_colon_weight(tag: str) -> (str, float):
-    if ':' in tag:
-        parts = tag.split(':')
-        weight = try_float(parts[1])
-        return parts[0], (weight if weight else 1.0)
-    else:
-        return tag, 1.0
+
+def normalize_weights(weights: np.ndarray, mean: float) -> np.ndarray:
+    """
+    Scale the weights so that their mean is the target mean. The ratio between the weights is kept.
+    """
+    current_mean = weights.mean() if len(weights) > 0 else 0.0
+    return weights * (mean / current_mean) if current_mean > 0 else weights.copy()
 
 
 class Prompts:
     def __init__(self):
-        self.positive_tag_data_dict = {PRIMARY_KEY: [], 'weight': []}
-        self.negative_tag_data_dict = {PRIMARY_KEY: [], 'weight': []}
+        self.positive_tag_weights = TagWeightList()
+        self.negative_tag_weights = TagWeightList()
         self.extra_data_string = ''
         self.raw_prompts = ''
 
-    def from_text(self, text: str) -> bool:
+    def from_text(self, text: str, statistics=None, source: str = '') -> bool:
         self.raw_prompts = text
-        return self.parse_prompt_text(text)
+        return self.parse_prompt_text(text, statistics, source)
 
     def from_file(self, file_name: str) -> bool:
         try:
@@ -60,14 +68,13 @@ class Prompts:
 
     def from_record(self, record: [dict], positive: bool) -> bool:
         try:
-            tag_data_dict = {
-                PRIMARY_KEY: [r[PRIMARY_KEY] for r in record],
-                'weight': [r['weight'] for r in record]
-            }
+            # The weight of dragged rows is the text of table. Convert once here.
+            tag_weights = TagWeightList([r[PRIMARY_KEY] for r in record],
+                                        to_weight_array([r.get('weight', '') for r in record]))
             if positive:
-                self.positive_tag_data_dict = tag_data_dict
+                self.positive_tag_weights = tag_weights
             else:
-                self.negative_tag_data_dict = tag_data_dict
+                self.negative_tag_weights = tag_weights
             return True
         except Exception as e:
             print(e)
@@ -76,32 +83,51 @@ class Prompts:
             pass
 
     def merge(self, other_prompts):
-        Prompts.merge_tag_data_dict(self.positive_tag_data_dict, other_prompts.positive_tag_data_dict)
-        Prompts.merge_tag_data_dict(self.negative_tag_data_dict, other_prompts.negative_tag_data_dict)
+        Prompts.merge_tag_weights(self.positive_tag_weights, other_prompts.positive_tag_weights)
+        Prompts.merge_tag_weights(self.negative_tag_weights, other_prompts.negative_tag_weights)
         # self.extra_data_string += other_prompts.extra_data_string
 
-    def parse_prompt_text(self, text: str):
-        positive_tags, negative_tags, self.extra_data_string = Prompts.parse_prompts(text)
-        self.positive_tag_data_dict = Prompts.tags_list_to_tag_data(unique_list(positive_tags))
-        self.negative_tag_data_dict = Prompts.tags_list_to_tag_data(unique_list(negative_tags))
+    def parse_prompt_text(self, text: str, statistics=None, source: str = ''):
+        """
+        :param text: The prompt text.
+        :param statistics: The TagStatistics to count the tags of this prompt. None to not count.
+        :param source: If not empty, the tags are reported as the current prompt of this source,
+                       which is counted once at the next flush. Else the tags are counted immediately.
+        """
+        positive_text, negative_text, self.extra_data_string = Prompts.split_prompt_sections(text)
+        self.positive_tag_weights = Prompts.parse_tag_weights(positive_text)
+        self.negative_tag_weights = Prompts.parse_tag_weights(negative_text)
+        if statistics is not None:
+            tags = self.positive_tag_weights.tags() + self.negative_tag_weights.tags()
+            if source != '':
+                statistics.set_source_tags(source, tags)
+            else:
+                statistics.count(tags)
         return True
 
+    def set_tag_weights(self, positive: bool, tags: [str], weights: [float]):
+        """
+        Set the weights of the tags in prompts. The tags not in prompts are ignored.
+        """
+        (self.positive_tag_weights if positive else self.negative_tag_weights).set_weights(tags, weights)
+
     def positive_tag_string(self, includes_weight: bool) -> str:
-        return Prompts.tag_data_dict_to_string(self.positive_tag_data_dict, includes_weight)
+        return Prompts.tag_weights_to_string(self.positive_tag_weights, includes_weight)
 
     def negative_tag_string(self, includes_weight: bool) -> str:
-        return Prompts.tag_data_dict_to_string(self.negative_tag_data_dict, includes_weight)
+        return Prompts.tag_weights_to_string(self.negative_tag_weights, includes_weight)
 
     def re_format_extra_string(self) -> str:
         extra_data = self.parse_extra_info(self.extra_data_string)
         return '\n'.join([f"{key}: {value}" for key, value in extra_data.items()])
 
     @staticmethod
-    def tag_data_dict_to_string(tag_data_dict: dict, includes_weight: bool) -> str:
-        tags_with_weight = [('(%s:%s)' % (t, round(try_float(w, 1.0), 2))
-                             if includes_weight and (w != '') and (try_float(w, 1.0) - 1 > 0.001) else t)
-                            for t, w in zip(tag_data_dict[PRIMARY_KEY],
-                                            tag_data_dict['weight'])]
+    def tag_weights_to_string(tag_weights: TagWeightList, includes_weight: bool) -> str:
+        # The weights are numbers. Format them only here.
+        # The weights below 1 are written too, so that the decreased weights are kept.
+        tags = [escape_prompt_text(tag) for tag in tag_weights.tags()]
+        tags_with_weight = [('(%s:%s)' % (t, round(w, 2)) if includes_weight and abs(w - 1.0) > 0.001 else t)
+                            for t, w in zip(tags, tag_weights.weights().tolist())]
         return ', '.join(tags_with_weight)
 
     @staticmethod
@@ -123,136 +149,96 @@ class Prompts:
         return extra_info
 
     @staticmethod
-    def parse_prompts(prompt_text: str):
-        prompt_text = prompt_text.strip()
-        lines = prompt_text.split('\n')
-        lines = [line for line in lines if line.strip() != '']
+    def split_prompt_sections(prompt_text: str) -> (str, str, str):
+        """
+        Split the prompt text to the positive, negative and extra data text.
+        The negative part starts with 'Negative prompt:'.
+        Without it, the first line is positive and the second line is negative.
+        """
+        lines = [line for line in prompt_text.strip().split('\n') if line.strip() != '']
         prompt_text = '\n'.join(lines)
+        lower_text = prompt_text.lower()
 
-        positive_start = prompt_text.lower().find('positive prompt')
+        positive_start = lower_text.find('positive prompt')
         if positive_start != -1:
             positive_start += len('positive prompt')
-            positive_start = prompt_text.find(':', positive_start) + 1
+            positive_start = prompt_text.find(':', positive_start) + 1 or positive_start
         else:
             positive_start = 0
 
-        negative_start = prompt_text.lower().find('negative prompt')
+        negative_start = lower_text.find('negative prompt')
         if negative_start != -1:
             positive_end = negative_start
             negative_start += len('negative prompt')
-            negative_start = prompt_text.find(':', negative_start) + 1
+            negative_start = prompt_text.find(':', negative_start) + 1 or negative_start
             negative_end = prompt_text.find('\n', negative_start)
         else:
-            first_line_end = prompt_text.find('\n')
-            second_line_end = prompt_text.find('\n', first_line_end + 1)
-            positive_end = first_line_end if first_line_end > 0 else len(prompt_text)
-
+            positive_end = prompt_text.find('\n')
+            positive_end = positive_end if positive_end != -1 else len(prompt_text)
             negative_start = positive_end
-            negative_end = second_line_end if second_line_end > 0 else len(prompt_text)
-
-        positive_tags_string = prompt_text[positive_start:positive_end].strip()
-        negative_tags_string = prompt_text[negative_start:negative_end].strip()
-        for keyword in SPECIAL_KEYWORDS:
-            positive_tags_string = positive_tags_string.replace(keyword, ',')
-            negative_tags_string = negative_tags_string.replace(keyword, ',')
-        extra_data_string = prompt_text[negative_end + 1:].strip() if negative_end > 0 else ''
-
-        # print('Positive tags:', positive_tags_string)
-        # print('Negative tags:', negative_tags_string)
-        # print('Extra data:', extra_data_string)
-
-        positive_tags_raw = positive_tags_string.replace('\n', ',').split(',')
-        negative_tags_raw = negative_tags_string.replace('\n', ',').split(',')
+            negative_end = prompt_text.find('\n', positive_end + 1) if positive_end < len(prompt_text) else -1
+        negative_end = negative_end if negative_end != -1 else len(prompt_text)
 
-        positive_tags = [tag.strip() for tag in positive_tags_raw if tag.strip() != '']
-        negative_tags = [tag.strip() for tag in negative_tags_raw if tag.strip() != '']
+        return prompt_text[positive_start:positive_end].strip(), \
+            prompt_text[negative_start:negative_end].strip(), \
+            prompt_text[negative_end + 1:].strip()
 
+    @staticmethod
+    def parse_prompts(prompt_text: str):
+        """
+        :return: The positive and negative tag fragments as text, and the extra data text.
+        """
+        positive_text, negative_text, extra_data_string = Prompts.split_prompt_sections(prompt_text)
+        positive_tags = [nodes_to_text(fragment).strip() for fragment in prompt_fragments(parse_prompt(positive_text))]
+        negative_tags = [nodes_to_text(fragment).strip() for fragment in prompt_fragments(parse_prompt(negative_text))]
+        positive_tags = [tag for tag in positive_tags if tag != '']
+        negative_tags = [tag for tag in negative_tags if tag != '']
         return positive_tags, negative_tags, extra_data_string
 
     @staticmethod
-    def tags_list_to_tag_data(tags: [str]) -> dict:
-        data_tag = []
-        data_weight = []
+    def parse_tag_weights(text: str) -> TagWeightList:
+        """
+        Parse the text as the tags of one side, without splitting the positive and negative part.
+        """
+        return Prompts.build_tag_weights(prompt_tag_weights(parse_prompt(text)))
+
+    @staticmethod
+    def tags_list_to_tag_weights(tags: [str]) -> TagWeightList:
+        tag_weights = []
         for tag in tags:
-            raw_tags, tag_weights = Prompts.analysis_tag(tag)
-            if len(raw_tags) == 0:
-                continue
-            for raw_tag, tag_weight in zip(raw_tags, tag_weights):
-                raw_tag = raw_tag.strip()
-                if raw_tag == '':
-                    continue
-                # Process the duplicate case
-                if raw_tag not in data_tag:
-                    data_tag.append(raw_tag)
-                    data_weight.append(format_float(tag_weight))
-                else:
-                    index = data_tag.index(raw_tag)
-                    data_weight[index] = format_float(float(data_weight[index]) * float(tag_weight))
-        return {
-            PRIMARY_KEY: data_tag,
-            'weight': data_weight
-        }
+            tag_weights.extend(zip(*Prompts.analysis_tag(tag)))
+        return Prompts.build_tag_weights(tag_weights)
 
     @staticmethod
-    def analysis_tag(tag: str):
-        weight_list = []
-        tag_list = []
-        if tag.startswith('[') or tag.endswith(']'):
-            raw_tag, weight = parse_wrapper(tag, '[', ']', WEIGHT_DEC_BASE)
-            pure_tag, weight2 = parse_tag_colon_weight(raw_tag)
-            tag_list.append(pure_tag)
-            weight_list.append(weight * weight2)
-        elif tag.startswith('{') or tag.endswith('}'):
-            raw_tag, weight = parse_wrapper(tag, '{', '}', WEIGHT_INC_BASE)
-            pure_tag, weight2 = parse_tag_colon_weight(raw_tag)
-            tag_list.append(pure_tag)
-            weight_list.append(weight * weight2)
-        elif tag.startswith('(') or tag.endswith(')'):
-            # TODO: Cannot parse (A, B, C: weight)
-            if ':' in tag:
-                sub_tags = tag.replace('(', '').replace(')', '').split(':')
-                for sub_tag in sub_tags:
-                    weight = try_float(sub_tag)
-                    if weight:
-                        weight_list.append(weight)
-                    else:
-                        tag_list.append(sub_tag)
-            else:
-                raw_tag, weight = parse_wrapper(tag, '(', ')', WEIGHT_INC_BASE)
-                pure_tag, weight2 = parse_tag_colon_weight(raw_tag)
-                tag_list.append(pure_tag)
-                weight_list.append(weight * weight2)
-        elif tag.startswith('<'):
-            sub_tags = tag.replace('<', '').replace('>', '').split(':')
-
-            weight = try_float(sub_tags[2]) if len(sub_tags) > 2 else None
-            weight = 1.0 if weight is None else weight
-            raw_tag = sub_tags[0] + ':' + sub_tags[1] if len(sub_tags) > 1 else sub_tags[0]
-
-            tag_list.append(raw_tag)
-            weight_list.append(weight)
-        else:
-            tag, weight = parse_tag_colon_weight(tag)
-            tag_list.append(tag)
-            weight_list.append(weight)
+    def build_tag_weights(tag_weights: [(str, float)]) -> TagWeightList:
+        """
+        The same tag with the same weight is kept once. The different weights of a tag are multiplied.
+        """
+        tag_weight_list = TagWeightList()
+        for tag, weight in dict.fromkeys(tag_weights):
+            if not tag_weight_list.append(tag, weight):
+                tag_weight_list.weights()[tag_weight_list.index(tag)] *= weight
+        return tag_weight_list
 
-        return tag_list, weight_list
+    @staticmethod
+    def analysis_tag(tag: str):
+        """
+        Parse a tag fragment like '(a, b:1.2)'.
+        :return: The tag list and the effective weight list.
+        """
+        tag_weights = prompt_tag_weights(parse_prompt(tag))
+        return [tag for tag, _ in tag_weights], [weight for _, weight in tag_weights]
 
     @staticmethod
-    def merge_tag_data_dict(base: dict, update: dict):
-        for tag, weight in zip(update[PRIMARY_KEY], update['weight']):
-            try:
-                if tag in base[PRIMARY_KEY]:
-                    index = base[PRIMARY_KEY].index(tag)
-                    adjust_weight = try_float(base['weight'][index], 1.0) + 0.1  # + try_float(weight, 1.0)- 1.0
-                    base['weight'][index] = max(adjust_weight, 0.1)
-                else:
-                    base[PRIMARY_KEY].append(tag)
-                    base['weight'].append(weight)
-            except Exception as e:
-                print(e)
-            finally:
-                pass
+    def merge_tag_weights(base: TagWeightList, update: TagWeightList):
+        """
+        Add the new tags of update to base. The weight of the tag in both is increased by 0.1.
+        """
+        positions = base.positions(update.tags())
+        exists = positions >= 0
+        weights = base.weights()
+        weights[positions[exists]] = np.maximum(weights[positions[exists]] + 0.1, 0.1)
+        base.extend([tag for tag, found in zip(update.tags(), exists) if not found], update.weights()[~exists])
 
 
 def test_parse_tag():
@@ -263,6 +249,8 @@ def test_parse_tag():
     print(Prompts.analysis_tag("tag"))
     print(Prompts.analysis_tag("(tag:1.2)"))
     print(Prompts.analysis_tag("(tag1:tag2:1.1:1.2)"))
+    print(Prompts.analysis_tag("(A, B, C: 1.2)"))
+    print(Prompts.analysis_tag("((a:1.2), b)"))
 
     print(Prompts.analysis_tag("(abc)"))
     print(Prompts.analysis_tag("((abc))"))
@@ -275,3 +263,25 @@ def test_parse_tag():
     print(Prompts.analysis_tag("[xyz]"))
     print(Prompts.analysis_tag("[[xyz]]"))
     print(Prompts.analysis_tag("[[[xyz]]]"))
+
+
+def test_tag_weights_to_string():
+    tag_weights = TagWeightList(['a', 'b', 'c', 'd (e)'], [1.0, 1.2, 0.9, 1.0004])
+    assert Prompts.tag_weights_to_string(tag_weights, True) == r'a, (b:1.2), (c:0.9), d \(e\)'
+    assert Prompts.tag_weights_to_string(tag_weights, False) == r'a, b, c, d \(e\)'
+
+
+def test_parse_deep_prompts():
+    positive_tags, _, _ = Prompts.parse_prompts('(' * 300 + 'a' + ')' * 300 + ', b')
+    assert positive_tags == ['(' * 300 + 'a' + ')' * 300, 'b']
+    assert Prompts.parse_tag_weights('(' * 300 + 'a' + ')' * 300).tags() == ['a']
+
+
+def main():
+    test_parse_tag()
+    test_tag_weights_to_string()
+    test_parse_deep_prompts()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+import io
+import os
+import sys
+import time
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from TagManager import TagManager, PRIMARY_KEY, NUMERIC_FIELDS
+from defines import IMPORT_CATEGORY_PATH
+
+
+class TagImporter:
+    """
+    Bulk import of Danbooru / e621 style tag dumps. The supported formats:
+        Without header (a1111 tag autocomplete): name,category,post_count,aliases
+        With header (site export):               id,name,post_count,category,... (aliases is optional)
+    The category is mapped to path by IMPORT_CATEGORY_PATH. The post count goes to statistics.
+    The aliases go to comments.
+
+    The dump is merged into the database by column operations in one edit session, so there's only one save.
+    The policy decides the fields of the existing tags:
+        keep:      Only fill the empty fields. The same as update_df_from_right_value_if_empty().
+                   0 is empty for the numeric fields, e.g. the statistics that is never counted.
+        overwrite: Replace the fields by the non-empty imported values.
+    """
+
+    POLICY_KEEP = 'keep'
+    POLICY_OVERWRITE = 'overwrite'
+
+    DUMP_COLUMNS = ['name', 'category', 'post_count', 'aliases']
+
+    def __init__(self, tag_manager: TagManager, category_path: dict = None):
+        self.__tag_manager = tag_manager
+        self.__category_path = category_path if category_path is not None else IMPORT_CATEGORY_PATH
+
+    def read_dump(self, dump_file: str or io.TextIOBase, source: str = 'danbooru',
+                  keep_underscore: bool = False, min_count: int = 0) -> pd.DataFrame:
+        """
+        Read a tag dump as the rows of database.
+        :param dump_file: The csv dump file, or a text stream of it.
+        :param source: The key of category path mapping, 'danbooru' or 'e621'.
+        :param keep_underscore: The dump uses '_' as space. Convert it to space as prompt does, except for
+                                the short emoticon tags like '^_^'.
+        :param min_count: Skip the tags with post count less than it.
+        :return: Dataframe of [tag, path, statistics, comments]
+        """
+        if isinstance(dump_file, str):
+            with open(dump_file, 'rt', encoding='utf-8') as f:
+                first_line = f.readline()
+        else:
+            first_line = dump_file.readline()
+            dump_file.seek(0)
+        has_header = first_line.split(',')[0].strip().strip('"') in ['id', 'name']
+        dump = pd.read_csv(dump_file, header=0 if has_header else None, dtype=str, keep_default_na=False,
+                           names=None if has_header else self.DUMP_COLUMNS, usecols=lambda c: c in self.DUMP_COLUMNS)
+        dump = dump.reindex(columns=self.DUMP_COLUMNS, fill_value='')
+
+        tags = dump['name'].str.strip()
+        if not keep_underscore:
+            tags = tags.where(tags.str.len() <= 3, tags.str.replace('_', ' ', regex=False))
+
+        counts = pd.to_numeric(dump['post_count'], errors='coerce')
+        category_path = self.__category_path.get(source, {})
+        categories = pd.to_numeric(dump['category'], errors='coerce')
+        paths = categories.map(category_path).fillna('')
+        aliases = dump['aliases'].str.strip()
+        comments = np.where(aliases != '', 'alias: ' + aliases.str.replace(',', ', ', regex=False), '')
+
+        rows = pd.DataFrame({PRIMARY_KEY: tags.values, 'path': paths.values,
+                             'statistics': counts.values, 'comments': comments})
+        rows = rows[(rows[PRIMARY_KEY] != '') & ~(counts.values < min_count)]
+        return rows.drop_duplicates(subset=[PRIMARY_KEY], keep='first').reset_index(drop=True)
+
+    def import_dump(self, dump_file: str, source: str = 'danbooru', policy: str = POLICY_KEEP,
+                    keep_underscore: bool = False, min_count: int = 0) -> dict:
+        """
+        Read a tag dump and merge it into the database. See read_dump() and import_rows() for the parameters.
+        :return: The count dict {'added': n, 'updated': n}
+        """
+        return self.import_rows(self.read_dump(dump_file, source, keep_underscore, min_count), policy)
+
+    def import_rows(self, rows: pd.DataFrame, policy: str = POLICY_KEEP) -> dict:
+        """
+        Merge the rows into the database with the policy.
+        :param rows: Dataframe with primary key column and the fields to import.
+        :param policy: POLICY_KEEP or POLICY_OVERWRITE
+        :return: The count dict {'added': n, 'updated': n}
+        """
+        if policy not in [self.POLICY_KEEP, self.POLICY_OVERWRITE]:
+            raise ValueError(f'Unknown import policy: {policy}')
+
+        rows = rows.drop_duplicates(subset=[PRIMARY_KEY], keep='first').reset_index(drop=True)
+        existing = self.__tag_manager.select_rows(rows[PRIMARY_KEY]).reset_index(drop=True)
+        positions = pd.Index(existing[PRIMARY_KEY]).get_indexer(rows[PRIMARY_KEY])
+        exists = positions >= 0
+
+        # Decide the final value of each field of the existing tags
+        merged = rows.copy()
+        for field in rows.columns:
+            if field == PRIMARY_KEY or field not in existing.columns or not exists.any():
+                continue
+            old_values = pd.Series(existing[field].to_numpy(dtype=object)[positions[exists]])
+            new_values = pd.Series(rows[field].to_numpy(dtype=object)[exists])
+            old_empty = old_values.isna() | (old_values == '')
+            new_empty = new_values.isna() | (new_values == '')
+            if field in NUMERIC_FIELDS:
+                old_empty |= pd.to_numeric(old_values, errors='coerce') == 0
+                new_empty |= pd.to_numeric(new_values, errors='coerce') == 0
+            if policy == self.POLICY_KEEP:
+                final_values = old_values.where(~old_empty, new_values)
+            else:
+                final_values = new_values.where(~new_empty, old_values)
+            merged[field] = merged[field].astype(object)
+            merged.loc[exists, field] = final_values.values
+
+        with self.__tag_manager.edit_session() as session:
+            session.upsert_dataframe(merged)
+        return {'added': int((~exists).sum()), 'updated': int(exists.sum())}
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+
+def test_import_dump():
+    dump = io.StringIO('1girl,0,5000,"female,girls"\n'
+                       'solo,0,4000,\n'
+                       'hatsune_miku,4,3000,miku\n'
+                       '^_^,0,10,\n'
+                       'rare_tag,0,1,\n')
+    work_dir = tempfile.mkdtemp()
+    public_db = os.path.join(work_dir, 'public.csv')
+    pd.DataFrame({PRIMARY_KEY: ['1girl', 'solo'], 'path': ['人物', ''], 'comments': ['', 'old'],
+                  'statistics': ['0', '7']}).to_csv(public_db, index=False)
+    private_db = os.path.join(work_dir, 'private.csv')
+
+    importer = TagImporter(TagManager(public_db, private_db, 0), {'danbooru': {0: 'general', 4: 'character'}})
+    rows = importer.read_dump(dump, min_count=5)
+    assert list(rows[PRIMARY_KEY]) == ['1girl', 'solo', 'hatsune miku', '^_^']
+    assert list(rows['path']) == ['general', 'general', 'character', 'general']
+    assert rows['comments'][0] == 'alias: female, girls' and rows['statistics'][2] == 3000
+
+    # keep: only the empty fields are filled. The statistics 0 is empty.
+    tag_manager = TagManager(public_db, private_db, 0)
+    result = TagImporter(tag_manager).import_rows(rows, TagImporter.POLICY_KEEP)
+    assert result == {'added': 2, 'updated': 2}
+    assert tag_manager.get_property('1girl', 'path') == '人物'
+    assert float(tag_manager.get_property('1girl', 'statistics')) == 5000
+    assert tag_manager.get_property('solo', 'path') == 'general'
+    assert tag_manager.get_property('solo', 'comments') == 'old'
+    assert float(tag_manager.get_property('solo', 'statistics')) == 7
+    assert tag_manager.get_property('hatsune miku', 'comments') == 'alias: miku'
+
+    # overwrite: the non-empty imported values replace the fields
+    tag_manager = TagManager(public_db, private_db, 0)
+    TagImporter(tag_manager).import_rows(rows, TagImporter.POLICY_OVERWRITE)
+    assert tag_manager.get_property('1girl', 'path') == 'general'
+    assert tag_manager.get_property('solo', 'comments') == 'old'
+    assert float(tag_manager.get_property('solo', 'statistics')) == 4000
+
+
+def main():
+    """
+    Import a Danbooru / e621 style tag dump into the tag database.
+        python TagImporter.py <dump_csv> [danbooru|e621] [keep|overwrite] [min_count]
+        python TagImporter.py test
+    """
+    from defines import PUBLIC_DATABASE, PRIVATE_DATABASE, BACKUP_LIMIT
+
+    if sys.argv[1:] == ['test']:
+        test_import_dump()
+        return
+
+    if len(sys.argv) < 2 or not os.path.isfile(sys.argv[1]):
+        print(main.__doc__)
+        return
+
+    source = sys.argv[2] if len(sys.argv) > 2 else 'danbooru'
+    policy = sys.argv[3] if len(sys.argv) > 3 else TagImporter.POLICY_KEEP
+    min_count = int(sys.argv[4]) if len(sys.argv) > 4 else 0
+
+    tag_manager = TagManager(PUBLIC_DATABASE, PRIVATE_DATABASE, BACKUP_LIMIT)
+    time_start = time.time()
+    result = TagImporter(tag_manager).import_dump(sys.argv[1], source, policy, min_count=min_count)
+    tag_manager.close()
+    print(f"Imported in {time.time() - time_start:.2f}s. Added: {result['added']}, updated: {result['updated']}")
+
+
+if __name__ == '__main__':
+    main()
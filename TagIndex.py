@@ -0,0 +1,932 @@
+import re
+import time
+import heapq
+import bisect
+import itertools
+import numpy as np
+
+import pandas as pd
+
+from app_utility import unique_list
+
+
+class TagIndex:
+    """
+    The base of secondary indexes over the tag database. The indexes are maintained by TagManager:
+        rebuild(snapshot): Build the index from a whole TagSnapshot. Called when the index is registered.
+        update(snapshot, change_set): Apply a TagChangeSet. The snapshot is the state after the changes.
+        get_state() / set_state(snapshot, state): Optional. Cache the index with the snapshot cache to skip rebuild.
+    An index keeps the indexed values of each tag by itself, so the stale entries can be removed
+    without the old database.
+    """
+
+    # Rebuild instead of the incremental update if a change set touches more than this ratio of rows.
+    REBUILD_RATIO = 0.3
+
+    def rebuild(self, snapshot):
+        pass
+
+    def update(self, snapshot, change_set):
+        pass
+
+    def get_state(self):
+        """
+        The picklable state of index to be cached with the database snapshot. None if it's not cached.
+        """
+        return None
+
+    def set_state(self, snapshot, state) -> bool:
+        """
+        Restore the state from get_state(), which was cached with the database of snapshot.
+        :return: False if the state is not usable, then the index is rebuilt.
+        """
+        return False
+
+    def need_rebuild(self, snapshot, change_set) -> bool:
+        changed_count = len(change_set.added) + len(change_set.updated) + len(change_set.removed)
+        return changed_count > max(len(snapshot.database), 1) * self.REBUILD_RATIO
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+
+def split_tag_path(path: str) -> [str]:
+    """
+    Split a path like 'scene/outdoor' into the parts. The blank parts are ignored.
+    """
+    return [part.strip() for part in str(path).split('/') if part.strip() != '']
+
+
+class PathTrieNode:
+    __slots__ = ['children', 'tags', 'subtree_count']
+
+    def __init__(self):
+        self.children = {}
+        # The tags whose path is exactly this node
+        self.tags = set()
+        # The number of tags in this node and all the sub nodes
+        self.subtree_count = 0
+
+
+class TagPathIndex(TagIndex):
+    """
+    A trie of the 'path' field. Each node keeps the tags of its path and the tag count of its subtree,
+    so a tree node query costs the result size instead of scanning the database.
+    The row positions are resolved by the tag index of snapshot, because they are shifted by the row removal.
+    """
+
+    def __init__(self, field: str = 'path', primary_key: str = 'tag'):
+        self.__field = field
+        self.__primary_key = primary_key
+        self.__root = PathTrieNode()
+        self.__tag_parts = {}
+        # Increased when a node is added or removed. The UI rebuilds its tree only if it's changed.
+        self.__structure_version = 0
+
+    def rebuild(self, snapshot):
+        self.__root = PathTrieNode()
+        self.__tag_parts = {}
+        self.__structure_version += 1
+        df = snapshot.database
+        groups = pd.Series(df[self.__primary_key].values).groupby(df[self.__field].astype(str).values)
+        for path, tags in groups:
+            parts = tuple(split_tag_path(path))
+            tags = tags.tolist()
+            node = self.__node(parts, True)
+            node.tags.update(tags)
+            for tag in tags:
+                self.__tag_parts[tag] = parts
+            self.__add_count(parts, len(tags))
+
+    def update(self, snapshot, change_set):
+        if self.need_rebuild(snapshot, change_set):
+            self.rebuild(snapshot)
+            return
+        for tag in change_set.removed:
+            self.__remove_tag(tag)
+        updated = [tag for tag, fields in change_set.updated.items() if self.__field in fields]
+        for tag in list(change_set.added) + updated:
+            self.__remove_tag(tag)
+            self.__add_tag(tag, snapshot.get_property(tag, self.__field))
+
+    def structure_version(self) -> int:
+        return self.__structure_version
+
+    def get_paths(self) -> [str]:
+        """
+        Get all the paths that have tags in them or their sub paths, parent first.
+        """
+        paths = []
+        stack = [((), self.__root)]
+        while len(stack) > 0:
+            parts, node = stack.pop()
+            if len(parts) > 0:
+                paths.append('/'.join(parts))
+            for name in sorted(node.children.keys(), reverse=True):
+                stack.append((parts + (name, ), node.children[name]))
+        return paths
+
+    def get_tags(self, path: str, include_sub_path: bool = False) -> [str]:
+        """
+        Get the tags of a path.
+        :param path: The path like 'scene/outdoor'. Empty for the tags without path.
+        :param include_sub_path: Also include the tags of all the sub paths.
+        :return: The list of tags in no particular order.
+        """
+        node = self.__node(tuple(split_tag_path(path)), False)
+        if node is None:
+            return []
+        if not include_sub_path:
+            return list(node.tags)
+        tags = []
+        stack = [node]
+        while len(stack) > 0:
+            node = stack.pop()
+            tags.extend(node.tags)
+            stack.extend(node.children.values())
+        return tags
+
+    def count_tags(self, path: str, include_sub_path: bool = False) -> int:
+        node = self.__node(tuple(split_tag_path(path)), False)
+        if node is None:
+            return 0
+        return node.subtree_count if include_sub_path else len(node.tags)
+
+    # ------------------------------------------------------------------------------------------------------------------
+
+    def __node(self, parts: tuple, create: bool) -> PathTrieNode or None:
+        node = self.__root
+        for part in parts:
+            child = node.children.get(part, None)
+            if child is None:
+                if not create:
+                    return None
+                child = node.children[part] = PathTrieNode()
+                self.__structure_version += 1
+            node = child
+        return node
+
+    def __add_count(self, parts: tuple, count: int):
+        node = self.__root
+        node.subtree_count += count
+        for part in parts:
+            node = node.children[part]
+            node.subtree_count += count
+
+    def __add_tag(self, tag: str, path: str):
+        parts = tuple(split_tag_path(path))
+        self.__node(parts, True).tags.add(tag)
+        self.__tag_parts[tag] = parts
+        self.__add_count(parts, 1)
+
+    def __remove_tag(self, tag: str):
+        parts = self.__tag_parts.pop(tag, None)
+        if parts is None:
+            return
+        node = self.__root
+        node.subtree_count -= 1
+        for part in parts:
+            parent, node = node, node.children[part]
+            node.subtree_count -= 1
+            # Prune the empty branch
+            if node.subtree_count == 0:
+                del parent.children[part]
+                self.__structure_version += 1
+                return
+        node.tags.discard(tag)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+
+LABEL_SEPARATORS = re.compile(r'[,，;；|]')
+
+
+def split_tag_labels(label: str) -> [str]:
+    """
+    Split a label cell into labels. A tag can be in multiple favourites, like 'portrait, night'.
+    """
+    return unique_list([part.strip() for part in LABEL_SEPARATORS.split(str(label)) if part.strip() != ''])
+
+
+class TagLabelIndex(TagIndex):
+    """
+    An inverted index of the 'label' (收藏夹) field: label -> tags. A cell may have multiple labels.
+    """
+
+    def __init__(self, field: str = 'label', primary_key: str = 'tag'):
+        self.__field = field
+        self.__primary_key = primary_key
+        self.__label_tags = {}
+        self.__tag_labels = {}
+        # Increased on each change of membership
+        self.__version = 0
+
+    def rebuild(self, snapshot):
+        self.__label_tags = {}
+        self.__tag_labels = {}
+        self.__version += 1
+        df = snapshot.database
+        # Split each distinct cell once instead of each row
+        groups = pd.Series(df[self.__primary_key].values).groupby(df[self.__field].astype(str).values)
+        for cell, tags in groups:
+            labels = tuple(split_tag_labels(cell))
+            if len(labels) == 0:
+                continue
+            tags = tags.tolist()
+            for label in labels:
+                self.__label_tags.setdefault(label, set()).update(tags)
+            for tag in tags:
+                self.__tag_labels[tag] = labels
+
+    def update(self, snapshot, change_set):
+        if self.need_rebuild(snapshot, change_set):
+            self.rebuild(snapshot)
+            return
+        updated = [tag for tag, fields in change_set.updated.items() if self.__field in fields]
+        for tag in list(change_set.removed) + list(change_set.added) + updated:
+            self.__remove_tag(tag)
+        for tag in list(change_set.added) + updated:
+            self.__add_tag(tag, snapshot.get_property(tag, self.__field))
+
+    def version(self) -> int:
+        return self.__version
+
+    def get_labels(self) -> [str]:
+        return sorted(self.__label_tags.keys())
+
+    def get_tags(self, label: str) -> [str]:
+        return list(self.__label_tags.get(label.strip(), []))
+
+    def count_tags(self, label: str) -> int:
+        return len(self.__label_tags.get(label.strip(), []))
+
+    def get_tag_labels(self, tag: str) -> [str]:
+        return list(self.__tag_labels.get(tag, ()))
+
+    # ------------------------------------------------------------------------------------------------------------------
+
+    def __add_tag(self, tag: str, cell: str):
+        labels = tuple(split_tag_labels(cell))
+        if len(labels) == 0:
+            return
+        for label in labels:
+            self.__label_tags.setdefault(label, set()).add(tag)
+        self.__tag_labels[tag] = labels
+        self.__version += 1
+
+    def __remove_tag(self, tag: str):
+        labels = self.__tag_labels.pop(tag, None)
+        if labels is None:
+            return
+        for label in labels:
+            tags = self.__label_tags[label]
+            tags.discard(tag)
+            if len(tags) == 0:
+                del self.__label_tags[label]
+        self.__version += 1
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+
+def text_grams(text: str) -> set:
+    """
+    The character bigrams of a lower case text, and the unigrams of non-ascii characters.
+    The CJK text is indexed without word segmentation, and a single CJK character can be searched.
+    Lines are indexed separately.
+    """
+    grams = set()
+    for line in text.split('\n'):
+        grams.update(line[i:i + 2] for i in range(len(line) - 1))
+        grams.update(c for c in line if ord(c) > 127)
+    return grams
+
+
+class TagNgramIndex(TagIndex):
+    """
+    A character n-gram inverted index of the text fields for substring search.
+
+    Each indexed version of a row is a document with an id. The postings of rebuild() are sorted int arrays.
+    The documents of the later changes go to the delta postings, and the replaced documents are marked
+    deleted (text None) instead of removed from postings. The query intersects the postings of query grams
+    and verifies the candidates by substring match, so the stale postings are harmless.
+    """
+
+    # Rebuild when the deleted documents are more than this ratio, to drop the stale postings.
+    COMPACT_RATIO = 0.3
+
+    def __init__(self, fields: [str], primary_key: str = 'tag'):
+        self.__fields = fields
+        self.__primary_key = primary_key
+        self.__reset()
+
+    def rebuild(self, snapshot):
+        self.__reset()
+        df = snapshot.database
+        texts = df[self.__fields[0]].astype(str).str.lower()
+        for field in self.__fields[1:]:
+            texts = texts + '\n' + df[field].astype(str).str.lower()
+        self.__doc_tags = df[self.__primary_key].tolist()
+        self.__doc_texts = texts.tolist()
+        self.__tag_docs = dict(zip(self.__doc_tags, range(len(self.__doc_tags))))
+
+        self.__postings = TagNgramIndex.build_postings(self.__doc_texts)
+
+    def update(self, snapshot, change_set):
+        if self.need_rebuild(snapshot, change_set):
+            self.rebuild(snapshot)
+            return
+        updated = [tag for tag, fields in change_set.updated.items() if len(fields & set(self.__fields)) > 0]
+        for tag in list(change_set.removed) + list(change_set.added) + updated:
+            self.__remove_tag(tag)
+        for tag in list(change_set.added) + updated:
+            self.__add_tag(tag, '\n'.join(str(snapshot.get_property(tag, field)).lower() for field in self.__fields))
+        if self.__deleted_count > len(self.__doc_texts) * self.COMPACT_RATIO:
+            self.rebuild(snapshot)
+
+    def search(self, text: str) -> [str]:
+        """
+        Find the tags that any of the indexed fields contains the text, case insensitive.
+        :param text: The text to search.
+        :return: The list of tags in no particular order.
+        """
+        text = text.strip().lower()
+        if text == '' or '\n' in text:
+            return []
+        grams = text_grams(text) if len(text) > 1 or ord(text) > 127 else set()
+        if len(grams) == 0:
+            # A single ascii character. Too common to be indexed.
+            doc_ids = range(len(self.__doc_texts))
+        else:
+            doc_ids = None
+            for doc_ids_of_gram in sorted((self.__gram_doc_ids(gram) for gram in grams), key=len):
+                doc_ids = doc_ids_of_gram if doc_ids is None else \
+                    np.intersect1d(doc_ids, doc_ids_of_gram, assume_unique=True)
+                if len(doc_ids) == 0:
+                    return []
+        doc_texts, doc_tags = self.__doc_texts, self.__doc_tags
+        return [doc_tags[doc_id] for doc_id in doc_ids
+                if doc_texts[doc_id] is not None and text in doc_texts[doc_id]]
+
+    def get_state(self):
+        return self.__fields, self.__doc_tags, self.__doc_texts, self.__postings, self.__delta_postings, \
+            self.__deleted_count
+
+    def set_state(self, snapshot, state) -> bool:
+        if state is None or state[0] != self.__fields:
+            return False
+        _, self.__doc_tags, self.__doc_texts, self.__postings, self.__delta_postings, self.__deleted_count = state
+        self.__tag_docs = {tag: doc_id for doc_id, tag in enumerate(self.__doc_tags)
+                           if self.__doc_texts[doc_id] is not None}
+        return True
+
+    @staticmethod
+    def build_postings(texts: [str]) -> dict:
+        """
+        Build the postings of text_grams() for all texts at once by numpy, instead of text by text.
+        :param texts: The lower case texts. The index is the doc id.
+        :return: {gram: sorted int32 array of doc ids}
+        """
+        if len(texts) == 0:
+            return {}
+        lengths = np.fromiter(map(len, texts), dtype=np.int64, count=len(texts))
+        code_points = np.frombuffer('\n'.join(texts).encode('utf-32-le'), dtype=np.uint32).astype(np.int64)
+        doc_ids = np.repeat(np.arange(len(texts), dtype=np.int64), lengths + 1)[:len(code_points)]
+
+        # A bigram is encoded as (first << 21 | second), which is larger than any unigram (a code point)
+        first, second = code_points[:-1], code_points[1:]
+        bigram = (first != 10) & (second != 10)
+        unigram = code_points > 127
+        gram_codes = np.concatenate([(first[bigram] << 21) | second[bigram], code_points[unigram]])
+        gram_docs = np.concatenate([doc_ids[:-1][bigram], doc_ids[unigram]])
+
+        # Sort the (gram, doc) pairs by one int key and drop the duplicates
+        unique_codes, gram_ids = np.unique(gram_codes, return_inverse=True)
+        pairs = np.unique((gram_ids.astype(np.int64) << 32) | gram_docs)
+        if len(pairs) == 0:
+            # All the texts are single ascii characters
+            return {}
+        gram_ids, gram_docs = pairs >> 32, (pairs & 0xFFFFFFFF).astype(np.int32)
+        starts = np.flatnonzero(np.r_[True, gram_ids[1:] != gram_ids[:-1]])
+        ends = np.r_[starts[1:], len(pairs)]
+
+        postings = {}
+        for code, start, end in zip(unique_codes[gram_ids[starts]].tolist(), starts.tolist(), ends.tolist()):
+            gram = chr(code >> 21) + chr(code & 0x1FFFFF) if code >= (1 << 21) else chr(code)
+            postings[gram] = gram_docs[start:end]
+        return postings
+
+    # ------------------------------------------------------------------------------------------------------------------
+
+    def __reset(self):
+        self.__doc_tags = []
+        self.__doc_texts = []
+        self.__tag_docs = {}
+        self.__postings = {}
+        self.__delta_postings = {}
+        self.__deleted_count = 0
+
+    def __gram_doc_ids(self, gram: str) -> np.ndarray:
+        doc_ids = self.__postings.get(gram, None)
+        delta = self.__delta_postings.get(gram, None)
+        if delta is None:
+            return doc_ids if doc_ids is not None else np.zeros(0, dtype=np.int32)
+        delta = np.array(sorted(delta), dtype=np.int32)
+        return delta if doc_ids is None else np.concatenate([doc_ids, delta])
+
+    def __add_tag(self, tag: str, text: str):
+        doc_id = len(self.__doc_texts)
+        self.__doc_tags.append(tag)
+        self.__doc_texts.append(text)
+        self.__tag_docs[tag] = doc_id
+        for gram in text_grams(text):
+            self.__delta_postings.setdefault(gram, set()).add(doc_id)
+
+    def __remove_tag(self, tag: str):
+        doc_id = self.__tag_docs.pop(tag, None)
+        if doc_id is not None:
+            self.__doc_texts[doc_id] = None
+            self.__deleted_count += 1
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+
+def edit_distance(a: str, b: str, max_distance: int) -> int:
+    """
+    The optimal string alignment distance (Levenshtein with adjacent transposition).
+    :return: The distance, or max_distance + 1 if it's larger than max_distance.
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous2, previous = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous2, previous = previous, current
+    return previous[-1] if previous[-1] <= max_distance else max_distance + 1
+
+
+class TagFuzzyIndex(TagIndex):
+    """
+    A SymSpell style index for "did you mean". The delete variants (up to MAX_DISTANCE characters deleted)
+    of the prefix of each tag are precomputed. A word's candidates are the tags sharing a delete variant
+    with it, which are verified by edit_distance().
+
+    The variants are kept as a sorted uint64 hash array with the tag ids, instead of a dict of strings,
+    to keep the memory small for a large tag dump. The hash collision only adds candidates to verify.
+    The index is built at the first lookup by numpy, a pass for each set of kept character positions.
+    The later added tags go to a delta dict.
+    """
+
+    MAX_DISTANCE = 2
+    PREFIX_LENGTH = 7
+
+    # The polynomial hash of a character sequence, modulo 2 ** 64. It's stable across processes.
+    HASH_SEED = 1469598103934665603
+    HASH_PRIME = 1099511628211
+
+    def __init__(self, primary_key: str = 'tag', rank_field: str = 'statistics'):
+        self.__primary_key = primary_key
+        self.__rank_field = rank_field
+        self.__snapshot = None
+        self.__built = False
+        self.__tags = []
+        self.__tag_ids = {}
+        self.__hashes = np.zeros(0, dtype=np.uint64)
+        self.__hash_tag_ids = np.zeros(0, dtype=np.int32)
+        self.__delta = {}
+        self.__deleted = set()
+
+    def rebuild(self, snapshot):
+        self.__snapshot = snapshot
+        self.__built = False
+
+    def update(self, snapshot, change_set):
+        self.__snapshot = snapshot
+        if not self.__built:
+            return
+        if self.need_rebuild(snapshot, change_set):
+            self.__built = False
+            return
+        # Only the tag itself is indexed, which is the primary key. Other fields are read for ranking.
+        for tag in change_set.removed:
+            tag_id = self.__tag_ids.pop(tag, None)
+            if tag_id is not None:
+                self.__deleted.add(tag_id)
+        for tag in change_set.added:
+            tag_id = self.__tag_ids[tag] = len(self.__tags)
+            self.__tags.append(tag)
+            for variant in self.delete_variants(tag.lower()):
+                self.__delta.setdefault(TagFuzzyIndex.sequence_hash(variant), []).append(tag_id)
+
+    def suggest(self, words: [str], limit: int = 3) -> dict:
+        """
+        Find the tags within MAX_DISTANCE of each word, in one pass for all the words.
+        :param words: The words, like the unknown tags of a prompt.
+        :param limit: The max number of suggestions of each word.
+        :return: {word: [tag, ...]} ordered by distance, case sensitive distance, then the rank field (descending).
+                 The words without suggestion are not included.
+        """
+        self.__ensure_built()
+        words = [word for word in dict.fromkeys(words) if word.strip() != '']
+        word_variants = [list(self.delete_variants(word.lower())) for word in words]
+        variant_hashes = np.array([TagFuzzyIndex.sequence_hash(variant)
+                                   for variants in word_variants for variant in variants], dtype=np.uint64)
+        lefts = np.searchsorted(self.__hashes, variant_hashes, 'left')
+        rights = np.searchsorted(self.__hashes, variant_hashes, 'right')
+
+        suggestions = {}
+        offset = 0
+        for word, variants in zip(words, word_variants):
+            candidate_ids = set()
+            for i in range(offset, offset + len(variants)):
+                candidate_ids.update(self.__hash_tag_ids[lefts[i]:rights[i]].tolist())
+                candidate_ids.update(self.__delta.get(int(variant_hashes[i]), []))
+            offset += len(variants)
+
+            lower_word = word.lower()
+            matches = []
+            for tag_id in candidate_ids - self.__deleted:
+                tag = self.__tags[tag_id]
+                distance = edit_distance(lower_word, tag.lower(), self.MAX_DISTANCE)
+                if distance <= self.MAX_DISTANCE and tag != word and tag != '':
+                    # Prefer the same case when the distance is the same
+                    case_distance = edit_distance(word, tag, self.MAX_DISTANCE * 2)
+                    matches.append((distance, case_distance, -self.__rank_value(tag), tag))
+            if len(matches) > 0:
+                suggestions[word] = [match[-1] for match in sorted(matches)[:limit]]
+        return suggestions
+
+    def delete_variants(self, word: str) -> set:
+        word = word[:self.PREFIX_LENGTH]
+        variants = {word}
+        edges = {word}
+        for _ in range(self.MAX_DISTANCE):
+            edges = {edge[:i] + edge[i + 1:] for edge in edges for i in range(len(edge))} - variants
+            variants |= edges
+        return variants
+
+    @staticmethod
+    def sequence_hash(text: str) -> int:
+        value = TagFuzzyIndex.HASH_SEED
+        for c in text:
+            value = (value * TagFuzzyIndex.HASH_PRIME + ord(c) + 1) & 0xFFFFFFFFFFFFFFFF
+        return value
+
+    def get_state(self):
+        if not self.__built:
+            return None
+        return self.__tags, self.__hashes, self.__hash_tag_ids, self.__delta, self.__deleted
+
+    def set_state(self, snapshot, state) -> bool:
+        if state is None:
+            return False
+        self.__snapshot = snapshot
+        self.__tags, self.__hashes, self.__hash_tag_ids, self.__delta, self.__deleted = state
+        self.__tag_ids = {tag: tag_id for tag_id, tag in enumerate(self.__tags) if tag_id not in self.__deleted}
+        self.__built = True
+        return True
+
+    # ------------------------------------------------------------------------------------------------------------------
+
+    def __ensure_built(self):
+        if self.__built:
+            return
+        self.__tags = self.__snapshot.database[self.__primary_key].tolist()
+        self.__tag_ids = dict(zip(self.__tags, range(len(self.__tags))))
+        self.__delta = {}
+        self.__deleted = set()
+
+        # The code points of the lower case prefixes as a matrix, padded by 0
+        prefixes = np.array([tag.lower()[:self.PREFIX_LENGTH] for tag in self.__tags], dtype='<U%d' % self.PREFIX_LENGTH)
+        code_points = prefixes.view(np.uint32).reshape(len(prefixes), self.PREFIX_LENGTH).astype(np.uint64)
+        lengths = np.char.str_len(prefixes)
+        tag_ids = np.arange(len(prefixes), dtype=np.int32)
+
+        hash_parts, tag_id_parts = [], []
+        with np.errstate(over='ignore'):
+            for length in np.unique(lengths).tolist():
+                rows = lengths == length
+                # Deleting n characters is keeping (length - n) positions
+                for keep in range(max(length - self.MAX_DISTANCE, 0), length + 1):
+                    for positions in itertools.combinations(range(length), keep):
+                        hashes = np.full(rows.sum(), self.HASH_SEED, dtype=np.uint64)
+                        for position in positions:
+                            hashes = hashes * np.uint64(self.HASH_PRIME) + code_points[rows, position] + np.uint64(1)
+                        hash_parts.append(hashes)
+                        tag_id_parts.append(tag_ids[rows])
+        hashes = np.concatenate(hash_parts) if len(hash_parts) > 0 else np.zeros(0, dtype=np.uint64)
+        order = np.argsort(hashes, kind='stable')
+        self.__hashes = hashes[order]
+        self.__hash_tag_ids = np.concatenate(tag_id_parts)[order] if len(tag_id_parts) > 0 else \
+            np.zeros(0, dtype=np.int32)
+        self.__built = True
+
+    def __rank_value(self, tag: str) -> float:
+        value = self.__snapshot.get_property(tag, self.__rank_field) if self.__snapshot.has_tag(tag) else 0.0
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return 0.0
+        return 0.0 if np.isnan(value) else value
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+
+class TagCompletionIndex(TagIndex):
+    """
+    Complete a typed prefix to tags, by the tag itself or its translation, ranked by a numeric field.
+
+    It's not a trie. The keys ('text' + KEY_SEPARATOR + 'tag', lower case text) are kept in a sorted list,
+    so the keys of a prefix are a bisect range. The top tags of each prefix that has more than SCAN_LIMIT keys
+    are cached like the ranked nodes of a trie, so a completion scans at most about SCAN_LIMIT keys.
+    A change of tag only refreshes the cached prefixes whose top tags can be affected.
+
+    Inserting into or deleting from the sorted list is O(n), so it's not changed for each key.
+    The added keys are kept in a pending set and the removed keys are skipped by a set,
+    and the list is rebuilt when more than MERGE_LIMIT keys are changed.
+    The index is built at the first completion.
+    """
+
+    SCAN_LIMIT = 128
+    MERGE_LIMIT = 256
+    CACHED_TOP_COUNT = 20
+    # Sorted before any printable character, so a text's keys are before the longer texts of the same prefix
+    KEY_SEPARATOR = '\x01'
+
+    def __init__(self, key_fields: [str], primary_key: str = 'tag', rank_field: str = 'statistics'):
+        self.__key_fields = key_fields
+        self.__primary_key = primary_key
+        self.__rank_field = rank_field
+        self.__snapshot = None
+        self.__built = False
+        self.__keys = []
+        self.__pending_keys = set()
+        self.__removed_keys = set()
+        self.__tag_keys = {}
+        self.__ranks = {}
+        self.__top_tags = {}
+
+    def rebuild(self, snapshot):
+        self.__snapshot = snapshot
+        self.__built = False
+
+    def update(self, snapshot, change_set):
+        self.__snapshot = snapshot
+        if not self.__built:
+            return
+        if self.need_rebuild(snapshot, change_set):
+            self.__built = False
+            return
+        fields = set(self.__key_fields + [self.__rank_field])
+        updated = [tag for tag, changed_fields in change_set.updated.items() if len(changed_fields & fields) > 0]
+
+        # The prefixes that a tag leaves the cached top are scanned again
+        dirty_prefixes = set()
+        for tag in list(change_set.removed) + list(change_set.added) + updated:
+            self.__ranks.pop(tag, None)
+            for key in self.__tag_keys.pop(tag, []):
+                self.__remove_key(key)
+                dirty_prefixes.update(prefix for prefix in self.__cached_prefixes(key)
+                                      if tag in self.__top_tags[prefix])
+        for tag in list(change_set.added) + updated:
+            self.__ranks[tag] = self.__rank_of(snapshot, tag)
+            keys = self.__keys_of(tag, [snapshot.get_property(tag, field) for field in self.__key_fields])
+            self.__tag_keys[tag] = keys
+            for key in keys:
+                self.__add_key(key)
+                # The added tag enters the cached top if it's ranked higher than the last one
+                for prefix in self.__cached_prefixes(key):
+                    top_tags = self.__top_tags[prefix]
+                    if prefix not in dirty_prefixes and tag not in top_tags:
+                        top_tags.append(tag)
+                        top_tags.sort(key=self.__sort_key)
+                        del top_tags[self.CACHED_TOP_COUNT:]
+        for prefix in dirty_prefixes:
+            self.__top_tags[prefix] = self.__scan_top_tags(prefix, self.CACHED_TOP_COUNT)[0]
+
+    def complete(self, prefix: str, limit: int = 10) -> [str]:
+        """
+        Get the tags whose tag or translation starts with the prefix, case insensitive.
+        :param prefix: The typed text.
+        :param limit: The max number of tags.
+        :return: The tags ordered by the rank field (descending), then shorter first.
+        """
+        self.__ensure_built()
+        prefix = prefix.strip().lower()
+        if prefix == '':
+            return []
+        top_tags = self.__top_tags.get(prefix, None)
+        if top_tags is not None and limit <= self.CACHED_TOP_COUNT:
+            return top_tags[:limit]
+        tags, key_count = self.__scan_top_tags(prefix, max(limit, self.CACHED_TOP_COUNT))
+        if key_count > self.SCAN_LIMIT:
+            # The prefix has got more keys since the build. Cache it so it's not scanned again.
+            self.__top_tags[prefix] = tags[:self.CACHED_TOP_COUNT]
+        return tags[:limit]
+
+    def get_state(self):
+        if not self.__built:
+            return None
+        return self.__key_fields, self.__keys, self.__pending_keys, self.__removed_keys, \
+            self.__tag_keys, self.__ranks, self.__top_tags
+
+    def set_state(self, snapshot, state) -> bool:
+        if state is None or len(state) != 7 or state[0] != self.__key_fields:
+            return False
+        self.__snapshot = snapshot
+        _, self.__keys, self.__pending_keys, self.__removed_keys, self.__tag_keys, self.__ranks, self.__top_tags = \
+            state
+        self.__built = True
+        return True
+
+    # ------------------------------------------------------------------------------------------------------------------
+
+    def __ensure_built(self):
+        if self.__built:
+            return
+        df = self.__snapshot.database
+        tags = df[self.__primary_key].astype(str).to_numpy(dtype=object)
+        ranks = np.nan_to_num(pd.to_numeric(df[self.__rank_field], errors='coerce').to_numpy(dtype=np.float64))
+        self.__ranks = dict(zip(tags.tolist(), ranks.tolist()))
+
+        # The (text, tag) of all key fields, without the empty texts and the same text of a tag
+        texts, rows = [], []
+        for field in self.__key_fields:
+            field_texts = np.array([str(value).strip().lower() for value in df[field].tolist()], dtype=object)
+            valid = field_texts != ''
+            for previous_texts in texts:
+                valid &= field_texts != previous_texts
+            texts.append(field_texts)
+            rows.append(np.flatnonzero(valid))
+        texts = np.concatenate([field_texts[field_rows] for field_texts, field_rows in zip(texts, rows)])
+        rows = np.concatenate(rows)
+        keys = (pd.Series(texts) + self.KEY_SEPARATOR + pd.Series(tags[rows])).tolist()
+        self.__keys = sorted(keys)
+        self.__pending_keys = set()
+        self.__removed_keys = set()
+        self.__tag_keys = {}
+        for tag, key in zip(tags[rows].tolist(), keys):
+            self.__tag_keys.setdefault(tag, []).append(key)
+
+        # Order the entries by __sort_key(). The tag codes of a sorted factorize are in alphabetical order.
+        tag_codes = pd.factorize(tags, sort=True)[0]
+        lengths = np.fromiter(map(len, tags), dtype=np.int64, count=len(tags))
+        order = np.lexsort((tag_codes[rows], lengths[rows], -ranks[rows]))
+        texts, rows = texts[order], rows[order]
+
+        # The top tags of each prefix that has more than SCAN_LIMIT keys: the first CACHED_TOP_COUNT distinct tags.
+        # Only the longer prefixes of such a prefix can have as many keys, so the entries are narrowed by length.
+        self.__top_tags = {}
+        length = 1
+        while len(texts) > 0:
+            text_lengths = np.fromiter(map(len, texts), dtype=np.int64, count=len(texts))
+            valid = text_lengths >= length
+            texts, rows = texts[valid], rows[valid]
+            prefix_codes, prefixes = pd.factorize(np.array([text[:length] for text in texts], dtype=object))
+            cached = (np.bincount(prefix_codes, minlength=len(prefixes)) > self.SCAN_LIMIT)[prefix_codes]
+            texts, rows, prefix_codes = texts[cached], rows[cached], prefix_codes[cached]
+
+            first = ~pd.Series((prefix_codes.astype(np.int64) << 32) | rows).duplicated().to_numpy()
+            top_codes, top_rows = prefix_codes[first], rows[first]
+            top = pd.Series(top_codes).groupby(top_codes).cumcount().to_numpy() < self.CACHED_TOP_COUNT
+            for prefix_code, row in zip(top_codes[top].tolist(), top_rows[top].tolist()):
+                self.__top_tags.setdefault(prefixes[prefix_code], []).append(tags[row])
+            length += 1
+        self.__built = True
+
+    def __scan_top_tags(self, prefix: str, limit: int) -> ([str], int):
+        """
+        :return: The top tags of the prefix, and the number of keys scanned.
+        """
+        begin = bisect.bisect_left(self.__keys, prefix)
+        end = bisect.bisect_left(self.__keys, prefix + '\U0010ffff')
+        keys = [key for key in self.__keys[begin:end] if key not in self.__removed_keys] \
+            if len(self.__removed_keys) > 0 else self.__keys[begin:end]
+        keys += [key for key in self.__pending_keys if key.startswith(prefix)]
+        tags = dict.fromkeys(key.split(self.KEY_SEPARATOR)[-1] for key in keys)
+        return heapq.nsmallest(limit, tags, key=self.__sort_key), len(keys)
+
+    def __add_key(self, key: str):
+        if key in self.__removed_keys:
+            self.__removed_keys.discard(key)
+        else:
+            self.__pending_keys.add(key)
+        if len(self.__pending_keys) + len(self.__removed_keys) > self.MERGE_LIMIT:
+            self.__merge_keys()
+
+    def __remove_key(self, key: str):
+        if key in self.__pending_keys:
+            self.__pending_keys.discard(key)
+        else:
+            self.__removed_keys.add(key)
+
+    def __merge_keys(self):
+        # The kept keys are a sorted run, so the sort is about linear
+        keys = [key for key in self.__keys if key not in self.__removed_keys] \
+            if len(self.__removed_keys) > 0 else self.__keys
+        self.__keys = sorted(keys + list(self.__pending_keys))
+        self.__pending_keys = set()
+        self.__removed_keys = set()
+
+    def __sort_key(self, tag: str) -> tuple:
+        return -self.__ranks.get(tag, 0.0), len(tag), tag
+
+    def __cached_prefixes(self, key: str) -> [str]:
+        text = key.split(self.KEY_SEPARATOR)[0]
+        return [text[:length] for length in range(1, len(text) + 1) if text[:length] in self.__top_tags]
+
+    def __keys_of(self, tag: str, values: list) -> [str]:
+        texts = unique_list([str(value).strip().lower() for value in values])
+        return [text + self.KEY_SEPARATOR + tag for text in texts if text != '']
+
+    def __rank_of(self, snapshot, tag: str) -> float:
+        try:
+            rank = float(snapshot.get_property(tag, self.__rank_field))
+        except (TypeError, ValueError):
+            return 0.0
+        return 0.0 if np.isnan(rank) else rank
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+
+def create_test_snapshot(tags: [str], translations: [str], statistics: [float]):
+    from TagManager import TagSnapshot
+    df = pd.DataFrame({'tag': tags, 'translate_cn': translations, 'statistics': statistics})
+    return TagSnapshot(0, df, dict(zip(tags, range(len(tags)))))
+
+
+def complete_by_scan(snapshot, prefix: str, limit: int) -> [str]:
+    df = snapshot.database
+    matched = df[df['tag'].str.lower().str.startswith(prefix) | df['translate_cn'].str.lower().str.startswith(prefix)]
+    tags = sorted(matched['tag'], key=lambda tag: (-snapshot.get_property(tag, 'statistics'), len(tag), tag))
+    return tags[:limit]
+
+
+def test_completion_update():
+    from TagManager import TagChangeSet
+    rng = np.random.default_rng(1)
+    tags = [''.join(rng.choice(list('abc'), 6)) + str(i) for i in range(3000)]
+    statistics = rng.integers(0, 100, len(tags)).astype(float).tolist()
+    snapshot = create_test_snapshot(tags, ['' if i % 3 else tag.upper()[::-1] for i, tag in enumerate(tags)],
+                                    statistics)
+    index = TagCompletionIndex(['tag', 'translate_cn'])
+    index.rebuild(snapshot)
+    index.complete('a')
+
+    # Many small changes, so the pending keys are merged into the sorted list several times
+    for i in range(60):
+        changed = rng.choice(len(tags), 10, replace=False).tolist()
+        change_set = TagChangeSet()
+        change_set.removed = [tags[row] for row in changed[:3]]
+        change_set.added = [f'added {i} {j}' for j in range(3)]
+        change_set.updated = {tags[row]: {'statistics'} for row in changed[3:]}
+        for row in changed[3:]:
+            statistics[row] = float(rng.integers(0, 200))
+        for row in sorted(changed[:3], reverse=True):
+            del tags[row], statistics[row]
+        tags += change_set.added
+        statistics += [float(rng.integers(0, 200)) for _ in change_set.added]
+        snapshot = create_test_snapshot(tags, [''] * len(tags), statistics)
+        index.update(snapshot, change_set)
+    snapshot = create_test_snapshot(tags, [''] * len(tags), statistics)
+    index.rebuild(snapshot)
+    for prefix in ['a', 'ab', 'abc', 'cba', 'added', 'added 5', 'ba', 'z']:
+        assert index.complete(prefix, 15) == complete_by_scan(snapshot, prefix, 15), prefix
+
+
+def test_completion_keystroke_time():
+    # 200k tags of a few syllables, so the short prefixes are shared by many keys like a real dictionary
+    rng = np.random.default_rng(0)
+    syllables = ['ba', 'bo', 'ka', 'ko', 'la', 'li', 'ma', 'mi', 'na', 'no', 'ra', 'ri', 'sa', 'so', 'ta', 'to']
+    words = np.array([''.join(rng.choice(syllables, rng.integers(2, 5))) for _ in range(4000)], dtype=object)
+    pairs = words[rng.integers(0, len(words), (220000, 2))]
+    tags = list(dict.fromkeys(first + ' ' + second for first, second in pairs.tolist()))[:200000]
+    snapshot = create_test_snapshot(tags, [''] * len(tags), rng.integers(0, 1000, len(tags)).astype(float))
+    index = TagCompletionIndex(['tag', 'translate_cn'])
+    index.rebuild(snapshot)
+    index.complete('b')
+
+    elapsed = []
+    for tag in rng.choice(tags, 300):
+        for length in range(1, len(tag) + 1):
+            start = time.perf_counter()
+            index.complete(tag[:length])
+            elapsed.append(time.perf_counter() - start)
+    elapsed = np.array(elapsed)
+    print(f'Completion of 200k keys: {len(elapsed)} keystrokes, mean {elapsed.mean() * 1000:.3f} ms, '
+          f'99% {np.percentile(elapsed, 99) * 1000:.3f} ms, max {elapsed.max() * 1000:.3f} ms')
+    assert np.percentile(elapsed, 99) < 0.001
+
+
+def main():
+    test_completion_update()
+    test_completion_keystroke_time()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+import os
+import json
+import math
+
+import pandas as pd
+
+from df_utility import set_dataframe_values
+
+
+class TagJournal:
+    """
+    An append-only write-ahead journal of row level changes for the tag database.
+    Each line is a json record. Either {"upsert": {field: value, ...}} or {"delete": primary_key}.
+    The journal is replayed on the loaded csv data and folded back into the csv files by compaction.
+    """
+
+    def __init__(self, journal_file: str, primary_key: str):
+        self.__journal_file = journal_file
+        self.__primary_key = primary_key
+        self.__record_count = len(self.read_records())
+
+    def journal_file(self) -> str:
+        return self.__journal_file
+
+    def record_count(self) -> int:
+        return self.__record_count
+
+    def append(self, upsert_rows: [dict], delete_keys: [str]):
+        if len(upsert_rows) == 0 and len(delete_keys) == 0:
+            return
+        # NaN of the numeric fields is written as null to keep the journal valid json
+        upsert_rows = [{key: None if isinstance(value, float) and math.isnan(value) else value
+                        for key, value in row.items()} for row in upsert_rows]
+        lines = [json.dumps({'upsert': row}, ensure_ascii=False, default=str) for row in upsert_rows] + \
+                [json.dumps({'delete': key}, ensure_ascii=False, default=str) for key in delete_keys]
+        with open(self.__journal_file, 'at', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.__record_count += len(lines)
+
+    def clear(self):
+        try:
+            os.remove(self.__journal_file)
+        except FileNotFoundError:
+            pass
+        self.__record_count = 0
+
+    def read_records(self) -> [dict]:
+        records = []
+        try:
+            with open(self.__journal_file, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if line == '':
+                        continue
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # The last line may be half written if the app was killed. Ignore it.
+                        print('Warning: Skip broken journal record: ' + line)
+        except FileNotFoundError:
+            pass
+        return records
+
+    def replay(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Apply the journal records on the dataframe. The later record of the same primary key wins.
+        :param df: The dataframe loaded from the csv files.
+        :return: The dataframe with journal applied.
+        """
+        primary_key = self.__primary_key
+
+        # Fold the records so that only the final operation of each primary key is kept
+        final_operation = {}
+        records = self.read_records()
+        # The journal may be appended by other instances
+        self.__record_count = len(records)
+        for record in records:
+            if 'upsert' in record:
+                row = record['upsert']
+                final_operation[row.get(primary_key, '')] = row
+            elif 'delete' in record:
+                final_operation[record['delete']] = None
+        if len(final_operation) == 0:
+            return df
+
+        delete_keys = [key for key, row in final_operation.items() if row is None]
+        upsert_rows = [row for row in final_operation.values() if row is not None]
+
+        if len(delete_keys) > 0:
+            df = df[~df[primary_key].isin(delete_keys)].reset_index(drop=True)
+
+        if len(upsert_rows) > 0:
+            df_upsert = pd.DataFrame(upsert_rows)
+            positions = pd.Index(df[primary_key]).get_indexer(df_upsert[primary_key])
+            exists = positions >= 0
+
+            # Update the existing rows in place so that the row order keeps the same as csv
+            if exists.any():
+                for column in df_upsert.columns:
+                    set_dataframe_values(df, df.index[positions[exists]], column, df_upsert.loc[exists, column].values)
+            # Append the new rows at the end
+            if (~exists).any():
+                df = pd.concat([df, df_upsert[~exists]], ignore_index=True)
+        return df
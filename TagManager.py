@@ -1,8 +1,19 @@
+import os
 import re
+import pickle
+import tempfile
+import threading
+import numpy as np
 import pandas as pd
 from collections import OrderedDict
 
 from app_utility import *
+from TagJournal import TagJournal
+from TagIndex import TagIndex, TagPathIndex, TagLabelIndex, TagNgramIndex, TagFuzzyIndex, TagCompletionIndex
+from TagStatistics import TagStatistics
+from TagStorage import CsvTagStorage, SqliteTagStorage, load_csv_database, save_csv_database
+from df_utility import compact_dataframe, set_dataframe_values, dataframe_memory_report, value_to_text, \
+    concat_dataframes_keeping_categories, copy_on_write
 
 PRIMARY_KEY = 'tag'
 
@@ -20,110 +31,906 @@ DATABASE_SUPPORT_FIELD = OrderedDict([
 
 DATABASE_FIELDS = list(DATABASE_SUPPORT_FIELD.keys())
 
+# The fields of full text search
+SEARCH_FIELDS = [PRIMARY_KEY, 'translate_cn', 'comments']
+
+# The fields that a typed prefix is completed by
+COMPLETION_FIELDS = [PRIMARY_KEY, 'translate_cn']
+
+# The in-memory representation of fields. Other fields are strings.
+CATEGORICAL_FIELDS = ['path', 'value', 'label', 'private']
+NUMERIC_FIELDS = ['weight', 'statistics']
+
+# Increase it when the in-memory representation is changed, so that the old snapshot cache is not used.
+SNAPSHOT_CACHE_VERSION = 5
+
+
+class TagChangeSet:
+    """
+    The changes of tag database between two notifications.
+        added:   The primary keys of the new rows.
+        updated: {primary key: set of changed fields} of the existing rows.
+        removed: The primary keys of the removed rows.
+    """
+
+    def __init__(self):
+        self.added = []
+        self.updated = {}
+        self.removed = []
+
+    def is_empty(self) -> bool:
+        return len(self.added) == 0 and len(self.updated) == 0 and len(self.removed) == 0
+
+    def changed_tags(self) -> set:
+        return set(self.added) | set(self.updated.keys()) | set(self.removed)
+
+    def changed_fields(self) -> set:
+        return set().union(*self.updated.values()) if len(self.updated) > 0 else set()
+
+    def merge(self, later):
+        """
+        Merge a later change set into this one, so that it's the changes of both.
+        :param later: The TagChangeSet after this one.
+        :return: self
+        """
+        added, removed = dict.fromkeys(self.added), dict.fromkeys(self.removed)
+        for tag in later.added:
+            if tag in removed:
+                # Removed then added back. The values may be different.
+                del removed[tag]
+                self.updated[tag] = set(DATABASE_FIELDS)
+            else:
+                added[tag] = None
+        for tag, fields in later.updated.items():
+            if tag not in added:
+                self.updated.setdefault(tag, set()).update(fields)
+        for tag in later.removed:
+            self.updated.pop(tag, None)
+            if tag in added:
+                del added[tag]
+            else:
+                removed[tag] = None
+        self.added, self.removed = list(added), list(removed)
+        return self
+
+    def discard(self, tags: [str]):
+        """
+        Forget the changes of tags, e.g. when they are the same as storage.
+        """
+        tags = set(tags)
+        self.added = [tag for tag in self.added if tag not in tags]
+        self.removed = [tag for tag in self.removed if tag not in tags]
+        for tag in tags:
+            self.updated.pop(tag, None)
+
+    def __repr__(self):
+        return f'TagChangeSet(added={self.added}, updated={self.updated}, removed={self.removed})'
+
+
+class TagSnapshot:
+    """
+    An immutable version of the tag database with its primary key index.
+    It can be read from any thread without lock, e.g. by the background workers of analysis and indexing.
+    The database and index must not be modified.
+    """
+
+    def __init__(self, version: int, database: pd.DataFrame, tag_index: dict):
+        self.version = version
+        self.database = database
+        self.tag_index = tag_index
+
+    def has_tag(self, primary_key: str) -> bool:
+        return primary_key in self.tag_index
+
+    def get_row_index(self, primary_key: str) -> int or None:
+        return self.tag_index.get(primary_key, None)
+
+    def get_property(self, primary_key: str, field: str):
+        index = self.tag_index.get(primary_key, None)
+        return '' if index is None else self.database.iat[index, self.database.columns.get_loc(field)]
+
+
+class TagEditSession:
+    """
+    A batch of database edits. Use it as a context manager:
+
+        with tag_manager.edit_session() as session:
+            for tag in tags:
+                session.set_property(tag, 'path', path)
+
+    The edits are staged and applied on exit. Then the database is verified, saved and the observers are notified
+    only once for the whole batch. The inform_database_modified() calls during the session are deferred as well.
+    If an exception is raised in the block or rollback() is called, the database is restored to the state
+    when the session began.
+
+    A nested session joins the outer one. Its edits go into the outer batch on exit,
+    and its rollback only discards its own staged edits.
+    """
+
+    def __init__(self, tag_manager, save: bool = True):
+        self.__tag_manager = tag_manager
+        self.__save = save
+        self.__staged_rows = OrderedDict()
+        self.__staged_frames = []
+        self.__removed_keys = set()
+        self.__rolled_back = False
+
+    def __enter__(self):
+        self.__tag_manager.begin_batch()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        rollback = self.__rolled_back or exc_type is not None
+        if rollback:
+            self.__staged_rows.clear()
+            self.__staged_frames.clear()
+            self.__removed_keys.clear()
+        self.__tag_manager.end_batch(
+            self.__staged_rows, self.__removed_keys, self.__save, rollback, self.__staged_frames)
+        return False
+
+    def set_property(self, primary_key: str, field: str, value):
+        """
+        Stage the value of a field. A new row is added if the primary key is not in database.
+        """
+        self.__removed_keys.discard(primary_key)
+        self.__staged_rows.setdefault(primary_key, {})[field] = value
+
+    def set_properties(self, primary_keys: [str], field: str, value):
+        """
+        Stage the same value of a field for a list of primary keys. E.g. bulk path assignment.
+        """
+        for primary_key in primary_keys:
+            self.set_property(primary_key, field, value)
+
+    def upsert_row(self, row: dict):
+        """
+        Stage a row as dict. The fields not in the row keep their value for an existing row.
+        """
+        primary_key = row[PRIMARY_KEY]
+        self.__removed_keys.discard(primary_key)
+        self.__staged_rows.setdefault(primary_key, {}).update(
+            {field: value for field, value in row.items() if field != PRIMARY_KEY})
+
+    def upsert_dataframe(self, df: pd.DataFrame):
+        """
+        Stage a dataframe of rows, which is applied by column assignment. Use it for bulk edits like import.
+        The columns not in df keep their value for the existing rows.
+        The dataframes are applied before the edits staged by other functions.
+        """
+        self.__staged_frames.append(df.drop_duplicates(subset=[PRIMARY_KEY], keep='last'))
+
+    def remove(self, primary_keys: [str]):
+        for primary_key in primary_keys:
+            self.__staged_rows.pop(primary_key, None)
+            self.__removed_keys.add(primary_key)
+
+    def staged_count(self) -> int:
+        return len(self.__staged_rows) + len(self.__removed_keys) + sum(len(df) for df in self.__staged_frames)
+
+    def rollback(self):
+        """
+        Discard the staged edits and restore the database when the session exits.
+        """
+        self.__rolled_back = True
+
 
 class TagManager:
-    def __init__(self, public_db: str, private_db: str, backup_limit: int):
-        self.__public_db = public_db
-        self.__private_db = private_db
+    def __init__(self, public_db: str, private_db: str, backup_limit: int,
+                 journal_limit: int = 1000, save_delay: float = 1.0, storage=None, load_progress: callable = None,
+                 dictionary=None):
+        """
+        :param storage: The storage backend that supports load(progress, normalise),
+                        save_changes(df, changed_df, deleted_keys), compact(df), close(df), signature(),
+                        snapshot_cache_file(), has_external_changes() and accept_current_state().
+                        If None, use the csv pair (public_db, private_db) with journal.
+        :param load_progress: Called as load_progress(done, total) while loading the storage.
+                              It's called from the thread that constructs TagManager.
+        :param dictionary: The read-only shared dictionary that supports select_rows(primary_keys) and
+                           query(field, value, prefix), e.g. SqliteTagStorage. It's not loaded into memory.
+                           The tags not in database are looked up in it by lookup_rows().
+        """
+        self.__dictionary = dictionary
         self.__database_observers = []
-        self.__backup_limit = backup_limit
-        self.__tag_database = TagManager.load_tag_data(public_db, private_db)
-        self.__verify_database()
+        self.__notification_scheduler = None
+        self.__notification_pending = False
+        self.__batch_depth = 0
+        self.__batch_origin = None
+        self.__batch_modified = False
+        self.__batch_save = False
+        # The changes of the staged edits in batch. None if a frame is informed, then the changes are diffed.
+        self.__batch_change_set = None
+        self.__snapshot = None
+        self.__publish_lock = threading.Lock()
+        self.__storage = storage if storage is not None else \
+            CsvTagStorage(public_db, private_db, DATABASE_FIELDS, backup_limit, journal_limit)
+        self.__tag_index = {}
+        self.__secondary_indexes = {}
+        # The states of secondary indexes from snapshot cache, which are used instead of rebuild.
+        self.__cached_index_states = {}
+        # The changes that observers have not seen
+        self.__pending_change_set = TagChangeSet()
+        # The changes that are not written to storage. It's taken by the save worker.
+        self.__unsaved_change_set = TagChangeSet()
+        self.__save_pending = False
+        self.__save_lock = threading.Lock()
+        self.__pending_lock = threading.Lock()
+
+        # Use the snapshot cache if the storage is not changed since the cache was written
+        storage_signature = self.__storage.signature()
+        snapshot = self.__load_snapshot_cache(storage_signature)
+        if snapshot is not None:
+            self.__tag_database, self.__cached_index_states = snapshot
+            self.__storage.accept_current_state()
+            self.__rebuild_index()
+        else:
+            # Compact each chunk as it's loaded to keep the peak memory low
+            self.__tag_database = self.__storage.load(load_progress, TagManager.compact_chunk)
+            self.__verify_database(True)
+            self.__save_snapshot_cache(storage_signature)
+
+        self.__publish_snapshot()
+
+        self.__path_index = TagPathIndex(field='path', primary_key=PRIMARY_KEY)
+        self.register_index('path', self.__path_index)
+        self.__label_index = TagLabelIndex(field='label', primary_key=PRIMARY_KEY)
+        self.register_index('label', self.__label_index)
+        self.__search_index = TagNgramIndex(SEARCH_FIELDS, primary_key=PRIMARY_KEY)
+        self.register_index('search', self.__search_index)
+        self.__fuzzy_index = TagFuzzyIndex(primary_key=PRIMARY_KEY, rank_field='statistics')
+        self.register_index('fuzzy', self.__fuzzy_index)
+        self.__completion_index = TagCompletionIndex(
+            COMPLETION_FIELDS, primary_key=PRIMARY_KEY, rank_field='statistics')
+        self.register_index('completion', self.__completion_index)
+        # The cached states are only valid for the loaded frame
+        self.__cached_index_states = {}
+        self.__statistics = TagStatistics(self, field='statistics', primary_key=PRIMARY_KEY)
+
+        # The save is done by a background worker on the snapshot of database
+        self.__save_worker = DebounceWorker(self.__do_save_database, save_delay)
 
     def get_database(self) -> pd.DataFrame:
+        """
+        The current database of the UI thread. The frame is copy-on-write, it's never modified in place
+        once published. Do not modify it in place, use edit_session() or inform_database_modified() with a new frame.
+        For the other threads, use get_snapshot().
+        """
         return self.__tag_database
 
+    def get_snapshot(self) -> TagSnapshot:
+        """
+        Get the latest published version of database. It's cheap, no copy.
+        """
+        with self.__publish_lock:
+            return self.__snapshot
+
+    def get_version(self) -> int:
+        with self.__publish_lock:
+            return self.__snapshot.version
+
+    def get_storage(self):
+        return self.__storage
+
+    def get_tag_statistics(self) -> TagStatistics:
+        """
+        The collector of tag usage. The counts are written to the 'statistics' field by its flush().
+        """
+        return self.__statistics
+
     def save_database(self):
-        backup_file_safe(self.__public_db, self.__backup_limit)
-        backup_file_safe(self.__private_db, self.__backup_limit)
-        TagManager.save_tag_data(self.__tag_database, self.__public_db, self.__private_db)
+        """
+        Schedule a save of the database. Modifications in a burst are coalesced into one save,
+        which runs on a background thread after a quiet period of save_delay seconds.
+        :return: None
+        """
+        with self.__pending_lock:
+            self.__save_pending = True
+        self.__save_worker.trigger()
+
+    def flush_database(self):
+        """
+        Run the pending save immediately and wait until it finishes.
+        :return: None
+        """
+        self.__save_worker.flush()
+
+    def compact_database(self):
+        """
+        Fold the incremental changes into the storage. For csv storage, the journal is folded into the csv files.
+        :return: None
+        """
+        self.flush_database()
+        with self.__save_lock:
+            self.__storage.compact(self.__tag_database)
+
+    def close(self):
+        """
+        Should be called on application exit. Flush the pending statistics and save, then close the storage.
+        :return: None
+        """
+        self.__statistics.flush()
+        self.flush_database()
+        self.__save_worker.stop()
+        with self.__save_lock:
+            self.__storage.close(self.__tag_database)
+            # Only cache the frame when it is the same as what in storage (no unsaved modification).
+            with self.__pending_lock:
+                saved = self.__unsaved_change_set.is_empty()
+            if saved:
+                self.__save_snapshot_cache(self.__storage.signature())
+
+    def edit_session(self, save: bool = True) -> TagEditSession:
+        """
+        Create a batch edit session. See TagEditSession.
+        :param save: Save the database when the session is committed.
+        :return: TagEditSession that should be used by 'with' statement.
+        """
+        return TagEditSession(self, save)
+
+    def begin_batch(self):
+        if self.__batch_depth == 0:
+            self.__batch_origin = self.__tag_database
+            self.__batch_modified = False
+            self.__batch_save = False
+            self.__batch_change_set = TagChangeSet()
+        self.__batch_depth += 1
+
+    def end_batch(self, staged_rows: dict, removed_keys: set, save: bool, rollback: bool,
+                  staged_frames: [pd.DataFrame] = None):
+        """
+        Apply the staged edits of a session. The outermost session commits or rolls back the whole batch.
+        :param staged_rows: {primary key: {field: value}}
+        :param removed_keys: The primary keys to remove.
+        :param save: Save the database on commit.
+        :param rollback: Restore the database to the state when the outermost session began.
+        :param staged_frames: The dataframes of rows to upsert.
+        """
+        for frame in (staged_frames or []):
+            self.__apply_staged_frame(frame)
+            self.__batch_modified = True
+            self.__batch_save = self.__batch_save or save
+        if len(staged_rows) > 0 or len(removed_keys) > 0:
+            self.__apply_staged_edits(staged_rows, removed_keys)
+            self.__batch_modified = True
+            self.__batch_save = self.__batch_save or save
+
+        self.__batch_depth -= 1
+        if self.__batch_depth > 0:
+            return
+
+        origin, self.__batch_origin = self.__batch_origin, None
+        change_set, self.__batch_change_set = self.__batch_change_set, None
+        if rollback:
+            self.__tag_database = origin
+            self.__rebuild_index()
+        elif self.__batch_modified:
+            self.__commit_modification(change_set, self.__batch_save)
+
+    def check_external_changes(self) -> bool:
+        """
+        Merge the changes of storage by others (other app instances, scripts or editors) into the database.
+        Only the changed rows are applied, and the observers are notified. It's cheap if nothing is changed,
+        so call it periodically.
+        :return: True if there are external changes.
+        """
+        if not self.__storage.has_external_changes():
+            return False
+
+        # Write the local changes first. Then the storage has the latest of both sides.
+        self.flush_database()
+        with self.__save_lock:
+            storage_df = self.__storage.load(None, TagManager.compact_chunk)
+        storage_df = storage_df.drop_duplicates(subset=[PRIMARY_KEY], keep='first').reset_index(drop=True)
+
+        # After flush, only the modifications without save are not in storage. Keep them, take the others.
+        external_changes = TagManager.diff_database(self.__tag_database, storage_df)
+        with self.__pending_lock:
+            local_tags = self.__unsaved_change_set.changed_tags()
+        changed_tags = [tag for tag in external_changes.added + list(external_changes.updated.keys())
+                        if tag not in local_tags]
+        removed_keys = [tag for tag in external_changes.removed if tag not in local_tags]
+
+        if len(changed_tags) > 0 or len(removed_keys) > 0:
+            with self.edit_session(save=False) as session:
+                session.upsert_dataframe(storage_df[storage_df[PRIMARY_KEY].isin(changed_tags)])
+                session.remove(removed_keys)
+            # They are the same as storage, nothing to save.
+            with self.__pending_lock:
+                self.__unsaved_change_set.discard(changed_tags + removed_keys)
+        return True
 
     def inform_database_modified(self, new_df: pd.DataFrame or None, save: bool):
         if new_df is not None:
             self.__tag_database = new_df
-        self.__tag_database = self.__tag_database.reindex().fillna('')
-        self.__verify_database()
-        if save:
-            self.save_database()
-        for ob in self.__database_observers:
-            ob.on_database_changed()
+
+        # Defer the verification, save and notification to the end of batch
+        if self.__batch_depth > 0:
+            self.__batch_modified = True
+            self.__batch_save = self.__batch_save or save
+            if new_df is not None:
+                self.__batch_change_set = None
+                self.__rebuild_index()
+            return
+        self.__commit_modification(None, save)
 
     def register_database_observer(self, ob):
         """
         The observer should support following functions:
-            def on_database_changed()
+            def on_database_changed(change_set: TagChangeSet)
         :param ob: Observer
         :return:
         """
         self.__database_observers.append(ob)
 
+    def set_notification_scheduler(self, scheduler: callable or None):
+        """
+        Set the function to defer the observer notification, e.g. lambda fn: QTimer.singleShot(0, fn).
+        All modifications before the deferred call are delivered in one change set.
+        If None (default), observers are notified synchronously in inform_database_modified().
+        :param scheduler: The function that accepts a callable and calls it later.
+        :return: None
+        """
+        self.__notification_scheduler = scheduler
+
+    def notify_database_observers(self):
+        self.__notification_pending = False
+        change_set, self.__pending_change_set = self.__pending_change_set, TagChangeSet()
+        if not change_set.is_empty():
+            for ob in self.__database_observers:
+                ob.on_database_changed(change_set)
+
+    def register_index(self, name: str, index: TagIndex):
+        """
+        Register a secondary index. It's built from the current snapshot and updated on each published change.
+        If the index supports get_state(), it's saved with the snapshot cache and restored at the next startup.
+        :param name: The unique name of index.
+        :param index: The TagIndex
+        :return: None
+        """
+        if not index.set_state(self.get_snapshot(), self.__cached_index_states.get(name, None)):
+            index.rebuild(self.get_snapshot())
+        self.__secondary_indexes[name] = index
+
+    def get_paths(self) -> [str]:
+        """
+        Get all the tag paths of database (parts joined by '/'), parent first.
+        """
+        return self.__path_index.get_paths()
+
+    def get_path_tree_version(self) -> int:
+        """
+        The version of the path hierarchy. It only changes when a path is added or removed.
+        """
+        return self.__path_index.structure_version()
+
+    def get_path_tags(self, path: str, include_sub_path: bool = False) -> [str]:
+        """
+        Get the tags of a path by the path index.
+        :param path: The path like 'scene/outdoor'.
+        :param include_sub_path: Also include the tags of all the sub paths.
+        :return: The list of tags in the database order.
+        """
+        tags = self.__path_index.get_tags(path, include_sub_path)
+        return sorted(tags, key=self.__tag_index.__getitem__)
+
+    def count_path_tags(self, path: str, include_sub_path: bool = False) -> int:
+        return self.__path_index.count_tags(path, include_sub_path)
+
+    def search_tags(self, text: str, limit: int = 0) -> [str]:
+        """
+        Full text search of tag, translation and comments by the n-gram index. Case insensitive substring match.
+        :param text: The text to search.
+        :param limit: The max number of results. 0 for no limit.
+        :return: The tags ordered by: tag equals text, tag starts with text, tag contains text, others.
+                 Then by the database order.
+        """
+        text = text.strip().lower()
+        tags = self.__search_index.search(text)
+
+        def rank(tag: str) -> (int, int):
+            lower_tag = tag.lower()
+            level = 0 if lower_tag == text else 1 if lower_tag.startswith(text) else 2 if text in lower_tag else 3
+            return level, self.__tag_index[tag]
+        tags = sorted(tags, key=rank)
+        return tags[:limit] if limit > 0 else tags
+
+    def suggest_tags(self, words: [str], limit: int = 3) -> dict:
+        """
+        Find the similar tags (edit distance <= 2) for the words, like the misspelled tags of a prompt.
+        The fuzzy index is built at the first call.
+        :param words: The words to look up in one pass.
+        :param limit: The max number of suggestions of each word.
+        :return: {word: [tag, ...]} ordered by distance then statistics. The words without suggestion are absent.
+        """
+        return self.__fuzzy_index.suggest(words, limit)
+
+    def complete_tags(self, prefix: str, limit: int = 10) -> [str]:
+        """
+        Complete a typed prefix to tags by the tag or its translation. The completion index is built at the first call.
+        :param prefix: The typed text, case insensitive.
+        :param limit: The max number of tags.
+        :return: The tags ordered by statistics (descending), then shorter first.
+        """
+        return self.__completion_index.complete(prefix, limit)
+
+    def get_labels(self) -> [str]:
+        """
+        Get all the labels (收藏夹) of database. A label cell can have multiple labels separated by ','.
+        """
+        return self.__label_index.get_labels()
+
+    def get_label_version(self) -> int:
+        """
+        The version of label index. It changes when any tag joins or leaves a label.
+        """
+        return self.__label_index.version()
+
+    def get_label_tags(self, label: str) -> [str]:
+        """
+        Get the tags of a label by the label index.
+        :param label: A single label.
+        :return: The list of tags in the database order.
+        """
+        tags = self.__label_index.get_tags(label)
+        return sorted(tags, key=self.__tag_index.__getitem__)
+
+    def count_label_tags(self, label: str) -> int:
+        return self.__label_index.count_tags(label)
+
+    def get_tag_labels(self, primary_key: str) -> [str]:
+        return self.__label_index.get_tag_labels(primary_key)
+
+    def memory_report(self) -> pd.DataFrame:
+        """
+        The memory usage of tag database by column.
+        :return: Dataframe of [column, dtype, bytes] with a 'Total' row at the end.
+        """
+        return dataframe_memory_report(self.__tag_database)
+
+    def has_tag(self, primary_key: str) -> bool:
+        return primary_key in self.__tag_index
+
+    def get_row_index(self, primary_key: str) -> int or None:
+        """
+        Get the row position of a primary key in the tag database by the hash index.
+        :param primary_key: str
+        :return: The row position. None if the primary key is not found.
+        """
+        return self.__tag_index.get(primary_key, None)
+
+    def select_rows(self, primary_keys: [str]) -> pd.DataFrame:
+        """
+        Select the rows of the primary keys by the hash index. The primary keys not found are ignored.
+        Merge with the result instead of the whole database to avoid hashing all the primary keys.
+        :param primary_keys: The list of primary keys.
+        :return: The rows as dataframe.
+        """
+        positions = [self.__tag_index[key] for key in dict.fromkeys(primary_keys) if key in self.__tag_index]
+        return self.__tag_database.iloc[positions]
+
+    def lookup_rows(self, primary_keys: [str]) -> pd.DataFrame:
+        """
+        Select the rows of the primary keys from database, and the ones not in database from the shared dictionary.
+        Only the missing keys are queried by the index of dictionary. Use it to show the information of tags.
+        :param primary_keys: The list of primary keys.
+        :return: The rows as dataframe. The database rows come first.
+        """
+        rows = self.select_rows(primary_keys)
+        if self.__dictionary is None:
+            return rows
+        missing_keys = [key for key in dict.fromkeys(primary_keys) if key not in self.__tag_index]
+        if len(missing_keys) == 0:
+            return rows
+        return self.__append_dictionary_rows(rows, self.__dictionary.select_rows(missing_keys))
+
+    def query_dictionary(self, field: str, value: str, prefix: bool = False) -> pd.DataFrame:
+        """
+        Query the shared dictionary by the index of a field, e.g. all the tags under a path.
+        The tags in database are taken from database.
+        :return: The rows as dataframe. Empty if there's no dictionary.
+        """
+        rows = self.__tag_database.iloc[:0]
+        if self.__dictionary is None:
+            return rows
+        dictionary_rows = self.__dictionary.query(field, value, prefix)
+        in_database = dictionary_rows[PRIMARY_KEY].isin(self.__tag_index.keys()).values
+        return self.__append_dictionary_rows(
+            self.select_rows(dictionary_rows[PRIMARY_KEY].values[in_database]), dictionary_rows[~in_database])
+
+    def get_row(self, primary_key: str) -> pd.Series or None:
+        """
+        Get the whole row of a given primary key from the tag database.
+        :param primary_key: str
+        :return: The row as Series. None if the primary key is not found.
+        """
+        index = self.__tag_index.get(primary_key, None)
+        return None if index is None else self.__tag_database.iloc[index]
+
+    def get_default_weights(self, primary_keys: [str]) -> np.ndarray:
+        """
+        Get the default weight of the primary keys in database as a float array.
+        The weight of primary keys not found or without default weight is 1.0.
+        """
+        positions = np.fromiter((self.__tag_index.get(key, -1) for key in primary_keys), dtype=np.int64)
+        found = positions >= 0
+        weights = np.ones(len(positions), dtype=np.float64)
+        if found.any():
+            weights[found] = pd.to_numeric(self.__tag_database['weight'].iloc[positions[found]],
+                                           errors='coerce').to_numpy(dtype=np.float64)
+        weights[np.isnan(weights)] = 1.0
+        return weights
+
     def get_property(self, primary_key: str, field: str) -> str:
         """
         Get the value of a field for a given primary key from the tag database.
-        If the primary key is not found, return an empty string.
+        If the primary key is not found or the value is empty, return an empty string.
         :param primary_key: str
         :param field: str
-        :return: str
+        :return: str. The numeric fields are the text of number, e.g. '1.2'.
         """
-        try:
-            return self.__tag_database.loc[self.__tag_database[PRIMARY_KEY] == primary_key, field].values[0]
-        except IndexError:
+        index = self.__tag_index.get(primary_key, None)
+        if index is None:
             return ''
+        return value_to_text(self.__tag_database.iat[index, self.__tag_database.columns.get_loc(field)])
 
     # ------------------------------------------------------------------------------------------------------------------
 
-    def __verify_database(self):
+    def __commit_modification(self, change_set: TagChangeSet or None, save: bool):
+        # The empty values are filled by the compaction, which keeps NaN for the numeric fields.
+        # The index is kept up to date by the staged edits, unless the frame is replaced as a whole.
+        self.__verify_database(rebuild_index=change_set is None)
+        self.__publish_snapshot(change_set)
+        if save:
+            self.save_database()
+
+        # Coalesce the modifications in one event loop tick into one notification if there's a scheduler
+        if self.__notification_scheduler is None:
+            self.notify_database_observers()
+        elif not self.__notification_pending:
+            self.__notification_pending = True
+            self.__notification_scheduler(self.notify_database_observers)
+
+    def __do_save_database(self):
+        # Save the rows changed since last save to storage. The cost is proportional to the size of the change.
+        with self.__pending_lock:
+            if not self.__save_pending:
+                return
+            self.__save_pending = False
+            # The snapshot has all the changes in the change set. The later changes are saved next time.
+            snapshot = self.get_snapshot()
+            change_set, self.__unsaved_change_set = self.__unsaved_change_set, TagChangeSet()
+
+        positions = [snapshot.tag_index[tag] for tag in change_set.added + list(change_set.updated.keys())
+                     if tag in snapshot.tag_index]
+        try:
+            with self.__save_lock:
+                if len(positions) > 0 or len(change_set.removed) > 0:
+                    self.__storage.save_changes(
+                        snapshot.database, snapshot.database.iloc[sorted(positions)], change_set.removed)
+        except Exception:
+            # Keep the changes to save them next time
+            with self.__pending_lock:
+                self.__unsaved_change_set = change_set.merge(self.__unsaved_change_set)
+            raise
+
+    def __apply_staged_edits(self, staged_rows: dict, removed_keys: set):
+        df = self.__tag_database
+
+        # Group the updates of existing rows by field so that each field is assigned in one operation
+        field_updates = {}
+        new_rows = []
+        for primary_key, fields in staged_rows.items():
+            position = self.__tag_index.get(primary_key, None)
+            if position is None:
+                new_rows.append(dict(fields, **{PRIMARY_KEY: primary_key}))
+                continue
+            for field, value in fields.items():
+                positions, values = field_updates.setdefault(field, ([], []))
+                positions.append(position)
+                values.append(value)
+
+        # Copy on write. The published frame is not changed.
+        df = copy_on_write(df, list(field_updates.keys()))
+        for field, (positions, values) in field_updates.items():
+            set_dataframe_values(df, df.index[positions], field, values)
+
+        change_set = TagChangeSet()
+        change_set.added = [row[PRIMARY_KEY] for row in new_rows]
+        change_set.updated = {primary_key: set(fields.keys()) for primary_key, fields in staged_rows.items()
+                              if primary_key in self.__tag_index and len(fields) > 0}
+        change_set.removed = [primary_key for primary_key in removed_keys if primary_key in self.__tag_index]
+        self.__track_batch_changes(change_set)
+
+        # The rows before the first removed one keep their positions
+        start = min([len(df)] + [self.__tag_index[primary_key] for primary_key in change_set.removed])
+        if len(new_rows) > 0:
+            df = pd.concat([df, pd.DataFrame(new_rows)], ignore_index=True)
+        if len(removed_keys) > 0:
+            df = df[~df[PRIMARY_KEY].isin(removed_keys)].reset_index(drop=True)
+
+        self.__tag_database = df
+        if len(new_rows) > 0 or len(change_set.removed) > 0:
+            self.__update_index(start, change_set.removed)
+
+    def __apply_staged_frame(self, frame: pd.DataFrame):
+        df = self.__tag_database
+        positions = np.fromiter((self.__tag_index.get(key, -1) for key in frame[PRIMARY_KEY].values),
+                                dtype=np.int64, count=len(frame))
+        exists = positions >= 0
+
+        change_set = TagChangeSet()
+        fields = set(field for field in frame.columns if field != PRIMARY_KEY)
+        change_set.added = list(frame[PRIMARY_KEY].values[~exists])
+        change_set.updated = {primary_key: set(fields) for primary_key in frame[PRIMARY_KEY].values[exists]} \
+            if len(fields) > 0 else {}
+        self.__track_batch_changes(change_set)
+
+        if exists.any():
+            # Copy on write. The published frame is not changed.
+            df = copy_on_write(df, [field for field in frame.columns if field != PRIMARY_KEY])
+            self.__tag_database = df
+            rows = df.index[positions[exists]]
+            for field in frame.columns:
+                if field != PRIMARY_KEY:
+                    set_dataframe_values(df, rows, field, frame[field].values[exists])
+        if not exists.all():
+            start = len(df)
+            new_rows = compact_dataframe(frame[~exists], CATEGORICAL_FIELDS, NUMERIC_FIELDS)
+            df = concat_dataframes_keeping_categories([df, new_rows])
+            self.__tag_database = df
+            self.__update_index(start)
+
+    def __append_dictionary_rows(self, rows: pd.DataFrame, dictionary_rows: pd.DataFrame) -> pd.DataFrame:
+        if dictionary_rows.empty:
+            return rows
+        dictionary_rows = TagManager.compact_chunk(dictionary_rows.reindex(columns=self.__tag_database.columns))
+        return concat_dataframes_keeping_categories([rows, dictionary_rows]).reset_index(drop=True)
+
+    def __track_batch_changes(self, change_set: TagChangeSet):
+        if self.__batch_change_set is not None:
+            self.__batch_change_set.merge(change_set)
+
+    def __load_snapshot_cache(self, storage_signature: str) -> (pd.DataFrame, dict) or None:
+        # The cache file is three pickles: the key first, so the frame is only unpickled when the key matches.
+        # Then the frame, and the states of secondary indexes {name: state}.
+        try:
+            with open(self.__storage.snapshot_cache_file(), 'rb') as f:
+                if pickle.load(f) != (storage_signature, DATABASE_FIELDS, SNAPSHOT_CACHE_VERSION):
+                    return None
+                return pickle.load(f), pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print('Load snapshot cache fail.')
+            print(e)
+            return None
+        finally:
+            pass
+
+    def __save_snapshot_cache(self, storage_signature: str):
+        index_states = {name: index.get_state() for name, index in self.__secondary_indexes.items()}
+        index_states = {name: state for name, state in index_states.items() if state is not None}
+
+        def write_cache(file_name: str):
+            with open(file_name, 'wb') as f:
+                pickle.dump((storage_signature, DATABASE_FIELDS, SNAPSHOT_CACHE_VERSION), f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+                pickle.dump(self.__tag_database, f, protocol=pickle.HIGHEST_PROTOCOL)
+                pickle.dump(index_states, f, protocol=pickle.HIGHEST_PROTOCOL)
+        try:
+            replace_file_atomic(self.__storage.snapshot_cache_file(), write_cache)
+        except Exception as e:
+            print('Save snapshot cache fail.')
+            print(e)
+        finally:
+            pass
+
+    def __verify_database(self, intern_strings: bool = False, rebuild_index: bool = True):
+        self.__tag_database = compact_dataframe(
+            self.__tag_database, CATEGORICAL_FIELDS, NUMERIC_FIELDS, intern_strings, PRIMARY_KEY)
         duplicates = self.__tag_database.duplicated(subset=[PRIMARY_KEY], keep='first')
         duplicate_rows = self.__tag_database[duplicates]
         if len(duplicate_rows) > 0:
             print('Warning: Duplicate row found.')
             print(duplicate_rows)
             self.__tag_database = self.__tag_database.drop_duplicates(subset=[PRIMARY_KEY], keep='first')
+            rebuild_index = True
         if 'level_0' in self.__tag_database.columns:
             print('Warning: Found level_0 column. There may be a missing drop=True '
                   'parameter in a call to reset_index() somewhere.')
             self.__tag_database = self.__tag_database.drop('level_0', axis=1)
-        self.__tag_database = self.__tag_database.reset_index(drop=True)
+        if not self.__tag_database.index.equals(pd.RangeIndex(len(self.__tag_database))):
+            self.__tag_database = self.__tag_database.reset_index(drop=True)
+            rebuild_index = True
+        if rebuild_index:
+            self.__rebuild_index()
+
+    def __publish_snapshot(self, change_set: TagChangeSet or None = None):
+        """
+        :param change_set: The changes from the previous snapshot. If None, they are diffed from the frames.
+        """
+        with self.__publish_lock:
+            previous = self.__snapshot
+            version = 0 if previous is None else previous.version + 1
+            self.__snapshot = TagSnapshot(version, self.__tag_database, self.__tag_index)
+        if previous is None or previous.database is self.__tag_database:
+            return
+
+        # The changes are applied to the secondary indexes at once, and delivered to the observers later.
+        if change_set is None:
+            change_set = TagManager.diff_database(previous.database, self.__tag_database)
+        if change_set.is_empty():
+            return
+        for index in self.__secondary_indexes.values():
+            index.update(self.__snapshot, change_set)
+        self.__pending_change_set.merge(change_set)
+        with self.__pending_lock:
+            self.__unsaved_change_set.merge(change_set)
+
+    def __rebuild_index(self):
+        # The index is reset by __verify_database, so the row label is the same as the row position.
+        self.__tag_index = dict(zip(self.__tag_database[PRIMARY_KEY].values, range(len(self.__tag_database))))
+
+    def __update_index(self, start: int, removed_keys=()):
+        """
+        Update the index for the changed rows only: the removed keys, and the rows from position start,
+        which are appended or moved by the removal. The rows before start are not changed.
+        """
+        if self.__snapshot is not None and self.__snapshot.tag_index is self.__tag_index:
+            # The published snapshot keeps its own index. Copying a dict is much cheaper than a rebuild.
+            self.__tag_index = self.__tag_index.copy()
+        for primary_key in removed_keys:
+            self.__tag_index.pop(primary_key, None)
+        tags = self.__tag_database[PRIMARY_KEY].values[start:]
+        self.__tag_index.update(zip(tags, range(start, start + len(tags))))
 
     # ------------------------------------------------------------------------------------------------------------------
 
     @staticmethod
-    def load_tag_data(public_db: str, private_db: str) -> pd.DataFrame:
-        # Load public.csv to df_public if it exists
-        try:
-            df_public = pd.read_csv(public_db)
-        except FileNotFoundError:
-            df_public = pd.DataFrame(columns=[PRIMARY_KEY])
-
-        # Load private.csv to df_private if it exists
-        try:
-            df_private = pd.read_csv(private_db)
-        except FileNotFoundError:
-            df_private = pd.DataFrame(columns=[PRIMARY_KEY])
+    def diff_database(old_df: pd.DataFrame, new_df: pd.DataFrame) -> TagChangeSet:
+        """
+        Compare two verified tag databases (primary key is unique) by value.
+        :param old_df: The old database
+        :param new_df: The new database
+        :return: The TagChangeSet from old_df to new_df
+        """
+        change_set = TagChangeSet()
+        old_tags = old_df[PRIMARY_KEY].values
+        new_tags = new_df[PRIMARY_KEY].values
 
-        # Join df_public and df_private by field "tag" to create df_tags
-        df_tags = pd.concat([df_public, df_private])
+        # Fast path for the most case: the rows are the same, only values are changed.
+        if len(old_tags) == len(new_tags) and (old_tags == new_tags).all():
+            old_positions = np.arange(len(new_tags))
+        else:
+            old_positions = pd.Index(old_tags).get_indexer(new_tags)
+            change_set.added = list(new_tags[old_positions < 0])
+            change_set.removed = list(old_tags[~pd.Index(old_tags).isin(new_tags)])
 
-        # Check if any of the required fields are missing in df_tags
-        if not set(DATABASE_FIELDS).issubset(df_tags.columns):
-            # Add the missing fields to df_tags
-            df_tags = df_tags.reindex(columns=DATABASE_FIELDS)
+        new_rows = np.nonzero(old_positions >= 0)[0]
+        old_rows = old_positions[new_rows]
+        for field in new_df.columns:
+            if field in old_df.columns:
+                new_values = new_df[field].to_numpy()[new_rows]
+                old_values = old_df[field].to_numpy()[old_rows]
+                changed = np.asarray(new_values != old_values, dtype=bool) & \
+                    ~(pd.isna(new_values) & pd.isna(old_values))
+            else:
+                changed = np.ones(len(new_rows), dtype=bool)
+            for tag in new_tags[new_rows[changed]]:
+                change_set.updated.setdefault(tag, set()).add(field)
+        return change_set
 
-        # Replace NaN or null values with empty strings
-        df_tags = df_tags.fillna('')
-        df_tags = df_tags.reset_index(drop=True)
+    @staticmethod
+    def compact_chunk(df: pd.DataFrame) -> pd.DataFrame:
+        return compact_dataframe(df, CATEGORICAL_FIELDS, NUMERIC_FIELDS)
 
-        return df_tags
+    @staticmethod
+    def load_tag_data(public_db: str, private_db: str, journal: TagJournal or None = None) -> pd.DataFrame:
+        return load_csv_database(public_db, private_db, DATABASE_FIELDS, journal)
 
     @staticmethod
     def save_tag_data(df: pd.DataFrame, public_db: str, private_db: str):
-        # Split the dataframe into two based on the value of the 'private' field
-        df_private = df[df['private'] == 'Y']
-        df_public = df[df['private'] != 'Y']
-
-        # Save the private and public dataframes to separate CSV files
-        df_public.to_csv(public_db, index=False, encoding='utf-8')
-        df_private.to_csv(private_db, index=False, encoding='utf-8')
+        save_csv_database(df, public_db, private_db)
 
     # @staticmethod
     # def parse_prompts(prompt_text: str):
@@ -216,7 +1023,7 @@ class TagManager:
             # Fill the table with data from the dataframe
             for row in range(len(dataframe)):
                 for col, field in enumerate(field_mapping.keys()):
-                    item_text = str(dataframe.loc[row, field])
+                    item_text = value_to_text(dataframe.loc[row, field])
                     # print(item_text, end=' ')
                     item = QTableWidgetItem(item_text)
 
@@ -232,7 +1039,50 @@ class TagManager:
         table_widget.sortByColumn(sort_column, sort_order)
 
     @staticmethod
-    def update_tag_path_tree(tree_widget, dataframe: pd.DataFrame, preset_path: list):
+    def update_table_widget_rows(
+            table_widget, dataframe: pd.DataFrame,
+            field_mapping: OrderedDict, primary_keys: set,
+            item_decorator: callable = None):
+        """
+        Update the items of the table rows whose primary key (the first column) is in primary_keys.
+        Other rows are not touched. The row of table may be different from dataframe because of sorting.
+        """
+
+        from PyQt5.QtWidgets import QTableWidget, QTableWidgetItem
+
+        table_widget: QTableWidget
+
+        if len(primary_keys) == 0 or dataframe.empty:
+            return
+
+        # Find the dataframe row of the changed primary keys
+        primary_keys = list(primary_keys)
+        positions = pd.Index(dataframe[PRIMARY_KEY].values).get_indexer(primary_keys)
+        df_rows = {key: pos for key, pos in zip(primary_keys, positions) if pos >= 0}
+        if len(df_rows) == 0:
+            return
+
+        sort_column = table_widget.horizontalHeader().sortIndicatorSection()
+        sort_order = table_widget.horizontalHeader().sortIndicatorOrder()
+
+        try:
+            for row in range(table_widget.rowCount()):
+                key_item = table_widget.item(row, 0)
+                if key_item is None or key_item.text() not in df_rows:
+                    continue
+                df_row = df_rows[key_item.text()]
+                for col, field in enumerate(field_mapping.keys()):
+                    item = QTableWidgetItem(value_to_text(dataframe.iloc[df_row][field]))
+                    if item_decorator is not None:
+                        item_decorator(row, col, item)
+                    table_widget.setItem(row, col, item)
+        except Exception as e:
+            print(e)
+
+        table_widget.sortByColumn(sort_column, sort_order)
+
+    @staticmethod
+    def update_tag_path_tree(tree_widget, paths: [str], preset_path: list) -> set:
         from PyQt5.QtWidgets import QTreeWidget, QTreeWidgetItem
 
         tree_widget: QTreeWidget
@@ -240,8 +1090,8 @@ class TagManager:
         # Clear the tree
         tree_widget.clear()
 
-        # Get unique path values from tag_database
-        unique_paths = unique_list(preset_path + list(dataframe['path'].unique()))
+        # The paths of database come from the path index, parent first
+        unique_paths = unique_list(preset_path + list(paths))
 
         # Loop through each unique path
         for path in unique_paths:
@@ -277,4 +1127,190 @@ class TagManager:
 
         tree_widget.expandAll()
 
+        return set(unique_paths)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+
+def create_test_database(work_dir: str = None) -> (str, str):
+    """
+    Write a small public database of tags a, b, c into a temp directory.
+    :return: The file names (public_db, private_db)
+    """
+    work_dir = work_dir if work_dir is not None else tempfile.mkdtemp()
+    public_db = os.path.join(work_dir, 'public.csv')
+    pd.DataFrame({PRIMARY_KEY: ['a', 'b', 'c'], 'path': ['x', 'x/y', ''], 'comments': ['', '', '']}) \
+        .to_csv(public_db, index=False)
+    return public_db, os.path.join(work_dir, 'private.csv')
+
+
+def test_index_after_upsert_and_remove():
+    tag_manager = TagManager(*create_test_database(), 0, save_delay=0)
+    with tag_manager.edit_session() as session:
+        session.upsert_row({PRIMARY_KEY: 'd', 'path': 'z'})
+        session.upsert_dataframe(pd.DataFrame({PRIMARY_KEY: ['e', 'a'], 'comments': ['new', 'old']}))
+        session.remove(['b'])
+
+    assert not tag_manager.has_tag('b') and tag_manager.get_property('b', 'path') == ''
+    assert tag_manager.get_property('d', 'path') == 'z' and tag_manager.get_property('e', 'comments') == 'new'
+    assert tag_manager.get_property('a', 'comments') == 'old' and tag_manager.get_property('a', 'path') == 'x'
+    assert list(tag_manager.select_rows(['e', 'b', 'c'])[PRIMARY_KEY]) == ['e', 'c']
+    # Each primary key points to its own row of the published frame
+    snapshot = tag_manager.get_snapshot()
+    assert sorted(snapshot.tag_index.keys()) == ['a', 'c', 'd', 'e']
+    assert all(snapshot.database[PRIMARY_KEY].iat[position] == tag for tag, position in snapshot.tag_index.items())
+
+    # The index is updated from the change, and the published snapshot is not changed by the later edits
+    with tag_manager.edit_session() as session:
+        session.remove(['a'])
+        session.upsert_row({PRIMARY_KEY: 'f', 'weight': '1.5'})
+    assert sorted(snapshot.tag_index.keys()) == ['a', 'c', 'd', 'e']
+    latest = tag_manager.get_snapshot()
+    assert sorted(latest.tag_index.keys()) == ['c', 'd', 'e', 'f']
+    assert all(latest.database[PRIMARY_KEY].iat[position] == tag for tag, position in latest.tag_index.items())
+    # get_property() is always text
+    assert tag_manager.get_property('f', 'weight') == '1.5' and tag_manager.get_property('e', 'weight') == ''
+
+
+def test_journal_replay_after_crash():
+    public_db, private_db = create_test_database()
+    tag_manager = TagManager(public_db, private_db, 0, save_delay=0)
+    with tag_manager.edit_session() as session:
+        session.set_property('a', 'comments', 'saved')
+        session.set_property('d', 'path', 'new')
+        session.remove(['c'])
+    tag_manager.flush_database()
+
+    # Killed without close(): the changes are only in the journal, whose last line is half written.
+    journal_file = os.path.splitext(public_db)[0] + '.journal'
+    assert os.path.isfile(journal_file) and 'saved' not in open(public_db, encoding='utf-8').read()
+    with open(journal_file, 'at', encoding='utf-8') as f:
+        f.write('{"upsert": {"tag": "half')
+
+    tag_manager = TagManager(public_db, private_db, 0)
+    assert tag_manager.get_property('a', 'comments') == 'saved' and tag_manager.get_property('d', 'path') == 'new'
+    assert not tag_manager.has_tag('c') and not tag_manager.has_tag('half')
+
+
+def test_nested_session_rollback():
+    tag_manager = TagManager(*create_test_database(), 0, save_delay=0)
+
+    # The inner rollback only discards the inner edits
+    with tag_manager.edit_session() as outer:
+        outer.set_property('a', 'comments', 'outer')
+        with tag_manager.edit_session() as inner:
+            inner.set_property('b', 'comments', 'inner')
+            inner.rollback()
+    assert tag_manager.get_property('a', 'comments') == 'outer' and tag_manager.get_property('b', 'comments') == ''
+
+    # An exception in the outer session restores the whole batch, including the committed inner session
+    version = tag_manager.get_version()
+    try:
+        with tag_manager.edit_session() as outer:
+            outer.set_property('a', 'comments', 'changed')
+            with tag_manager.edit_session() as inner:
+                inner.set_property('c', 'comments', 'inner')
+                inner.remove(['b'])
+            raise ValueError('abort')
+    except ValueError:
+        pass
+    assert tag_manager.get_property('a', 'comments') == 'outer' and tag_manager.get_property('c', 'comments') == ''
+    assert tag_manager.has_tag('b') and tag_manager.get_version() == version
+
+
+def test_external_reload():
+    public_db, private_db = create_test_database()
+    tag_manager = TagManager(public_db, private_db, 0, save_delay=0)
+    other_manager = TagManager(public_db, private_db, 0, save_delay=0)
+    with tag_manager.edit_session(save=False) as session:
+        session.set_property('a', 'comments', 'local')
+    assert not tag_manager.check_external_changes()
+
+    # Another instance writes the files under the file lock
+    with other_manager.edit_session() as session:
+        session.set_property('b', 'comments', 'external')
+        session.set_property('d', 'path', 'external')
+        session.remove(['c'])
+    other_manager.flush_database()
+
+    assert tag_manager.check_external_changes()
+    assert tag_manager.get_property('b', 'comments') == 'external'
+    assert tag_manager.get_property('d', 'path') == 'external' and not tag_manager.has_tag('c')
+    # The local modification that is not saved is kept
+    assert tag_manager.get_property('a', 'comments') == 'local'
+    assert not tag_manager.check_external_changes()
+
+
+def test_csv_round_trip():
+    # Load and save without any edit writes the same bytes, e.g. the weight '1.00' and the text 'bad' are kept
+    work_dir = tempfile.mkdtemp()
+    public_db, private_db = os.path.join(work_dir, 'public.csv'), os.path.join(work_dir, 'private.csv')
+    lines = [','.join(DATABASE_FIELDS),
+             'NA,x/y,,,"a, b",1.00,,,',
+             'b,,,,,bad,,,3',
+             'c,x,,,,1.1,,,12.0']
+    shipped_db = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'public.csv')
+    if os.path.isfile(shipped_db):
+        with open(shipped_db, 'rt', encoding='utf-8') as f:
+            lines += f.read().splitlines()[1:]
+    data = (os.linesep.join(lines) + os.linesep).encode('utf-8')
+    with open(public_db, 'wb') as f:
+        f.write(data)
+
+    tag_manager = TagManager(public_db, private_db, 0, save_delay=0)
+    assert tag_manager.has_tag('NA') and tag_manager.get_property('b', 'weight') == 'bad'
+    TagManager.save_tag_data(tag_manager.get_database(), public_db, private_db)
+    with open(public_db, 'rb') as f:
+        assert f.read() == data
+
+
+def test_statistics_of_known_tags():
+    tag_manager = TagManager(*create_test_database(), 0, save_delay=0)
+    statistics = tag_manager.get_tag_statistics()
+    # The text that is not a tag in database is not counted, and gets no id
+    statistics.count(['unknown %d' % i for i in range(5000)])
+    assert statistics.pending_count() == 0 and statistics.flush() == 0
+
+    statistics.count(['a', 'b', 'a', 'typo'])
+    statistics.count(['a'])
+    assert statistics.flush() == 2 and statistics.pending_count() == 0
+    assert tag_manager.get_property('a', 'statistics') == '2' and tag_manager.get_property('b', 'statistics') == '1'
+    statistics.count(['b'])
+    assert statistics.flush() == 1 and tag_manager.get_property('b', 'statistics') == '2'
+
+
+def test_dictionary_lookup():
+    work_dir = tempfile.mkdtemp()
+    public_db, private_db = create_test_database(work_dir)
+    dictionary_csv = os.path.join(work_dir, 'dictionary.csv')
+    pd.DataFrame({PRIMARY_KEY: ['a', 'e', 'f'], 'path': ['dict', 'x/y', 'w'], 'comments': ['', 'from dict', '']}) \
+        .to_csv(dictionary_csv, index=False)
+    dictionary = SqliteTagStorage(os.path.join(work_dir, 'dictionary.db'), DATABASE_FIELDS)
+    dictionary.import_csv(dictionary_csv, os.path.join(work_dir, 'none.csv'))
+    tag_manager = TagManager(public_db, private_db, 0, save_delay=0, dictionary=dictionary)
+
+    # The tag in database is not taken from dictionary. The unknown tag is not in either.
+    rows = tag_manager.lookup_rows(['e', 'a', 'g'])
+    assert list(rows[PRIMARY_KEY]) == ['a', 'e']
+    assert list(rows['path']) == ['x', 'x/y'] and rows['comments'].iat[1] == 'from dict'
+    assert not tag_manager.has_tag('e')
+
+    rows = tag_manager.query_dictionary('path', 'x', prefix=True)
+    assert sorted(rows[PRIMARY_KEY]) == ['e']
+    assert list(tag_manager.query_dictionary('path', 'w')[PRIMARY_KEY]) == ['f']
+    assert list(tag_manager.query_dictionary('path', 'dict')[PRIMARY_KEY]) == ['a']
+    assert tag_manager.query_dictionary('path', 'dict')['path'].iat[0] == 'x'
+
+
+def main():
+    test_index_after_upsert_and_remove()
+    test_journal_replay_after_crash()
+    test_nested_session_rollback()
+    test_external_reload()
+    test_dictionary_lookup()
+    test_csv_round_trip()
+    test_statistics_of_known_tags()
+
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+import threading
+import numpy as np
+import pandas as pd
+
+from df_utility import copy_on_write
+
+
+class TagStatistics:
+    """
+    Collect how often the tags appear in the analysed prompts, and write them to the 'statistics' field in batch.
+
+    The counts are accumulated in an int array indexed by tag id, which is assigned when a tag is counted
+    for the first time. Only the tags in database are counted, so the ids are not assigned to any text typed.
+    They're written to database by flush(), which is called by a timer and at exit, so analysing many prompts
+    causes one save instead of one per prompt. The ids are cleared by flush() as all the counts are zero then.
+
+    A source (like the analyser editor) reports its current prompt by set_source_tags(). Only the prompt
+    at flush time is counted, and the same tags of a source are not counted again. So the intermediate
+    states of editing don't increase the statistics.
+    """
+
+    def __init__(self, tag_manager, field: str = 'statistics', primary_key: str = 'tag'):
+        self.__tag_manager = tag_manager
+        self.__field = field
+        self.__primary_key = primary_key
+        self.__lock = threading.Lock()
+        self.__tag_ids = {}
+        self.__id_tags = []
+        self.__counts = np.zeros(1024, dtype=np.int64)
+        # {source: [tag]} of the prompts not counted yet, and {source: frozenset(tag)} that are counted.
+        self.__source_tags = {}
+        self.__counted_source_tags = {}
+
+    def count(self, tags: [str]):
+        """
+        Count the tags of a prompt. A tag is counted once per call. The tags not in database are ignored.
+        """
+        snapshot = self.__tag_manager.get_snapshot()
+        with self.__lock:
+            ids = np.fromiter((self.__tag_id(tag) for tag in dict.fromkeys(tags) if snapshot.has_tag(tag)),
+                              dtype=np.int64)
+            self.__counts[ids] += 1
+
+    def set_source_tags(self, source: str, tags: [str]):
+        """
+        Set the current prompt tags of a source, which is counted at the next flush if it's changed.
+        """
+        with self.__lock:
+            self.__source_tags[source] = list(tags)
+
+    def pending_count(self) -> int:
+        with self.__lock:
+            return int(np.count_nonzero(self.__counts)) + len(self.__source_tags)
+
+    def flush(self) -> int:
+        """
+        Add the pending counts to the statistics of database in one edit session.
+        The tags not in database are dropped.
+        :return: The number of tags updated.
+        """
+        snapshot = self.__tag_manager.get_snapshot()
+        with self.__lock:
+            for source, tags in self.__source_tags.items():
+                tag_set = frozenset(tags)
+                if self.__counted_source_tags.get(source, None) != tag_set:
+                    self.__counted_source_tags[source] = tag_set
+                    ids = np.fromiter((self.__tag_id(tag) for tag in tag_set if snapshot.has_tag(tag)),
+                                      dtype=np.int64)
+                    self.__counts[ids] += 1
+            self.__source_tags.clear()
+
+            ids = np.nonzero(self.__counts)[0]
+            tags = [self.__id_tags[i] for i in ids]
+            increments = self.__counts[ids].astype(np.float64)
+            self.__clear_ids()
+        if len(tags) == 0:
+            return 0
+
+        rows = self.__tag_manager.select_rows(tags)
+        if rows.empty:
+            return 0
+        positions = pd.Index(tags).get_indexer(rows[self.__primary_key])
+        statistics = np.nan_to_num(pd.to_numeric(rows[self.__field], errors='coerce').to_numpy(dtype=np.float64)) + \
+            increments[positions]
+        with self.__tag_manager.edit_session() as session:
+            session.upsert_dataframe(pd.DataFrame({
+                self.__primary_key: rows[self.__primary_key].values, self.__field: statistics}))
+        return len(rows)
+
+    def reset(self):
+        """
+        Clear the statistics of all tags and the pending counts. The column is replaced at once.
+        """
+        with self.__lock:
+            self.__clear_ids()
+            self.__source_tags.clear()
+            self.__counted_source_tags.clear()
+        df = copy_on_write(self.__tag_manager.get_database(), [self.__field])
+        df[self.__field] = np.nan
+        self.__tag_manager.inform_database_modified(df, True)
+
+    # ------------------------------------------------------------------------------------------------------------------
+
+    def __clear_ids(self):
+        # All the counts are zero, so the ids of tags are not needed any more
+        self.__tag_ids = {}
+        self.__id_tags = []
+        self.__counts = np.zeros(1024, dtype=np.int64)
+
+    def __tag_id(self, tag: str) -> int:
+        tag_id = self.__tag_ids.get(tag, None)
+        if tag_id is None:
+            tag_id = self.__tag_ids[tag] = len(self.__id_tags)
+            self.__id_tags.append(tag)
+            if tag_id >= len(self.__counts):
+                self.__counts = np.concatenate([self.__counts, np.zeros(len(self.__counts), dtype=np.int64)])
+        return tag_id
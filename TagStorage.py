@@ -0,0 +1,390 @@
+import os
+import sys
+import sqlite3
+import threading
+
+import numpy as np
+import pandas as pd
+
+from app_utility import backup_file_safe, replace_file_atomic, file_signature, file_stat_signature, FileLock
+from df_utility import value_to_text, concat_dataframes_keeping_categories
+from TagJournal import TagJournal
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#                                                   CSV Pair
+# ----------------------------------------------------------------------------------------------------------------------
+
+LOAD_CHUNK_SIZE = 50000
+
+
+def load_csv_database(public_db: str, private_db: str, fields: list, journal: TagJournal or None = None,
+                      progress: callable = None, normalise: callable = None,
+                      chunk_size: int = LOAD_CHUNK_SIZE) -> pd.DataFrame:
+    """
+    Load public.csv and private.csv. The files are read by chunks, so the peak memory is about the loaded table
+    plus one chunk. The rows are de-duplicated by primary key as they come, the first one wins.
+    :param journal: The journal replayed on the loaded data.
+    :param progress: Called as progress(bytes_read, total_bytes) after each chunk.
+    :param normalise: Called on each chunk and the final table to convert the columns, e.g. compact_dataframe().
+                      If None, NaN is filled with ''.
+    :param chunk_size: The row count of a chunk.
+    :return: The loaded table.
+    """
+    primary_key = fields[0]
+    normalise = normalise if normalise is not None else (lambda df: df.fillna(''))
+
+    csv_files = [file_name for file_name in [public_db, private_db] if os.path.isfile(file_name)]
+    total_bytes = sum(os.path.getsize(file_name) for file_name in csv_files)
+    read_bytes = 0
+
+    chunks = []
+    loaded_keys = set()
+    for file_name in csv_files:
+        with open(file_name, 'rb') as f:
+            try:
+                # Read the text as it is, so that the numbers are not reformatted and the 'NA' tag is not NaN
+                reader = pd.read_csv(f, chunksize=chunk_size, dtype=str, keep_default_na=False)
+                for chunk in reader:
+                    chunks.append(normalise(normalise_csv_chunk(chunk, fields, loaded_keys)))
+                    if progress is not None:
+                        progress(read_bytes + f.tell(), total_bytes)
+            except pd.errors.EmptyDataError:
+                pass
+        read_bytes += os.path.getsize(file_name)
+
+    if len(chunks) > 0:
+        df_tags = concat_dataframes_keeping_categories(chunks)
+    else:
+        df_tags = pd.DataFrame(columns=fields)
+
+    # Replay the changes that have not been folded into csv files yet
+    if journal is not None:
+        df_tags = journal.replay(df_tags)
+
+    df_tags = normalise(df_tags.reset_index(drop=True))
+    if progress is not None:
+        progress(total_bytes, total_bytes)
+    return df_tags
+
+
+def normalise_csv_chunk(chunk: pd.DataFrame, fields: list, loaded_keys: set) -> pd.DataFrame:
+    primary_key = fields[0]
+
+    # Add the missing fields. The required fields come first.
+    if not set(fields).issubset(chunk.columns):
+        chunk = chunk.reindex(columns=fields + [column for column in chunk.columns if column not in fields])
+
+    # Drop the primary keys that are already loaded, both in previous chunks and in this chunk
+    keys = chunk[primary_key].values
+    keep = np.fromiter((key not in loaded_keys for key in keys), dtype=bool, count=len(keys)) & \
+        ~chunk[primary_key].duplicated().values
+    if not keep.all():
+        chunk = chunk[keep]
+    loaded_keys.update(chunk[primary_key].values)
+    return chunk.reset_index(drop=True)
+
+
+def save_csv_database(df: pd.DataFrame, public_db: str, private_db: str):
+    # Split the dataframe into two based on the value of the 'private' field
+    df_private = df[df['private'] == 'Y']
+    df_public = df[df['private'] != 'Y']
+
+    # Save the private and public dataframes to separate CSV files. Write to temp files and replace atomically.
+    replace_file_atomic(public_db, lambda file_name: df_public.to_csv(file_name, index=False, encoding='utf-8'))
+    replace_file_atomic(private_db, lambda file_name: df_private.to_csv(file_name, index=False, encoding='utf-8'))
+
+
+class CsvTagStorage:
+    """
+    The default storage: public.csv and private.csv, with the row level changes appended to a journal.
+
+    The files can be shared by several app instances and scripts. The reads and writes are serialized by
+    an advisory lock file. The changes by others (including editing csv by Excel) are detected by polling
+    the size and mtime of files, see has_external_changes().
+    """
+
+    def __init__(self, public_db: str, private_db: str, fields: list, backup_limit: int, journal_limit: int):
+        self.__public_db = public_db
+        self.__private_db = private_db
+        self.__fields = fields
+        self.__backup_limit = backup_limit
+        self.__journal_limit = journal_limit
+        self.__journal = TagJournal(os.path.splitext(public_db)[0] + '.journal', fields[0])
+        self.__lock = FileLock(os.path.splitext(public_db)[0] + '.lock')
+        # The state of files that this instance knows. Any other state is changed by others.
+        self.__known_state = None
+
+    def load(self, progress: callable = None, normalise: callable = None) -> pd.DataFrame:
+        with self.__lock:
+            df = load_csv_database(self.__public_db, self.__private_db, self.__fields, self.__journal,
+                                   progress, normalise)
+            self.__known_state = self.__file_state()
+        return df
+
+    def has_external_changes(self) -> bool:
+        """
+        Check whether the files are changed by others since the last load or write of this instance.
+        It only stats the files, so it's cheap for polling.
+        """
+        return self.__file_state() != self.__known_state
+
+    def accept_current_state(self):
+        """
+        Regard the current files as known. It's called when the database is restored from the snapshot cache.
+        """
+        self.__known_state = self.__file_state()
+
+    def signature(self) -> str:
+        return file_signature([self.__public_db, self.__private_db, self.__journal.journal_file()])
+
+    def snapshot_cache_file(self) -> str:
+        return os.path.splitext(self.__public_db)[0] + '.cache'
+
+    def save_changes(self, df: pd.DataFrame, changed_df: pd.DataFrame, deleted_keys: [str]):
+        with self.__lock:
+            external_changed = self.has_external_changes()
+            if not external_changed and \
+                    self.__journal.record_count() + len(changed_df) + len(deleted_keys) > self.__journal_limit:
+                # The df has all the changes, so a bulk change is written to csv files directly.
+                self.__write_csv(df)
+            else:
+                # Only the changed rows are appended, so the changes by others are not overwritten.
+                self.__journal.append(changed_df.to_dict('records'), deleted_keys)
+                if self.__journal.record_count() > self.__journal_limit:
+                    self.__fold_journal(df, external_changed)
+            # Keep the external changes detectable
+            if not external_changed:
+                self.__known_state = self.__file_state()
+
+    def compact(self, df: pd.DataFrame):
+        """
+        Fold the journal into the csv files. The csv files are backed up before being rewritten.
+        """
+        with self.__lock:
+            external_changed = self.has_external_changes()
+            self.__fold_journal(df, external_changed)
+            if not external_changed:
+                self.__known_state = self.__file_state()
+
+    def close(self, df: pd.DataFrame):
+        if self.__journal.record_count() > 0:
+            self.compact(df)
+
+    def __fold_journal(self, df: pd.DataFrame, external_changed: bool):
+        # If the files are changed by others, df is not the latest. Fold the files on disk instead.
+        if external_changed:
+            df = load_csv_database(self.__public_db, self.__private_db, self.__fields, self.__journal)
+            df = df.drop_duplicates(subset=[self.__fields[0]], keep='first')
+        self.__write_csv(df)
+
+    def __write_csv(self, df: pd.DataFrame):
+        backup_file_safe(self.__public_db, self.__backup_limit)
+        backup_file_safe(self.__private_db, self.__backup_limit)
+        save_csv_database(df, self.__public_db, self.__private_db)
+        self.__journal.clear()
+
+    def __file_state(self) -> tuple:
+        return file_stat_signature([self.__public_db, self.__private_db, self.__journal.journal_file()])
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#                                                    SQLite
+# ----------------------------------------------------------------------------------------------------------------------
+
+class SqliteTagStorage:
+    """
+    Optional storage backed by stdlib sqlite3. Changes are written as row level upserts and deletes in a transaction.
+    As the backend of TagManager, the table is loaded into memory as the csv storage.
+    The tag, path and label columns are indexed, so select_rows() and query() read only the matched rows.
+    It's how a large shared dictionary is used without loading it, see the dictionary of TagManager.
+    """
+
+    TABLE_NAME = 'tags'
+    INDEXED_FIELDS = ['path', 'label']
+    # The max count of parameters of sqlite is 999 for the old versions
+    SELECT_CHUNK_SIZE = 500
+
+    def __init__(self, db_file: str, fields: list):
+        self.__db_file = db_file
+        self.__fields = list(fields)
+        self.__primary_key = fields[0]
+        self.__lock = threading.Lock()
+        # The connection is shared with the background save worker. Access is serialized by the lock.
+        self.__connection = sqlite3.connect(db_file, check_same_thread=False)
+        self.__create_table()
+        self.__known_data_version = None
+
+    def load(self, progress: callable = None, normalise: callable = None) -> pd.DataFrame:
+        """
+        Load the table by chunks. See load_csv_database() for the parameters. The progress is counted by rows.
+        """
+        normalise = normalise if normalise is not None else (lambda df: df.fillna(''))
+        chunks = []
+        with self.__lock:
+            total_rows = self.__connection.execute(f'SELECT COUNT(*) FROM {self.TABLE_NAME}').fetchone()[0]
+            read_rows = 0
+            for chunk in pd.read_sql_query(f'SELECT * FROM {self.TABLE_NAME} ORDER BY rowid', self.__connection,
+                                           chunksize=LOAD_CHUNK_SIZE):
+                chunks.append(normalise(chunk))
+                read_rows += len(chunk)
+                if progress is not None:
+                    progress(read_rows, total_rows)
+            self.__known_data_version = self.__data_version()
+        df = concat_dataframes_keeping_categories(chunks) if len(chunks) > 0 else \
+            pd.DataFrame(columns=self.__fields)
+        df = df.reindex(columns=list(dict.fromkeys(self.__fields + list(df.columns))))
+        return normalise(df.reset_index(drop=True))
+
+    def has_external_changes(self) -> bool:
+        """
+        Check whether the database is committed by other connections since the last load.
+        sqlite changes the data_version only for the commits of other connections.
+        """
+        with self.__lock:
+            return self.__data_version() != self.__known_data_version
+
+    def accept_current_state(self):
+        with self.__lock:
+            self.__known_data_version = self.__data_version()
+
+    def save_changes(self, df: pd.DataFrame, changed_df: pd.DataFrame, deleted_keys: [str]):
+        with self.__lock, self.__connection:
+            if len(changed_df) > 0:
+                self.__ensure_columns(list(df.columns))
+                self.__upsert_rows(list(df.columns), changed_df.to_dict('records'))
+            if len(deleted_keys) > 0:
+                self.__connection.executemany(
+                    f'DELETE FROM {self.TABLE_NAME} WHERE "{self.__primary_key}" = ?',
+                    [(key,) for key in deleted_keys])
+
+    def signature(self) -> str:
+        # All the writes are committed by transaction, so the files reflect the database content.
+        return file_signature([self.__db_file, self.__db_file + '-wal'])
+
+    def snapshot_cache_file(self) -> str:
+        return os.path.splitext(self.__db_file)[0] + '.cache'
+
+    def compact(self, df: pd.DataFrame):
+        pass
+
+    def close(self, df: pd.DataFrame):
+        with self.__lock:
+            self.__connection.close()
+
+    def is_empty(self) -> bool:
+        with self.__lock:
+            return self.__connection.execute(f'SELECT 1 FROM {self.TABLE_NAME} LIMIT 1').fetchone() is None
+
+    def select_rows(self, primary_keys: [str]) -> pd.DataFrame:
+        """
+        Select the rows of the primary keys by the primary key index. The primary keys not found are ignored.
+        """
+        primary_keys = list(dict.fromkeys(primary_keys))
+        chunks = []
+        with self.__lock:
+            for start in range(0, len(primary_keys), self.SELECT_CHUNK_SIZE):
+                keys = primary_keys[start:start + self.SELECT_CHUNK_SIZE]
+                sql = f'SELECT * FROM {self.TABLE_NAME} WHERE "{self.__primary_key}" IN ({", ".join("?" * len(keys))})'
+                chunks.append(pd.read_sql_query(sql, self.__connection, params=keys))
+        return self.__to_rows(chunks)
+
+    def query(self, field: str, value: str, prefix: bool = False) -> pd.DataFrame:
+        """
+        Query rows by the value of a field without loading the whole table.
+        :param field: The field name. The primary key, path and label are indexed.
+        :param value: The value to match.
+        :param prefix: If True, match the rows whose field value starts with the value, e.g. the sub paths.
+        :return: The matched rows as dataframe.
+        """
+        if field not in self.__fields:
+            raise ValueError(f'Unknown field: {field}')
+        if prefix:
+            # A range of the binary collation, which uses the index unlike LIKE
+            sql = f'SELECT * FROM {self.TABLE_NAME} WHERE "{field}" >= ? AND "{field}" < ? ORDER BY rowid'
+            params = (value, value + chr(0x10FFFF))
+        else:
+            sql = f'SELECT * FROM {self.TABLE_NAME} WHERE "{field}" = ? ORDER BY rowid'
+            params = (value,)
+        with self.__lock:
+            return self.__to_rows([pd.read_sql_query(sql, self.__connection, params=params)])
+
+    def import_csv(self, public_db: str, private_db: str):
+        """
+        One-shot import of the csv pair. The existing rows with the same primary key are overwritten.
+        """
+        df = load_csv_database(public_db, private_db, self.__fields)
+        df = df.drop_duplicates(subset=[self.__primary_key], keep='first')
+        with self.__lock, self.__connection:
+            self.__ensure_columns(list(df.columns))
+            self.__upsert_rows(list(df.columns), df.to_dict('records'))
+
+    def export_csv(self, public_db: str, private_db: str):
+        """
+        One-shot export to the csv pair. The rows are split by the private field as the csv storage does.
+        """
+        save_csv_database(self.load(), public_db, private_db)
+
+    # ------------------------------------------------------------------------------------------------------------------
+
+    def __create_table(self):
+        primary_key = self.__primary_key
+        columns = ', '.join([f'"{primary_key}" TEXT PRIMARY KEY'] +
+                            [f'"{field}" TEXT' for field in self.__fields if field != primary_key])
+        with self.__lock, self.__connection:
+            self.__connection.execute(f'CREATE TABLE IF NOT EXISTS {self.TABLE_NAME} ({columns})')
+            for field in self.INDEXED_FIELDS:
+                self.__connection.execute(
+                    f'CREATE INDEX IF NOT EXISTS idx_{self.TABLE_NAME}_{field} ON {self.TABLE_NAME} ("{field}")')
+
+    def __to_rows(self, chunks: [pd.DataFrame]) -> pd.DataFrame:
+        df = pd.concat(chunks, ignore_index=True) if len(chunks) > 0 else pd.DataFrame(columns=self.__fields)
+        df = df.reindex(columns=list(dict.fromkeys(self.__fields + list(df.columns))))
+        return df.fillna('')
+
+    def __data_version(self) -> int:
+        return self.__connection.execute('PRAGMA data_version').fetchone()[0]
+
+    def __ensure_columns(self, columns: list):
+        exists = [row[1] for row in self.__connection.execute(f'PRAGMA table_info({self.TABLE_NAME})')]
+        for column in columns:
+            if column not in exists:
+                self.__connection.execute(f'ALTER TABLE {self.TABLE_NAME} ADD COLUMN "{column}" TEXT')
+
+    def __upsert_rows(self, columns: list, rows: [dict]):
+        column_names = ', '.join(f'"{column}"' for column in columns)
+        placeholders = ', '.join('?' * len(columns))
+        updates = ', '.join(f'"{column}" = excluded."{column}"' for column in columns
+                            if column != self.__primary_key)
+        sql = f'INSERT INTO {self.TABLE_NAME} ({column_names}) VALUES ({placeholders}) ' \
+              f'ON CONFLICT("{self.__primary_key}") DO UPDATE SET {updates}'
+        self.__connection.executemany(
+            sql, [tuple(value_to_text(row.get(column, '')) for column in columns) for row in rows])
+
+
+def main():
+    """
+    Import or export the csv pair from/to the sqlite database.
+        python TagStorage.py import|export [sqlite_db] [public_csv] [private_csv]
+    """
+    from TagManager import DATABASE_FIELDS
+    from defines import PUBLIC_DATABASE, PRIVATE_DATABASE, SQLITE_DATABASE
+
+    if len(sys.argv) < 2 or sys.argv[1] not in ['import', 'export']:
+        print(main.__doc__)
+        return
+
+    sqlite_db = sys.argv[2] if len(sys.argv) > 2 else SQLITE_DATABASE
+    public_db = sys.argv[3] if len(sys.argv) > 3 else PUBLIC_DATABASE
+    private_db = sys.argv[4] if len(sys.argv) > 4 else PRIVATE_DATABASE
+
+    storage = SqliteTagStorage(sqlite_db, DATABASE_FIELDS)
+    if sys.argv[1] == 'import':
+        storage.import_csv(public_db, private_db)
+    else:
+        storage.export_csv(public_db, private_db)
+    storage.close(None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+import numpy as np
+import pandas as pd
+
+
+class TagWeightList:
+    """
+    An ordered list of unique tags and their weights.
+
+    The tags are kept in a list with a dict of their positions, so the lookup, dedupe and merge are O(1) per tag.
+    The weights are kept in a float array, which grows by doubling and is worked on as a whole by numpy.
+    """
+
+    __slots__ = ['__tags', '__positions', '__weights']
+
+    def __init__(self, tags: [str] = None, weights=None):
+        """
+        :param tags: The tags. The later duplicated tags are ignored.
+        :param weights: The weights of tags. 1.0 for all tags if it's None.
+        """
+        self.__tags = []
+        self.__positions = {}
+        self.__weights = np.ones(16, dtype=np.float64)
+        if tags is not None:
+            self.extend(tags, weights)
+
+    def __len__(self) -> int:
+        return len(self.__tags)
+
+    def __contains__(self, tag: str) -> bool:
+        return tag in self.__positions
+
+    def __iter__(self):
+        return zip(self.__tags, self.__weights[:len(self.__tags)].tolist())
+
+    def tags(self) -> [str]:
+        return self.__tags
+
+    def weights(self) -> np.ndarray:
+        """
+        The weight array of tags. It's a view, which is changed by the later edit.
+        """
+        return self.__weights[:len(self.__tags)]
+
+    def index(self, tag: str) -> int:
+        """
+        :return: The position of tag. -1 if it's not in the list.
+        """
+        return self.__positions.get(tag, -1)
+
+    def positions(self, tags: [str]) -> np.ndarray:
+        return np.fromiter((self.__positions.get(tag, -1) for tag in tags), dtype=np.int64)
+
+    def get_weight(self, tag: str, default: float = 1.0) -> float:
+        position = self.__positions.get(tag, -1)
+        return float(self.__weights[position]) if position >= 0 else default
+
+    def append(self, tag: str, weight: float = 1.0) -> bool:
+        """
+        Append a tag at the end.
+        :return: False if the tag is in the list already. Its weight is not changed.
+        """
+        if tag in self.__positions:
+            return False
+        position = len(self.__tags)
+        if position >= len(self.__weights):
+            self.__weights = np.concatenate([self.__weights, np.ones(len(self.__weights), dtype=np.float64)])
+        self.__positions[tag] = position
+        self.__tags.append(tag)
+        self.__weights[position] = weight
+        return True
+
+    def extend(self, tags: [str], weights=None):
+        """
+        Append the tags not in the list, with their weights. The weights of the existing tags are not changed.
+        """
+        weights = np.ones(len(tags), dtype=np.float64) if weights is None else np.asarray(weights, dtype=np.float64)
+        start = len(self.__tags)
+        sources = []
+        for position, tag in enumerate(tags):
+            if tag not in self.__positions:
+                self.__positions[tag] = len(self.__tags)
+                self.__tags.append(tag)
+                sources.append(position)
+        if len(self.__tags) > len(self.__weights):
+            capacity = max(len(self.__tags), len(self.__weights) * 2)
+            self.__weights = np.concatenate([self.__weights, np.ones(capacity - len(self.__weights))])
+        self.__weights[start:len(self.__tags)] = weights[sources]
+
+    def set_weights(self, tags: [str], weights):
+        """
+        Set the weights of tags in one pass. The tags not in the list are ignored.
+        """
+        positions = self.positions(tags)
+        found = positions >= 0
+        self.__weights[positions[found]] = np.asarray(weights, dtype=np.float64)[found]
+
+    def to_dataframe(self, tag_field: str = 'tag', weight_field: str = 'weight') -> pd.DataFrame:
+        return pd.DataFrame({
+            tag_field: pd.Series(self.__tags, dtype=object),
+            weight_field: self.weights().copy()
+        })
+
+    def copy(self):
+        tag_weight_list = TagWeightList()
+        tag_weight_list.extend(self.__tags, self.weights())
+        return tag_weight_list
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+
+def test_tag_weight_list():
+    tag_weights = TagWeightList(['a', 'b', 'a', 'c'], [1.1, 1.2, 1.3, 1.4])
+    assert tag_weights.tags() == ['a', 'b', 'c'] and list(tag_weights.weights()) == [1.1, 1.2, 1.4]
+    assert 'b' in tag_weights and 'd' not in tag_weights and tag_weights.index('c') == 2
+
+    tag_weights.extend(['d', 'b', 'e', 'd'], [0.5, 2.0, 0.6, 0.7])
+    assert tag_weights.tags() == ['a', 'b', 'c', 'd', 'e']
+    assert list(tag_weights.weights()) == [1.1, 1.2, 1.4, 0.5, 0.6]
+
+    # Grow over the initial capacity
+    tag_weights.extend([str(i) for i in range(100)])
+    assert len(tag_weights) == 105 and tag_weights.get_weight('99') == 1.0 and tag_weights.get_weight('e') == 0.6
+
+    tag_weights.set_weights(['e', 'x', 'a'], [0.9, 3.0, 1.0])
+    assert tag_weights.get_weight('e') == 0.9 and tag_weights.get_weight('a') == 1.0 and 'x' not in tag_weights
+
+    df = TagWeightList().to_dataframe()
+    assert df.empty and df['tag'].dtype == object and df['weight'].dtype == np.float64
+    df = tag_weights.copy().to_dataframe()
+    assert list(df['tag'][:3]) == ['a', 'b', 'c'] and df['weight'][4] == 0.9
+
+
+def main():
+    test_tag_weight_list()
+
+
+if __name__ == '__main__':
+    main()
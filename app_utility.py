@@ -1,17 +1,22 @@
 import os
-import glob
-import datetime
+import sys
+import time
+import shutil
+import hashlib
+import tempfile
+import atexit
+import builtins
+import threading
+import traceback
 from collections import defaultdict
 
-
-# Do not use set to keep list order
-import shutil
+from BackupStore import BackupStore
 
 
+# Do not use set to keep list order
 def unique_list(lst: list or tuple) -> list:
-    result = []
-    [result.append(item) for item in lst if item not in result]
-    return result
+    # dict keeps the insertion order
+    return list(dict.fromkeys(lst))
 
 
 def format_float(value):
@@ -22,46 +27,302 @@ def format_float(value):
         return str(value)
 
 
-def backup_file(file_name: str, backup_limit: int):
-    # Get the path of the file
-    file_path = os.path.abspath(file_name)
+def file_signature(file_names: [str]) -> str:
+    """
+    Calculate the signature of files by size, mtime and content hash. A missing file is also a valid state.
+    :param file_names: The file name list
+    :return: The signature string
+    """
+    signatures = []
+    for file_name in file_names:
+        try:
+            stat = os.stat(file_name)
+            hasher = hashlib.blake2b(digest_size=16)
+            with open(file_name, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    hasher.update(block)
+            signatures.append(f'{os.path.basename(file_name)}:{stat.st_size}:{stat.st_mtime_ns}:{hasher.hexdigest()}')
+        except FileNotFoundError:
+            signatures.append(f'{os.path.basename(file_name)}:missing')
+    return '|'.join(signatures)
+
+
+def file_stat_signature(file_names: [str]) -> tuple:
+    """
+    The cheap signature of files by size and mtime, for polling the external changes.
+    :param file_names: The file name list
+    :return: The tuple of (size, mtime_ns) of each file. None for a missing file.
+    """
+    signatures = []
+    for file_name in file_names:
+        try:
+            stat = os.stat(file_name)
+            signatures.append((stat.st_size, stat.st_mtime_ns))
+        except FileNotFoundError:
+            signatures.append(None)
+    return tuple(signatures)
+
+
+class FileLock:
+    """
+    A cross-process advisory lock on a lock file. It only works between the processes that use it.
+    It's reentrant in the same process and also serializes the threads. Use it by 'with' statement.
+    """
+
+    def __init__(self, lock_file: str, timeout: float = 10.0):
+        self.__lock_file = lock_file
+        self.__timeout = timeout
+        self.__thread_lock = threading.RLock()
+        self.__depth = 0
+        self.__file = None
+
+    def acquire(self):
+        self.__thread_lock.acquire()
+        if self.__depth == 0:
+            try:
+                self.__lock_file_handle()
+            except Exception:
+                self.__thread_lock.release()
+                raise
+        self.__depth += 1
+
+    def release(self):
+        self.__depth -= 1
+        if self.__depth == 0:
+            self.__unlock_file_handle()
+        self.__thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+        return False
+
+    def __lock_file_handle(self):
+        self.__file = open(self.__lock_file, 'a+b')
+        time_start = time.time()
+        while True:
+            try:
+                if os.name == 'nt':
+                    import msvcrt
+                    self.__file.seek(0)
+                    msvcrt.locking(self.__file.fileno(), msvcrt.LK_NBLCK, 1)
+                else:
+                    import fcntl
+                    fcntl.flock(self.__file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except OSError:
+                if time.time() - time_start > self.__timeout:
+                    self.__file.close()
+                    self.__file = None
+                    raise TimeoutError(f'Cannot lock {self.__lock_file} in {self.__timeout} seconds.')
+                time.sleep(0.05)
+
+    def __unlock_file_handle(self):
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                self.__file.seek(0)
+                msvcrt.locking(self.__file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(self.__file.fileno(), fcntl.LOCK_UN)
+        finally:
+            self.__file.close()
+            self.__file = None
+
+
+def read_umask() -> int:
+    # os.umask() can only be read by setting it. Read it once at import, before any thread creates files.
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return umask
+
+
+PROCESS_UMASK = read_umask()
+
+
+def replace_file_atomic(file_name: str, writer: callable):
+    """
+    Write the file by writer(temp_file_name) and then rename it to file_name atomically.
+    So the file is either the old one or the new one even if the app is killed during writing.
+    :param file_name: The target file name
+    :param writer: The function that writes data to the given file name
+    :return: None
+    """
+    # A unique temp file in the same directory, so that the rename doesn't cross file systems
+    # and the concurrent writers of the same file don't write to one temp file.
+    file_dir, base_name = os.path.split(os.path.abspath(file_name))
+    fd, temp_file_name = tempfile.mkstemp(prefix=base_name + '.', suffix='.tmp', dir=file_dir)
+    os.close(fd)
+    try:
+        writer(temp_file_name)
+        # mkstemp() creates the file as 0600. Keep the mode of the replaced file, or the default of a new file.
+        if os.path.exists(file_name):
+            shutil.copymode(file_name, temp_file_name)
+        else:
+            os.chmod(temp_file_name, 0o666 & ~PROCESS_UMASK)
+        os.replace(temp_file_name, file_name)
+    except BaseException:
+        if os.path.exists(temp_file_name):
+            os.remove(temp_file_name)
+        raise
+
+
+class DebounceWorker:
+    """
+    Run the task in a background thread once the trigger has been quiet for delay seconds.
+    Multiple triggers during the quiet period are coalesced into one run.
+    The pending task is flushed on interpreter exit, or by stop() if the worker is not used any more.
+    """
 
-    # Get the directory of the file
-    file_dir = os.path.dirname(file_path)
+    def __init__(self, task: callable, delay: float):
+        self.__task = task
+        self.__delay = delay
+        self.__deadline = None
+        # True from the time the task is dequeued until it finishes, by either the worker or flush()
+        self.__running = False
+        self.__stopped = False
+        self.__condition = threading.Condition()
+        self.__thread = threading.Thread(target=self.__worker_loop, daemon=True)
+        self.__thread.start()
+        atexit.register(self.flush)
 
-    # Create the backup directory if it does not exist
-    backup_dir = os.path.join(file_dir, 'backup')
-    os.makedirs(backup_dir, exist_ok=True)
+    def trigger(self):
+        with self.__condition:
+            self.__deadline = time.monotonic() + self.__delay
+            self.__condition.notify_all()
 
-    # Get the timestamp
-    timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S_%f')[:-3]
+    def has_pending(self) -> bool:
+        return self.__deadline is not None
 
-    # Get the file extension
-    file_ext = os.path.splitext(file_name)[1]
+    def flush(self):
+        """
+        Run the pending task immediately in the caller thread, or wait for the running task to finish.
+        :return: None
+        """
+        with self.__condition:
+            while self.__running:
+                self.__condition.wait()
+            if self.__deadline is None:
+                return
+            self.__deadline = None
+            self.__running = True
+        self.__run_task()
 
-    # Create the backup file name
-    backup_file_name = os.path.basename(file_name)
-    if file_ext:
-        backup_file_name = backup_file_name.replace(file_ext, f'_{timestamp}{file_ext}')
-    else:
-        backup_file_name = f'{backup_file_name}_{timestamp}'
+    def stop(self):
+        """
+        Run the pending task and end the worker thread. It's not flushed on exit any more, so the worker
+        can be garbage collected. Do not trigger it after stop.
+        :return: None
+        """
+        atexit.unregister(self.flush)
+        with self.__condition:
+            self.__stopped = True
+            self.__condition.notify_all()
+        self.flush()
+        self.__thread.join()
 
-    # Copy the file to the backup directory
-    backup_file_path = os.path.join(backup_dir, backup_file_name)
-    shutil.copy2(file_path, backup_file_path)
+    def __worker_loop(self):
+        while True:
+            with self.__condition:
+                while (self.__deadline is None or self.__running) and not self.__stopped:
+                    self.__condition.wait()
+                if self.__stopped:
+                    return
+                remaining = self.__deadline - time.monotonic()
+                if remaining > 0:
+                    self.__condition.wait(remaining)
+                    continue
+                self.__deadline = None
+                self.__running = True
+            self.__run_task()
 
-    # Get the number of backup files
-    if file_ext:
-        backup_files = glob.glob(
-            os.path.join(backup_dir, f'{os.path.basename(file_name).replace(file_ext, "")}_*{file_ext}'))
-    else:
-        backup_files = glob.glob(os.path.join(backup_dir, f'{os.path.basename(file_name)}_*'))
-    num_backup_files = len(backup_files)
+    def __run_task(self):
+        try:
+            self.__task()
+        except Exception as e:
+            print('Background task error.')
+            print(e)
+            print(traceback.format_exc())
+        finally:
+            with self.__condition:
+                self.__running = False
+                self.__condition.notify_all()
 
-    # If the number of backup files is greater than the backup limit, delete the oldest file
-    if num_backup_files > backup_limit:
-        oldest_file = min(backup_files, key=os.path.getctime)
-        os.remove(oldest_file)
+
+class StartupProfiler:
+    """
+    A built-in startup report in the style of python -X importtime.
+    It records the self and cumulative time of each first-time import, and the time of each startup phase.
+    Do nothing if not enabled.
+    """
+
+    def __init__(self, enabled: bool):
+        self.__enabled = enabled
+        self.__start_time = time.perf_counter()
+        self.__last_mark_time = self.__start_time
+        self.__phases = []
+        self.__imports = []
+        self.__import_stack = []
+        self.__original_import = builtins.__import__
+        if enabled:
+            builtins.__import__ = self.__timed_import
+
+    def is_enabled(self) -> bool:
+        return self.__enabled
+
+    def mark(self, phase: str):
+        if self.__enabled:
+            now = time.perf_counter()
+            self.__phases.append((phase, now - self.__last_mark_time, now - self.__start_time))
+            self.__last_mark_time = now
+
+    def report(self, top_imports: int = 30) -> str:
+        if not self.__enabled:
+            return ''
+        builtins.__import__ = self.__original_import
+
+        lines = ['Startup phases:', '%10s | %10s | %s' % ('self [ms]', 'total [ms]', 'phase')]
+        for phase, self_time, total_time in self.__phases:
+            lines.append('%10.1f | %10.1f | %s' % (self_time * 1000, total_time * 1000, phase))
+
+        lines += ['', 'Slowest imports:', 'import time: %10s | %10s | %s' % ('self [us]', 'cumulative', 'package')]
+        slowest_imports = sorted(self.__imports, key=lambda x: x[3], reverse=True)[:top_imports]
+        for depth, name, self_time, cumulative in slowest_imports:
+            lines.append('import time: %10d | %10d | %s%s' % (self_time * 1e6, cumulative * 1e6, '  ' * depth, name))
+        return '\n'.join(lines)
+
+    def __timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        # Only time the first absolute import of a module. Others are just dict lookups.
+        if level != 0 or name in sys.modules:
+            return self.__original_import(name, globals, locals, fromlist, level)
+        self.__import_stack.append(0.0)
+        start_time = time.perf_counter()
+        try:
+            return self.__original_import(name, globals, locals, fromlist, level)
+        finally:
+            cumulative = time.perf_counter() - start_time
+            children_time = self.__import_stack.pop()
+            if len(self.__import_stack) > 0:
+                self.__import_stack[-1] += cumulative
+            self.__imports.append((len(self.__import_stack), name, cumulative - children_time, cumulative))
+
+
+def backup_file(file_name: str, backup_limit: int) -> bool:
+    """
+    Backup the file to the "backup" directory beside it. The content is stored compressed and deduplicated,
+    so a save that does not change the file costs only a hash. Older points are thinned to hourly and daily.
+    :param file_name: The file to backup.
+    :param backup_limit: The number of recent points kept for this file before thinning.
+    :return: True if a new version is stored.
+    """
+    if not os.path.exists(file_name):
+        return False
+    backup_dir = os.path.join(os.path.dirname(os.path.abspath(file_name)), 'backup')
+    return BackupStore(backup_dir).backup(file_name, backup_limit)
 
 
 def backup_file_safe(file_name: str, backup_limit: int) -> bool:
@@ -87,3 +348,78 @@ def convert_list_of_dicts(input_list):
         result[key] += [None] * (max_len - len(result[key]))
     return result
 
+
+# ----------------------------------------------------------------------------------------------------------------------
+
+def test_debounce_worker_flush():
+    log = []
+
+    def task():
+        log.append('start')
+        time.sleep(0.05)
+        log.append('end')
+
+    worker = DebounceWorker(task, 0.01)
+    # flush() returns after the run, whether it's pending, dequeued by the worker or running
+    for delay in [0.0, 0.005, 0.01, 0.02, 0.04]:
+        log.clear()
+        worker.trigger()
+        time.sleep(delay)
+        worker.flush()
+        log.append('flushed')
+        assert log == ['start', 'end', 'flushed'], log
+
+    # The triggers in the quiet period are coalesced into one run
+    log.clear()
+    for _ in range(5):
+        worker.trigger()
+    worker.flush()
+    worker.flush()
+    assert log == ['start', 'end'] and not worker.has_pending()
+
+    # stop() runs the pending task and ends the thread
+    log.clear()
+    worker.trigger()
+    worker.stop()
+    assert log == ['start', 'end'] and not worker.has_pending()
+
+
+def test_replace_file_mode():
+    if os.name != 'posix':
+        return
+    work_dir = tempfile.mkdtemp()
+    file_name = os.path.join(work_dir, 'new.txt')
+    replace_file_atomic(file_name, lambda temp_file_name: open(temp_file_name, 'w').close())
+    assert os.stat(file_name).st_mode & 0o777 == 0o666 & ~PROCESS_UMASK
+
+    # The replaced file keeps its mode
+    os.chmod(file_name, 0o640)
+    replace_file_atomic(file_name, lambda temp_file_name: open(temp_file_name, 'w').close())
+    assert os.stat(file_name).st_mode & 0o777 == 0o640
+
+
+def test_file_lock():
+    lock_file = os.path.join(tempfile.mkdtemp(), 'test.lock')
+    lock = FileLock(lock_file)
+    other_lock = FileLock(lock_file, timeout=0.1)
+    with lock:
+        # Reentrant for the owner, exclusive for the others
+        with lock:
+            pass
+        try:
+            other_lock.acquire()
+            assert False, 'The lock is acquired twice.'
+        except TimeoutError:
+            pass
+    with other_lock:
+        pass
+
+
+def main():
+    test_debounce_worker_flush()
+    test_replace_file_mode()
+    test_file_lock()
+
+
+if __name__ == '__main__':
+    main()
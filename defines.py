@@ -4,9 +4,26 @@ from TagManager import PRIMARY_KEY, DATABASE_SUPPORT_FIELD, DATABASE_FIELDS
 
 
 BACKUP_LIMIT = 20
+JOURNAL_LIMIT = 1000
+SAVE_DELAY = 1.0
+# The interval (ms) to poll the database files for the changes by other instances or editors
+EXTERNAL_CHANGE_POLL_INTERVAL = 2000
+# The max number of tags shown for a search
+SEARCH_RESULT_LIMIT = 1000
+# The interval (ms) to write the collected tag statistics to database
+STATISTICS_FLUSH_INTERVAL = 10000
+# The delay (ms) after the last edit of prompt to analyse it
+ANALYSIS_DELAY = 200
 PUBLIC_DATABASE = 'public.csv'
 PRIVATE_DATABASE = 'private.csv'
 
+# 'csv' or 'sqlite'. The sqlite database is imported from the csv files on first use.
+DATABASE_BACKEND = 'csv'
+SQLITE_DATABASE = 'tags.db'
+# The read-only sqlite database of a shared tag dictionary, e.g. a big tag list of a booru site. Empty for none.
+# It's not loaded. The tags not in the database are looked up in it by index.
+SHARED_DICTIONARY = ''
+
 ANALYSIS_DISPLAY_FIELD = [PRIMARY_KEY, 'weight', 'path', 'value', 'translate_cn', 'comments']
 
 ANALYSIS_SHOW_COLUMNS = OrderedDict()
@@ -35,6 +52,27 @@ PRESET_TAG_PATH = ['正向效果', '反向效果', '中立效果', '低价值',
                    '人物/身体', '人物/服饰', '人物/饰品', '人物/动作', '人物/感觉', '人物/人种',
                    '视角', '图片风格', '18x', '非通用描述', '玄学？']
 
+# The path of the imported tags by the category of tag dump. The general tags are left for manual grouping.
+IMPORT_CATEGORY_PATH = {
+    'danbooru': {
+        0: '',
+        1: '图片风格/画师',
+        3: '非通用描述/作品',
+        4: '非通用描述/角色',
+        5: '低价值/元数据',
+    },
+    'e621': {
+        0: '',
+        1: '图片风格/画师',
+        3: '非通用描述/作品',
+        4: '非通用描述/角色',
+        5: '角色/福瑞/物种',
+        6: '低价值/无效',
+        7: '低价值/元数据',
+        8: '非通用描述/设定',
+    },
+}
+
 ANALYSIS_README = """使用说明：
 1. 将tags粘贴到左边的输入框中。第一行为正面tag，第二行为负面tag，忽略空行以及三行之后的附加数据。可以直接粘贴从C站上复制下来的图片参数。
 2. 下方左侧列表显示正面tag分析结果，右侧列表显示负面tag分析结果。如果数据库中有对应tag的数据，则展示更多信息，否则除权重外显示空白。
@@ -1,10 +1,11 @@
+import sys
+import math
 import random
 import string
 import traceback
 
-import requests
+import numpy as np
 import pandas as pd
-from pandas._testing import assert_frame_equal
 
 RIGHT_INDICATOR = "__Right_Sleepy_299792458"
 
@@ -13,6 +14,9 @@ RIGHT_INDICATOR = "__Right_Sleepy_299792458"
 # Thanks youdao providing API KEY free translate service.
 
 def youdao_translate(query, from_lang='AUTO', to_lang='AUTO'):
+    # Import on first use. Requests is slow to import and only needed for online translation.
+    import requests
+
     url = 'http://fanyi.youdao.com/translate'
     data = {
         "i": query,
@@ -175,6 +179,165 @@ def concat_df_exclude(df1: pd.DataFrame, df2: pd.DataFrame, df3: pd.DataFrame, p
     return df1
 
 
+def value_to_text(value) -> str:
+    """
+    The display text of a dataframe cell. NaN is empty and a float of integer value has no decimal part.
+    """
+    if isinstance(value, float):
+        if math.isnan(value):
+            return ''
+        return str(int(value)) if value.is_integer() else str(value)
+    return str(value)
+
+
+def numeric_column_text(series: pd.Series) -> pd.Series:
+    """
+    The text of a numeric column as it's written to csv. NaN is empty and a float is its repr, e.g. '1.0'.
+    """
+    return series.astype(object).map(lambda value: '' if pd.isna(value) else
+                                     repr(float(value)) if isinstance(value, float) else str(value))
+
+
+def numeric_text_to_float(series: pd.Series, column: str = '', primary_keys: pd.Series = None) -> pd.Series:
+    """
+    Convert a numeric column to float only if it loses nothing: every non-empty value is a number and
+    it's written back as the same text, e.g. '1.00' is kept as text because a float is written as '1.0'.
+    :param series: The column of text, float or both.
+    :param column: The column name to report.
+    :param primary_keys: If given, the rows whose value is not a number are reported by the keys.
+    :return: The float column, or the column as text with NaN as ''.
+    """
+    texts = numeric_column_text(series)
+    numbers = pd.to_numeric(texts, errors='coerce')
+    invalid = numbers.isna().values & (texts != '').values
+    if invalid.any():
+        if primary_keys is not None:
+            keys = primary_keys.values[invalid]
+            print(f'Warning: Keep {column} as text. {invalid.sum()} values are not numbers: ' +
+                  ', '.join(f'{key}={value!r}' for key, value in zip(keys[:10], texts.values[invalid][:10])) +
+                  (' ...' if invalid.sum() > 10 else ''))
+        return texts
+    if (numeric_column_text(numbers.astype(float)) != texts).any():
+        return texts
+    return numbers.astype(float)
+
+
+def compact_dataframe(df: pd.DataFrame, categorical_fields: list, numeric_fields: list,
+                      intern_strings: bool = True, primary_key: str = None) -> pd.DataFrame:
+    """
+    Reduce the memory of a string table. The columns that are compact already are not converted again.
+        categorical_fields: Low-cardinality columns become categorical. '' is always a category so fillna('') works.
+        numeric_fields:     Become float if it loses nothing, see numeric_text_to_float(). Otherwise it's text.
+        Other columns:      NaN is filled with ''. If intern_strings, the equal strings share one object.
+
+    Note that a categorical column raises on assignment of a new category. Use set_dataframe_values().
+    :param primary_key: If given, the rows whose numeric field is not a number are reported by this column.
+    :return: The compact dataframe. The input dataframe is not modified.
+    """
+    df = df.copy(deep=False)
+    primary_keys = df[primary_key] if primary_key in df.columns else None
+    for column in df.columns:
+        series = df[column]
+        if column in numeric_fields and not pd.api.types.is_float_dtype(series.dtype):
+            series = numeric_text_to_float(series, column, primary_keys)
+        if column in categorical_fields:
+            if not isinstance(series.dtype, pd.CategoricalDtype):
+                series = series.astype(object).where(series.notna(), '').map(value_to_text).astype('category')
+            if '' not in series.cat.categories:
+                series = series.cat.add_categories([''])
+            if series.hasnans:
+                series = series.fillna('')
+        elif column in numeric_fields and pd.api.types.is_float_dtype(series.dtype):
+            pass
+        elif series.dtype == object or series.hasnans:
+            if series.hasnans:
+                series = series.astype(object).fillna('')
+            if intern_strings and series.dtype == object:
+                codes, uniques = pd.factorize(series)
+                series = pd.Series(uniques.take(codes), index=series.index, name=column)
+        df[column] = series
+    return df
+
+
+def copy_on_write(df: pd.DataFrame, fields: list) -> pd.DataFrame:
+    """
+    A shallow copy of df with the given columns copied, so that the columns can be modified
+    without changing df. The other columns are shared.
+    """
+    df = df.copy(deep=False)
+    for field in fields:
+        if field in df.columns:
+            df[field] = df[field].copy()
+    return df
+
+
+def set_dataframe_values(df: pd.DataFrame, rows, field: str, values):
+    """
+    df.loc[rows, field] = values, which also works for a categorical column with new categories.
+    """
+    if field not in df.columns:
+        df[field] = ''
+    if pd.api.types.is_list_like(values):
+        # A categorical can't be assigned to another categorical with different categories
+        values = np.asarray(values, dtype=object)
+    series = df[field]
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        new_categories = pd.Index(pd.unique(np.atleast_1d(np.asarray(values, dtype=object)))) \
+            .difference(series.cat.categories)
+        if len(new_categories) > 0:
+            df[field] = series.cat.add_categories(new_categories)
+    elif pd.api.types.is_float_dtype(series.dtype):
+        # Keep the column numeric. If a value is not a number, the column becomes text so that it's not lost.
+        texts = pd.Series(np.atleast_1d(np.asarray(values, dtype=object)))
+        texts = texts.where(texts.notna(), '')
+        numbers = pd.to_numeric(texts, errors='coerce')
+        if (numbers.isna() & (texts.astype(str).str.strip() != '')).any():
+            df[field] = numeric_column_text(series)
+        else:
+            values = numbers.values[0] if np.ndim(rows) == 0 else numbers.values
+    df.loc[rows, field] = values
+
+
+def concat_dataframes_keeping_categories(frames: [pd.DataFrame]) -> pd.DataFrame:
+    """
+    Concat dataframes by rows. pd.concat() turns categorical columns with different categories into object,
+    so a column that is categorical in all frames is combined by union_categoricals().
+    """
+    columns = list(dict.fromkeys(column for frame in frames for column in frame.columns))
+    data = {}
+    for column in columns:
+        # The missing column of a frame is empty, in the same kind of dtype as the other frames
+        dtype = next(frame[column].dtype for frame in frames if column in frame.columns)
+        if isinstance(dtype, pd.CategoricalDtype):
+            empty = lambda n: pd.Series(pd.Categorical([''] * n))
+        else:
+            empty = lambda n: pd.Series([np.nan] * n, dtype=float if pd.api.types.is_float_dtype(dtype) else object)
+        parts = [frame[column] if column in frame.columns else empty(len(frame)) for frame in frames]
+        if all(isinstance(part.dtype, pd.CategoricalDtype) for part in parts):
+            data[column] = pd.Series(pd.api.types.union_categoricals(parts, ignore_order=True))
+        else:
+            data[column] = pd.concat(parts, ignore_index=True)
+    return pd.DataFrame(data, columns=columns)
+
+
+def dataframe_memory_report(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    The memory usage of each column. Unlike memory_usage(deep=True), a shared string object is only counted once.
+    :return: Dataframe of [column, dtype, bytes] with a 'Total' row at the end.
+    """
+    report = []
+    for column in df.columns:
+        series = df[column]
+        if series.dtype == object:
+            unique_objects = {id(value): value for value in series.values}
+            size = series.values.nbytes + sum(sys.getsizeof(value) for value in unique_objects.values())
+        else:
+            size = series.memory_usage(index=False, deep=True)
+        report.append({'column': column, 'dtype': str(series.dtype), 'bytes': int(size)})
+    report.append({'column': 'Total', 'dtype': '', 'bytes': int(sum(item['bytes'] for item in report))})
+    return pd.DataFrame(report)
+
+
 # ----------------------------------------------------------------------------------------------------------------------
 # Test case are generated by new Bing and adjust by manual
 # ----------------------------------------------------------------------------------------------------------------------
@@ -371,6 +534,32 @@ def test_upsert_df_from_right():
     pd.testing.assert_frame_equal(df_merged, expected_df)
 
 
+def test_compact_dataframe():
+    df = pd.DataFrame({'tag': ['a', 'b', 'c'], 'path': ['x', np.nan, 'x'],
+                       'weight': ['1.2', '', '0.9'], 'comments': ['same', 'same', np.nan]})
+    df = compact_dataframe(df, ['path'], ['weight'])
+
+    assert isinstance(df['path'].dtype, pd.CategoricalDtype)
+    assert list(df['path']) == ['x', '', 'x']
+    assert df['weight'].dtype == float and df['weight'][0] == 1.2 and np.isnan(df['weight'][1])
+    assert list(df['comments']) == ['same', 'same', ''] and df['comments'][0] is df['comments'][1]
+
+    set_dataframe_values(df, [0, 2], 'path', 'new/path')
+    set_dataframe_values(df, 1, 'weight', '0.5')
+    assert list(df['path']) == ['new/path', '', 'new/path'] and df['weight'][1] == 0.5
+    assert value_to_text(df['weight'][2]) == '0.9' and value_to_text(2.0) == '2'
+
+    # A value that is not a number is kept as text, with the column
+    set_dataframe_values(df, 2, 'weight', 'bad')
+    assert list(df['weight']) == ['1.2', '0.5', 'bad']
+
+    # The text that can't be written back the same is not converted
+    df = pd.DataFrame({'tag': ['a', 'b', 'c', 'd'], 'weight': ['1.00', '', 'bad', '1.1']})
+    assert list(compact_dataframe(df, [], ['weight'], primary_key='tag')['weight']) == ['1.00', '', 'bad', '1.1']
+    assert list(compact_dataframe(df[:2], [], ['weight'])['weight']) == ['1.00', '']
+    assert compact_dataframe(df[3:], [], ['weight'])['weight'].dtype == float
+
+
 # def test_update_df_by_dicts_1():
 #     # Test case 1: data is a dict and data's keys exist in df
 #     df = pd.DataFrame({'A': [1, 2], 'B': [3, 4]})
@@ -459,6 +648,8 @@ def main():
 
     test_upsert_df_from_right()
 
+    test_compact_dataframe()
+
     # test_update_df_by_dicts_1()
     # test_update_df_by_dicts_2()
     # test_update_df_by_dicts_3()
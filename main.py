@@ -1,41 +1,171 @@
 import sys
-from PyQt5.QtWidgets import QApplication, QMainWindow, QTabWidget
+import time
+import threading
+
+from app_utility import StartupProfiler
+
+# Run with --startup-report to print the import and startup phase timing.
+# The profiler must be created before the heavy imports below to measure them.
+startup_profiler = StartupProfiler('--startup-report' in sys.argv)
+
+from PyQt5.QtCore import QTimer
+from PyQt5.QtWidgets import QApplication, QMainWindow, QTabWidget, QWidget, QVBoxLayout, QProgressDialog
 
 from TagManager import TagManager
 from AnalyserWindow import AnalyserWindow
-from GenerateWindow import GenerateWindow
-from defines import PUBLIC_DATABASE, PRIVATE_DATABASE, BACKUP_LIMIT
+from TagManager import DATABASE_FIELDS
+from TagStorage import SqliteTagStorage
+from defines import PUBLIC_DATABASE, PRIVATE_DATABASE, BACKUP_LIMIT, JOURNAL_LIMIT, SAVE_DELAY, \
+    DATABASE_BACKEND, SQLITE_DATABASE, SHARED_DICTIONARY, EXTERNAL_CHANGE_POLL_INTERVAL, STATISTICS_FLUSH_INTERVAL
+
+startup_profiler.mark('import modules')
 
 
 class MainWindow(QMainWindow):
-    def __init__(self):
+    def __init__(self, tag_manager: TagManager = None):
         super(MainWindow, self).__init__()
-        self.tag_manager = TagManager(PUBLIC_DATABASE, PRIVATE_DATABASE, BACKUP_LIMIT)
+        self.tag_manager = tag_manager if tag_manager is not None else MainWindow.create_tag_manager()
+        # Coalesce the database change notifications of one event loop iteration into one
+        self.tag_manager.set_notification_scheduler(lambda notify: QTimer.singleShot(0, notify))
+
+        # Hot reload the changes of database files by other instances, scripts or Excel
+        self.external_change_timer = QTimer(self)
+        self.external_change_timer.timeout.connect(self.on_external_change_timer)
+        self.external_change_timer.start(EXTERNAL_CHANGE_POLL_INTERVAL)
+
+        # Write the collected tag statistics in batch. The rest is flushed by tag_manager.close().
+        self.statistics_flush_timer = QTimer(self)
+        self.statistics_flush_timer.timeout.connect(self.on_statistics_flush_timer)
+        self.statistics_flush_timer.start(STATISTICS_FLUSH_INTERVAL)
+        startup_profiler.mark('load tag database')
 
         self.tabs = QTabWidget()
         self.tabs.currentChanged.connect(self.on_tab_changed)
 
         self.analysis_tab = AnalyserWindow(self.tag_manager)
-        self.generate_tab = GenerateWindow(self.tag_manager)
+        startup_profiler.mark('build analysis tab')
+
+        # The generate tab is built when it's activated for the first time
+        self.generate_tab = None
+        self.generate_tab_holder = QWidget()
+        self.generate_tab_holder.setLayout(QVBoxLayout())
+        self.generate_tab_holder.layout().setContentsMargins(0, 0, 0, 0)
 
         self.init_ui()
 
     def init_ui(self):
         self.tabs.addTab(self.analysis_tab, "Analysis")
-        self.tabs.addTab(self.generate_tab, "Generate")
+        self.tabs.addTab(self.generate_tab_holder, "Generate")
         self.setCentralWidget(self.tabs)
         self.resize(1280, 800)
         self.setWindowTitle('Stable Diffusion Tag 分析管理 - Sleepy')
 
+    @staticmethod
+    def create_tag_manager(load_progress: callable = None) -> TagManager:
+        return TagManager(PUBLIC_DATABASE, PRIVATE_DATABASE, BACKUP_LIMIT, JOURNAL_LIMIT, SAVE_DELAY,
+                          MainWindow.create_storage(), load_progress, MainWindow.create_dictionary())
+
+    @staticmethod
+    def create_storage():
+        if DATABASE_BACKEND == 'sqlite':
+            storage = SqliteTagStorage(SQLITE_DATABASE, DATABASE_FIELDS)
+            if storage.is_empty():
+                storage.import_csv(PUBLIC_DATABASE, PRIVATE_DATABASE)
+            return storage
+        # None for the default csv storage
+        return None
+
+    @staticmethod
+    def create_dictionary():
+        return SqliteTagStorage(SHARED_DICTIONARY, DATABASE_FIELDS) if SHARED_DICTIONARY != '' else None
+
+    def on_external_change_timer(self):
+        try:
+            self.tag_manager.check_external_changes()
+        except Exception as e:
+            print('Check external changes fail.')
+            print(e)
+        finally:
+            pass
+
+    def on_statistics_flush_timer(self):
+        try:
+            self.tag_manager.get_tag_statistics().flush()
+        except Exception as e:
+            print('Flush tag statistics fail.')
+            print(e)
+        finally:
+            pass
+
+    def closeEvent(self, event):
+        self.external_change_timer.stop()
+        self.statistics_flush_timer.stop()
+        self.tag_manager.close()
+        super(MainWindow, self).closeEvent(event)
+
     def on_tab_changed(self, index):
         if index == 0:
             self.analysis_tab.on_widget_activated()
         else:
-            self.generate_tab.on_widget_activated()
+            self.ensure_generate_tab().on_widget_activated()
+
+    def ensure_generate_tab(self):
+        if self.generate_tab is None:
+            from GenerateWindow import GenerateWindow
+            self.generate_tab = GenerateWindow(self.tag_manager)
+            self.generate_tab_holder.layout().addWidget(self.generate_tab)
+        return self.generate_tab
+
+
+def load_tag_manager(app: QApplication) -> TagManager:
+    """
+    Load the tag database on a worker thread and keep the UI responsive.
+    A progress dialog is shown if the loading takes more than a moment, e.g. for a large imported tag dump.
+    """
+    result = {}
+    progress = {'done': 0, 'total': 0}
+
+    def on_progress(done: int, total: int):
+        progress['done'], progress['total'] = done, total
+
+    def do_load():
+        try:
+            result['tag_manager'] = MainWindow.create_tag_manager(on_progress)
+        except Exception as e:
+            result['error'] = e
+
+    thread = threading.Thread(target=do_load, daemon=True)
+    thread.start()
+
+    dialog = None
+    start_time = time.time()
+    while thread.is_alive():
+        thread.join(0.05)
+        if dialog is None and time.time() - start_time > 0.5:
+            dialog = QProgressDialog('Loading tag database...', None, 0, 1000)
+            dialog.setWindowTitle('Stable Diffusion Tag 分析管理 - Sleepy')
+            dialog.setMinimumDuration(0)
+            dialog.show()
+        if dialog is not None and progress['total'] > 0:
+            dialog.setValue(int(progress['done'] * 1000 / progress['total']))
+        app.processEvents()
+    if dialog is not None:
+        dialog.close()
+
+    if 'error' in result:
+        raise result['error']
+    return result['tag_manager']
+
+
+def print_startup_report():
+    startup_profiler.mark('first paint')
+    print(startup_profiler.report())
 
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
-    main_window = MainWindow()
+    main_window = MainWindow(load_tag_manager(app))
     main_window.show()
+    if startup_profiler.is_enabled():
+        QTimer.singleShot(0, print_startup_report)
     sys.exit(app.exec_())
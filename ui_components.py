@@ -5,22 +5,27 @@ from functools import partial
 import pandas as pd
 from PyQt5 import QtGui
 
-from PyQt5.QtCore import Qt, QMimeData
-from PyQt5.QtGui import QDrag
+from PyQt5.QtCore import Qt, QMimeData, QModelIndex
+from PyQt5.QtGui import QDrag, QStandardItemModel, QStandardItem
 from PyQt5.QtWidgets import QVBoxLayout, QTableWidget, QTableWidgetItem, QTreeWidget, QAbstractItemView, QDialog, \
-    QPushButton, QDialogButtonBox, QTreeWidgetItem, QPlainTextEdit
+    QPushButton, QDialogButtonBox, QTreeWidgetItem, QPlainTextEdit, QCompleter, QMenu, QAction, QInputDialog
 
-from Prompts import try_float, WEIGHT_INC_BASE, WEIGHT_DEC_BASE, Prompts
+from Prompts import try_float, WEIGHT_INC_BASE, WEIGHT_DEC_BASE, Prompts, to_weight_array, scale_weights, \
+    clamp_weights, normalize_weights
 from TagManager import PRIMARY_KEY, TagManager
+from TagWeightList import TagWeightList
 from app_utility import format_float
-from df_utility import translate_df
+from df_utility import translate_df, set_dataframe_values, value_to_text, copy_on_write
 
 
 class DataFrameRowEditDialog(QDialog):
-    def __init__(self, df: pd.DataFrame, field_name_mapping: dict, edit_row_data: pd.DataFrame, unique_field: str):
+    def __init__(self, tag_manager: TagManager, field_name_mapping: dict, edit_row_data: pd.DataFrame,
+                 unique_field: str):
         super().__init__()
 
-        self.database = df
+        df = tag_manager.get_database()
+
+        self.tag_manager = tag_manager
         self.unique_field = unique_field
         self.unique_field_value = ''
 
@@ -46,7 +51,7 @@ class DataFrameRowEditDialog(QDialog):
             if edit_row_data is not None and not edit_row_data.empty and field in edit_row_data.columns:
                 # If the edit_row_data is not empty and unique_field is not empty -> Edit mode
                 # Get the first row of the filtered dataframe
-                item = QTableWidgetItem(edit_row_data.iloc[0][field])
+                item = QTableWidgetItem(value_to_text(edit_row_data.iloc[0][field]))
                 if field == unique_field:
                     self.unique_field_value = edit_row_data.iloc[0][unique_field]
                     if self.unique_field_value.strip() != '':
@@ -84,7 +89,6 @@ class DataFrameRowEditDialog(QDialog):
     def accept(self):
         # Get the data from the table
         data = {}
-        df = self.database
         for row_idx in range(self.table_widget.rowCount()):
             field_item = self.table_widget.item(row_idx, 0)
             value_item = self.table_widget.item(row_idx, 1)
@@ -92,21 +96,19 @@ class DataFrameRowEditDialog(QDialog):
             if field_item and value_item:
                 data[field_name] = value_item.text().strip()
 
-        index = df.index[df[self.unique_field] == self.unique_field_value].tolist()
-        if not index:
-            index = len(df)
-        else:
-            index = index[0]
-        df.loc[index] = data
+        # In append mode the unique field is typed by user, so the row is upserted by the final value.
+        data.setdefault(self.unique_field, self.unique_field_value)
+        with self.tag_manager.edit_session() as session:
+            session.upsert_row(data)
 
         # Call the base accept method to close the dialog
         super().accept()
 
 
 class DraggableTree(QTreeWidget):
-    def __init__(self, database: pd.DataFrame, on_edit_done, parent=None):
+    def __init__(self, tag_manager: TagManager, on_edit_done, parent=None):
         super().__init__(parent)
-        self.database = database
+        self.tag_manager = tag_manager
         self.on_operation_done = on_edit_done
         self.setAcceptDrops(True)
         self.setDragEnabled(True)
@@ -159,19 +161,27 @@ class DraggableTree(QTreeWidget):
                 current_item = self.itemAt(event.pos())
                 full_path = self.get_node_path(current_item)
 
-                df = self.update_tags_path(self.database, selected_data, full_path)
-                self.on_operation_done(df, refresh_tree=False)
+                df = self.update_tags_path(self.tag_manager.get_database(), selected_data, full_path)
+                self.on_operation_done(df)
 
     def update_tags_path(self, df: pd.DataFrame, tags: [str], _path: str) -> pd.DataFrame or None:
-        # Check if any of the tags already exist in the dataframe
+        # Split the tags into the existing rows (by the index of tag manager) and the new tags
+        exists_rows = []
+        new_tags = []
         for tag in tags:
-            if tag in df[PRIMARY_KEY].values:
-                df.loc[df[PRIMARY_KEY] == tag, 'path'] = _path
-            else:
-                # Create a new row with the tags and path
-                new_row = pd.DataFrame({PRIMARY_KEY: [tag], 'path': [_path]})
-                # Append the new row to the dataframe
-                df = df.append(new_row, ignore_index=True)
+            index = self.tag_manager.get_row_index(tag)
+            if index is not None:
+                exists_rows.append(index)
+            elif tag not in new_tags:
+                new_tags.append(tag)
+        if len(exists_rows) > 0:
+            # Copy on write. The database frame is not modified in place.
+            df = copy_on_write(df, ['path'])
+            set_dataframe_values(df, exists_rows, 'path', _path)
+        if len(new_tags) > 0:
+            # Append the new rows with the tags and path to the dataframe
+            new_rows = pd.DataFrame({PRIMARY_KEY: new_tags, 'path': [_path] * len(new_tags)})
+            df = pd.concat([df, new_rows], ignore_index=True)
         return df
 
     def save_expand_items(self) -> list:
@@ -252,6 +262,42 @@ class TagViewTableWidget(QTableWidget):
         event.ignore()
 
 
+def add_weight_operation_menu(menu: QMenu, parent, tag_manager: TagManager, apply_operation: callable):
+    """
+    Add the bulk weight operations of selected rows to a menu.
+    :param apply_operation: Called with operation(tags, weights) -> weights working on the arrays of all rows.
+    """
+    weight_menu = menu.addMenu('批量调整权重')
+
+    def on_scale():
+        factor, ok = QInputDialog.getDouble(parent, '缩放权重', '权重乘以', 1.1, 0.01, 10.0, 2)
+        if ok:
+            apply_operation(lambda tags, weights: scale_weights(weights, factor))
+
+    def on_clamp():
+        lower, ok = QInputDialog.getDouble(parent, '限制权重范围', '最小权重', 0.5, 0.0, 10.0, 2)
+        if not ok:
+            return
+        upper, ok = QInputDialog.getDouble(parent, '限制权重范围', '最大权重', 1.5, 0.0, 10.0, 2)
+        if ok:
+            apply_operation(lambda tags, weights: clamp_weights(weights, lower, upper))
+
+    def on_normalize():
+        mean, ok = QInputDialog.getDouble(parent, '归一化权重', '目标平均权重', 1.0, 0.01, 10.0, 2)
+        if ok:
+            apply_operation(lambda tags, weights: normalize_weights(weights, mean))
+
+    for text, handler in [('缩放...', on_scale), ('限制范围...', on_clamp), ('归一化到平均值...', on_normalize)]:
+        action = QAction(text, parent)
+        action.triggered.connect(handler)
+        weight_menu.addAction(action)
+
+    reset_action = QAction('恢复数据库默认权重', parent)
+    reset_action.triggered.connect(
+        lambda: apply_operation(lambda tags, weights: tag_manager.get_default_weights(tags)))
+    weight_menu.addAction(reset_action)
+
+
 class TagEditTableWidget(QTableWidget):
     def __init__(self, tag_manager: TagManager, fields: OrderedDict, *args, **kwargs):
         super(TagEditTableWidget, self).__init__(*args, **kwargs)
@@ -267,6 +313,29 @@ class TagEditTableWidget(QTableWidget):
         self.setColumnCount(len(fields) + 2)
         self.setHorizontalHeaderLabels(list(fields.values()) + ['', ''])
 
+        self.setContextMenuPolicy(Qt.CustomContextMenu)
+        self.customContextMenuRequested.connect(self.on_right_click)
+
+    def on_right_click(self, position):
+        menu = QMenu()
+        add_weight_operation_menu(menu, self, self.tag_manager, self.apply_weight_operation)
+        menu.exec_(self.viewport().mapToGlobal(position))
+
+    def apply_weight_operation(self, operation: callable):
+        """
+        Apply operation(tags, weights) -> weights to the selected rows in one pass.
+        """
+        tags = set(self.get_selected_row_data(0))
+        mask = self.table_editing_data[PRIMARY_KEY].isin(tags).values
+        if not mask.any():
+            return
+        weights = to_weight_array(self.table_editing_data['weight'])
+        weights[mask] = operation(self.table_editing_data[PRIMARY_KEY].values[mask], weights[mask])
+        self.table_editing_data['weight'] = weights
+        for row in range(self.rowCount()):
+            if self.item(row, 0).text() in tags:
+                self.update_row_weight(row)
+
     def keyPressEvent(self, event):
         if event.key() == Qt.Key_Delete:
             rows = sorted(set(item.row() for item in self.selectedItems()))
@@ -321,6 +390,7 @@ class TagEditTableWidget(QTableWidget):
             self.table_editing_data = self.table_editing_data.append(
                 pd.DataFrame(append_rows, columns=self.table_editing_data.columns))
             self.table_editing_data = self.table_editing_data.reset_index(drop=True)
+            self.table_editing_data['weight'] = to_weight_array(self.table_editing_data['weight'])
             translate_df(self.table_editing_data, PRIMARY_KEY, 'translate_cn', True, True)
             event.accept()
         self.update_table()
@@ -389,15 +459,8 @@ class TagEditTableWidget(QTableWidget):
                 self.table_editing_data.loc[self.table_editing_data[PRIMARY_KEY] == tag, column_name] = data
 
     def generate_prompts(self) -> str:
-        flat_tags = []
-        for index, row in self.table_editing_data.iterrows():
-            tag = row['tag']
-            weight = row['weight']
-
-            if try_float(weight):
-                tag = '(%s: %s)' % (tag, weight)
-            flat_tags.append(tag)
-        return ', '.join(flat_tags)
+        df = self.table_editing_data
+        return Prompts.tag_weights_to_string(TagWeightList(list(df[PRIMARY_KEY]), to_weight_array(df['weight'])), True)
 
     def generate_files(self, file_name: str, wildcards_path: str):
         df_flat_tags = self.table_editing_data[
@@ -413,21 +476,9 @@ class TagEditTableWidget(QTableWidget):
                 f.write(tags)
             wildcards.append(f"__{shuffle}__")
 
-        flat_tags = []
-        for index, row in df_flat_tags.iterrows():
-            tag = row['tag']
-            weight = row['weight']
-
-            if try_float(weight):
-                tag = '(%s: %s)' % (tag, weight)
-
-            # # If the weight is 1, than it's (tag), if 2 than ((tag)) and so on.
-            # if weight > 0:
-            #     tag = f"{'(' * weight}{tag}{')' * weight}"
-            # elif weight < 0:
-            #     tag = f"{'[' * abs(weight)}{tag}{']' * abs(weight)}"
-
-            flat_tags.append(tag)
+        flat_tags = Prompts.tag_weights_to_string(
+            TagWeightList(list(df_flat_tags[PRIMARY_KEY]), to_weight_array(df_flat_tags['weight'])), True)
+        flat_tags = [flat_tags] if flat_tags != '' else []
 
         with open(file_name, 'w') as f:
             f.write(', '.join(wildcards + flat_tags))
@@ -442,24 +493,12 @@ class TagEditTableWidget(QTableWidget):
         if PRIMARY_KEY in self.table_editing_data.columns:
             # Pass the tag to handling function with partial
             # Handle '+' button click
-            if operation == '+':
-                weight = self.table_editing_data.loc[self.table_editing_data[PRIMARY_KEY] == tag, 'weight']
-                weight_digit = try_float(weight)
-                if weight_digit is not None:
-                    weight_digit += 0.1
-                else:
-                    weight_digit = 1.1
-                self.table_editing_data.loc[self.table_editing_data[PRIMARY_KEY] == tag, 'weight'] = weight_digit
-            elif operation == '-':
-                weight = self.table_editing_data.loc[self.table_editing_data[PRIMARY_KEY] == tag, 'weight']
-                weight_digit = try_float(weight)
-                if weight_digit is not None:
-                    weight_digit -= 0.1
-                else:
-                    weight_digit = 0.9
-                self.table_editing_data.loc[self.table_editing_data[PRIMARY_KEY] == tag, 'weight'] = weight_digit
-            else:
+            if operation not in ['+', '-']:
                 raise ValueError(f'Invalid operation: {operation}')
+            mask = (self.table_editing_data[PRIMARY_KEY] == tag).values
+            weights = to_weight_array(self.table_editing_data['weight'])
+            weights[mask] += 0.1 if operation == '+' else -0.1
+            self.table_editing_data['weight'] = weights
             self.update_row_weight(row)
 
     def adjust_order(self):
@@ -529,11 +568,76 @@ class TagEditTableWidget(QTableWidget):
 
 
 class PromptPlainTextEdit(QPlainTextEdit):
+    # The characters that end a tag when looking back from the cursor
+    TAG_DELIMITERS = ',，\n()[]{}<>|:'
+    COMPLETION_LIMIT = 10
+
     def __init__(self, positive_prompts: bool, parent=None):
         super().__init__(parent)
         self.positive_prompts = positive_prompts
         self.setAcceptDrops(True)
 
+        self.tag_manager = None
+        self.completer = None
+        self.completion_model = None
+
+    def set_tag_completion(self, tag_manager: TagManager):
+        """
+        Complete the tag being typed by the tags and translations of database.
+        """
+        self.tag_manager = tag_manager
+        self.completion_model = QStandardItemModel(self)
+        self.completer = QCompleter(self.completion_model, self)
+        self.completer.setWidget(self)
+        # The items are matched by the index, including the translation. Show them as they are.
+        self.completer.setCompletionMode(QCompleter.UnfilteredPopupCompletion)
+        self.completer.activated[QModelIndex].connect(self.on_completion_activated)
+
+    def typing_tag(self) -> str:
+        text = self.toPlainText()[:self.textCursor().position()]
+        start = max(text.rfind(delimiter) for delimiter in self.TAG_DELIMITERS) + 1
+        return text[start:].lstrip()
+
+    def keyPressEvent(self, event):
+        popup = self.completer.popup() if self.completer is not None else None
+        if popup is not None and popup.isVisible() and \
+                event.key() in [Qt.Key_Enter, Qt.Key_Return, Qt.Key_Escape, Qt.Key_Tab, Qt.Key_Backtab]:
+            # Let the completer handle the keys
+            event.ignore()
+            return
+        super().keyPressEvent(event)
+        if self.completer is not None and event.text() != '':
+            self.update_completion()
+
+    def update_completion(self):
+        tag = self.typing_tag()
+        # A single ascii character matches too many tags
+        tags = self.tag_manager.complete_tags(tag, self.COMPLETION_LIMIT) \
+            if len(tag) > 1 or (len(tag) == 1 and not tag.isascii()) else []
+        if len(tags) == 0:
+            self.completer.popup().hide()
+            return
+
+        self.completion_model.clear()
+        for completion in tags:
+            translation = self.tag_manager.get_property(completion, 'translate_cn')
+            item = QStandardItem(completion + ('  ' + translation if translation else ''))
+            item.setData(completion, Qt.UserRole)
+            self.completion_model.appendRow(item)
+
+        rect = self.cursorRect()
+        rect.setWidth(self.completer.popup().sizeHintForColumn(0) +
+                      self.completer.popup().verticalScrollBar().sizeHint().width())
+        self.completer.complete(rect)
+
+    def on_completion_activated(self, index: QModelIndex):
+        completion = index.data(Qt.UserRole)
+        cursor = self.textCursor()
+        for _ in range(len(self.typing_tag())):
+            cursor.deletePreviousChar()
+        cursor.insertText(completion)
+        self.setTextCursor(cursor)
+
     def set_prompts(self, prompts: Prompts):
         self.setPlainText(prompts.positive_tag_string(True))
 
@@ -544,20 +648,12 @@ class PromptPlainTextEdit(QPlainTextEdit):
 
     def on_accept_tag_data(self, tag_data: [dict]):
         new_prompts = Prompts()
-        if not new_prompts.from_record(tag_data, self.positive_prompts):
+        if not new_prompts.from_record(tag_data, True):
             return False
-        now_prompts = Prompts()
-        if now_prompts.from_text(self.toPlainText()):
-            now_prompts.merge(new_prompts)
-            self.setPlainText(
-                now_prompts.positive_tag_string(True)
-                if self.positive_prompts else
-                now_prompts.negative_tag_string(True))
-        else:
-            self.appendPlainText(
-                new_prompts.positive_tag_string(True)
-                if self.positive_prompts else
-                new_prompts.negative_tag_string(True))
+        # The edit holds one side of prompts only, so the whole text is the tags of that side
+        tag_weights = Prompts.parse_tag_weights(self.toPlainText())
+        Prompts.merge_tag_weights(tag_weights, new_prompts.positive_tag_weights)
+        self.setPlainText(Prompts.tag_weights_to_string(tag_weights, True))
 
     def dropEvent(self, event):
         try: